@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+""" Compares FASTA searches that use the k-mer prefilter with searches of the whole library: how many of the hits
+of the full search the prefiltered search also finds (recall), and how long each takes.
+
+Needs the FASTA libraries built by the reloader (--fasta) in the configured fasta_directory, and the fasta36
+binary. Queries can be given as a file with one sequence per line. Otherwise fragments of random library sequences
+with some mutations are used. The prefilter settings from the configuration are used, but the prefilter is turned
+on even if it isn't enabled there.
+
+Run from the server/wsgi directory: python -m benchmarks.fasta_prefilter [type] [queries.txt] """
+
+import os
+import random
+import sys
+import time
+from tempfile import NamedTemporaryFile
+
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.fasta import get_fasta_library, run_fasta
+from bmrbapi.utils.querymod import SUBMODULE_DIR
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+
+
+def make_up_queries(library, a_type: str, count: int = 50, seed: int = 1):
+    """ Makes up queries from fragments of library sequences, with about one in ten residues changed. """
+
+    generator = random.Random(seed)
+    kmer_index = library.kmer_index(a_type)
+    for _ in range(count):
+        sequence = kmer_index.sequence(generator.randrange(len(kmer_index)))
+        start = generator.randrange(max(1, len(sequence) - 40))
+        fragment = list(sequence[start:start + generator.randint(40, 200)])
+        for position in range(len(fragment)):
+            if generator.random() < .1:
+                fragment[position] = generator.choice(AMINO_ACIDS)
+        yield "".join(fragment)
+
+
+def main():
+    a_type = sys.argv[1] if len(sys.argv) > 1 else 'polymer'
+    fasta_binary = os.path.join(SUBMODULE_DIR, "fasta36", "bin", "fasta36")
+    library = get_fasta_library()
+    if not library or not library.kmer_index(a_type):
+        print("The FASTA libraries haven't been built. Run the reloader with --fasta first.")
+        sys.exit(1)
+    configuration.setdefault('fasta', {}).setdefault('prefilter', {})['enabled'] = True
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'r') as queries_file:
+            queries = [line.strip().upper() for line in queries_file if line.strip()]
+    else:
+        queries = list(make_up_queries(library, a_type))
+
+    full_time = prefiltered_time = 0
+    full_hits = found_hits = fallbacks = 0
+    for query in queries:
+        with NamedTemporaryFile() as query_file, NamedTemporaryFile() as candidates_file:
+            query_file.write((">query\n%s" % query).encode())
+            query_file.flush()
+
+            start = time.perf_counter()
+            expected = run_fasta([fasta_binary, "-m", "8"], query_file.name, library.library_files(a_type),
+                                 library.size(a_type))
+            full_time += time.perf_counter() - start
+
+            start = time.perf_counter()
+            candidates = library.write_candidates(a_type, query, candidates_file)
+            if candidates is None:
+                fallbacks += 1
+                result = run_fasta([fasta_binary, "-m", "8"], query_file.name, library.library_files(a_type),
+                                   library.size(a_type))
+            elif candidates:
+                result = run_fasta([fasta_binary, "-m", "8"], query_file.name, [candidates_file.name],
+                                   library.size(a_type))
+            else:
+                result = []
+            prefiltered_time += time.perf_counter() - start
+
+        expected_ids = set(cols[1] for cols in expected)
+        full_hits += len(expected_ids)
+        found_hits += len(expected_ids & set(cols[1] for cols in result))
+
+    print("%d queries, %d searched the whole library instead." % (len(queries), fallbacks))
+    print("Recall: %d of %d hits (%.1f%%)" % (found_hits, full_hits, 100 * found_hits / max(full_hits, 1)))
+    print("Full: %.3fs, prefiltered: %.3fs (%.1fx faster)" % (full_time, prefiltered_time,
+                                                              full_time / prefiltered_time))
+
+
+if __name__ == "__main__":
+    main()
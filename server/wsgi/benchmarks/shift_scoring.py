@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+""" Checks that the numpy shift list scoring gives exactly the same results as the original Decimal scoring, and
+compares their speed.
+
+Recorded queries can be given as a file with one JSON object per line, each with the "shifts" queried, the
+"thresholds" used, and the "data" returned by /search/multiple_shift_search. Otherwise random queries are made up.
+
+Run from the server/wsgi directory: python -m benchmarks.shift_scoring [recorded_queries.jsonl] """
+
+import copy
+import random
+import sys
+import time
+from decimal import Decimal
+
+import simplejson as json
+
+from bmrbapi.utils.shift_scoring import score_shift_lists, score_shift_lists_decimal
+
+DEFAULT_THRESHOLDS = {'N': .2, 'C': .2, 'H': .01}
+
+
+def load_recorded(path: str):
+    """ Loads recorded queries. """
+
+    with open(path, 'r') as recorded:
+        for line in recorded:
+            query = json.loads(line, use_decimal=True)
+            shift_lists = [{'Entry_ID': x['Entry_ID'], 'Assigned_chem_shift_list_ID': x['Assigned_chem_shift_list_ID'],
+                            'Val': [{'Shift': Decimal(str(y['Shift'])), 'Atom_type': y['Atom_type']}
+                                    for y in x['Val']]} for x in query['data']]
+            thresholds = {k: float(v) for k, v in query.get('thresholds', DEFAULT_THRESHOLDS).items()}
+            yield sorted(Decimal(str(x)) for x in query['shifts']), thresholds, shift_lists
+
+
+def make_up_queries(count: int = 50, seed: int = 1):
+    """ Makes up queries that look like real ones: a few peaks, and thousands of lists each with a few shifts
+    near them. """
+
+    generator = random.Random(seed)
+    ranges = {'C': (10, 180), 'N': (100, 130), 'H': (0, 10)}
+    for _ in range(count):
+        peaks = sorted(Decimal("%.2f" % generator.uniform(0, 180)) for _ in range(generator.randint(1, 12)))
+        shift_lists = []
+        for number in range(generator.randint(100, 3000)):
+            shifts = []
+            for _ in range(generator.randint(1, 40)):
+                atom_type = generator.choice('CNH')
+                if generator.random() < .5:
+                    value = float(generator.choice(peaks)) + generator.uniform(-.2, .2)
+                else:
+                    value = generator.uniform(*ranges[atom_type])
+                shifts.append({'Shift': Decimal("%.*f" % (generator.randint(1, 3), value)), 'Atom_type': atom_type})
+            shift_lists.append({'Entry_ID': 'bmse%06d' % number, 'Assigned_chem_shift_list_ID': '1', 'Val': shifts})
+        yield peaks, DEFAULT_THRESHOLDS, shift_lists
+
+
+def main():
+    queries = load_recorded(sys.argv[1]) if len(sys.argv) > 1 else make_up_queries()
+
+    decimal_time = numpy_time = 0
+    for number, (peaks, thresholds, shift_lists) in enumerate(queries):
+        decimal_lists, numpy_lists = copy.deepcopy(shift_lists), copy.deepcopy(shift_lists)
+
+        start = time.perf_counter()
+        expected = score_shift_lists_decimal(decimal_lists, peaks, thresholds)
+        decimal_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        result = score_shift_lists(numpy_lists, peaks, thresholds)
+        numpy_time += time.perf_counter() - start
+
+        if json.dumps(expected) != json.dumps(result):
+            print("Query %d: results differ." % number)
+            sys.exit(1)
+
+    print("All %d queries gave the same results." % (number + 1))
+    print("Decimal: %.3fs, numpy: %.3fs (%.1fx faster)" % (decimal_time, numpy_time, decimal_time / numpy_time))
+
+
+if __name__ == "__main__":
+    main()
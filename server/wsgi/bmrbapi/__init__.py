@@ -19,11 +19,14 @@ from bmrbapi.exceptions import RequestException, ServerException
 from bmrbapi.schemas import validate_parameters
 from bmrbapi.utils import querymod
 from bmrbapi.utils.configuration import configuration
-from bmrbapi.utils.connections import RedisConnection, PostgresConnection
+from bmrbapi.utils.connections import RedisConnection, PostgresConnection, get_redis_pool_statistics
+from bmrbapi.utils.decorators import RESPONSE_CACHE_STATS_KEY
+from bmrbapi.utils.entry_cache import entry_cache
 from bmrbapi.views.db_links import db_endpoints
 from bmrbapi.views.dictionary import dictionary_endpoints
 from bmrbapi.views.entry import entry_endpoints
 from bmrbapi.views.internal import internal_endpoints
+from bmrbapi.views.jobs import job_endpoints
 from bmrbapi.views.metadata import meta_endpoints
 from bmrbapi.views.molprobity import molprobity_endpoints
 from bmrbapi.views.search import search_endpoints
@@ -37,6 +40,7 @@ application.register_blueprint(entry_endpoints)
 application.register_blueprint(internal_endpoints)
 application.register_blueprint(dictionary_endpoints)
 application.register_blueprint(meta_endpoints)
+application.register_blueprint(job_endpoints)
 
 # Set debug if running from command line
 if application.debug:
@@ -218,13 +222,19 @@ def get_status():
     """ Returns the server status."""
 
     stats = {}
-    for key in ['metabolomics', 'macromolecules', 'chemcomps', 'combined']:
+    databases = ['metabolomics', 'macromolecules', 'chemcomps', 'combined']
+    with RedisConnection() as r:
+        pipe = r.pipeline(transaction=False)
+        for key in databases:
+            pipe.hgetall("%s:meta" % key)
+        pipe.hgetall(RESPONSE_CACHE_STATS_KEY)
+        *meta, response_cache = pipe.execute()
+    for key, values in zip(databases, meta):
         stats[key] = {}
-        with RedisConnection() as r:
-            for k, v in r.hgetall("%s:meta" % key).items():
-                k = k.decode()
-                v = v.decode()
-                stats[key][k] = v
+        for k, v in values.items():
+            k = k.decode()
+            v = v.decode()
+            stats[key][k] = v
         for skey in stats[key]:
             if skey == "update_time":
                 stats[key][skey] = float(stats[key][skey])
@@ -237,6 +247,13 @@ def get_status():
             pg.execute(sql)
             stats[key]['num_chemical_shifts'] = int(pg.fetchone()['reltuples'])
 
+    stats['redis_pool'] = get_redis_pool_statistics()
+    stats['entry_cache'] = entry_cache.statistics()
+    stats['response_cache'] = {}
+    for k, v in response_cache.items():
+        endpoint, counter = k.decode().rsplit(":", 1)
+        stats['response_cache'].setdefault(endpoint, {})[counter] = int(v)
+
     try:
         stats['version'] = subprocess.check_output(["git", "describe", "--abbrev=0"]).strip()
     except subprocess.CalledProcessError:
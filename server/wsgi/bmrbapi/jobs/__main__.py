@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+
+""" Run the jobs queued by the API (see bmrbapi/utils/jobs.py). """
+
+import logging
+import multiprocessing
+import optparse
+import time
+
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.jobs import run_jobs
+
+opt = optparse.OptionParser(usage="usage: %prog", version="1.0",
+                            description="Run the jobs queued by the API, such as asynchronous entry validation.")
+opt.add_option("--processes", action="store", dest="processes", type="int",
+               default=configuration.get('jobs', {}).get('processes', 2),
+               help="How many jobs to run at the same time.")
+opt.add_option("--redis-db", action="store", dest="redis_db", default=configuration['redis']['db'],
+               help="The Redis DB to use. 0 is master.")
+opt.add_option("--verbose", action="store_true", dest="verbose", default=False, help="Be verbose")
+(options, cmd_input) = opt.parse_args()
+
+configuration['redis']['db'] = options.redis_db
+
+logging.basicConfig()
+logger = logging.getLogger()
+if options.verbose:
+    logger.setLevel(logging.DEBUG)
+else:
+    logger.setLevel(logging.WARNING)
+
+logger.info('Running jobs in %d processes...', options.processes)
+workers = [None] * options.processes
+while True:
+    # Start the workers, and start them again if they die
+    for position, worker in enumerate(workers):
+        if worker is None or not worker.is_alive():
+            if worker is not None:
+                logger.error('Job worker %d exited with code %s, restarting it.', position, worker.exitcode)
+            workers[position] = multiprocessing.Process(target=run_jobs, daemon=True)
+            workers[position].start()
+    time.sleep(5)
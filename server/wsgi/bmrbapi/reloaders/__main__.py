@@ -11,12 +11,18 @@ import sys
 import time
 
 from bmrbapi.reloaders.database import one_entry
+from bmrbapi.reloaders.fasta import fasta_libraries
+from bmrbapi.reloaders.hsqc import hsqc_peak_lists
 from bmrbapi.reloaders.inext import inext
 from bmrbapi.reloaders.molprobity import molprobity_full, molprobity_visualizations
+from bmrbapi.reloaders.shift_index import shift_index
 from bmrbapi.reloaders.sql_initialize import sql_initialize
 from bmrbapi.reloaders.timedomain import timedomain
 from bmrbapi.reloaders.uniprot import uniprot
+from bmrbapi.reloaders.validation import validation_reports
 from bmrbapi.reloaders.xml_generate import xml
+from bmrbapi.reloaders.zstd_dictionary import delete_unused_zstd_dictionaries, zstd_dictionary
+from bmrbapi.utils.compression import CODECS, ZSTD_DICTIONARY_ID_KEY
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import PostgresConnection, RedisConnection
 
@@ -65,7 +71,8 @@ def make_entry_list(name: str):
     for each_entry in old_entries:
         if each_entry not in ent_list:
             to_delete = "%s:entry:%s" % (name, each_entry)
-            if r_conn.delete(to_delete):
+            if r_conn.delete(to_delete, "%s:nmrstar:%s" % (name, each_entry),
+                             "%s:entry_index:%s" % (name, each_entry), "%s:entry_info:%s" % (name, each_entry)):
                 logging.info("Deleted stale entry: %s" % to_delete)
 
     # Set the update time, ready status, and entry list
@@ -96,6 +103,16 @@ opt.add_option("--timedomain", action="store_true", dest="timedomain", default=F
 opt.add_option("--uniprot", action="store_true", dest="uniprot", default=False, help="Update the UniProt tables.")
 opt.add_option("--xml", action="store_true", dest="xml", default=False, help="Update the XML file for BMRB entries.")
 opt.add_option("--inext", action="store_true", dest="inext", default=False, help="Update the iNext tables.")
+opt.add_option("--shift-index", action="store_true", dest="shift_index", default=False,
+               help="Rebuild the chemical shift index used by the multiple shift search.")
+opt.add_option("--fasta", action="store_true", dest="fasta", default=False,
+               help="Rebuild the FASTA sequence libraries used by the FASTA search.")
+opt.add_option("--validation", action="store_true", dest="validation", default=False,
+               help="Validate the macromolecule entries which don't have a cached validation report yet, so that "
+                    "their reports can be served immediately.")
+opt.add_option("--hsqc", action="store_true", dest="hsqc", default=False,
+               help="Simulate the HSQC peak lists of the macromolecule entries which don't have a cached peak list "
+                    "yet.")
 opt.add_option("--sql", action="store_true", dest="sql", default=False,
                help="Run the SQL commands to prepare the correct indexes on the DB.")
 opt.add_option("--sql-host", action="store", dest='sql_host', default=configuration['postgres']['host'],
@@ -108,13 +125,29 @@ opt.add_option("--sql-port", action="store", dest='sql_port', default=configurat
                help="Port to connect to Postgres on.")
 opt.add_option("--all-entries", action="store_true", dest="all", default=False,
                help="Update all the databases, and run all reloaders. Equivalent to: --metabolomics --macromolecules "
-                    "--chemcomps --molprobity-visualization --molprobity-full --uniprot --sql --timedomain")
+                    "--chemcomps --molprobity-visualization --molprobity-full --uniprot --sql --timedomain --xml "
+                    "--shift-index --fasta")
 opt.add_option("--redis-db", action="store", dest="redis_db", default=configuration['redis']['db'],
                help="The Redis DB to use. 0 is master.")
 opt.add_option("--redis-host", action="store", dest="redis_host", default=None,
                help="The Redis host to use, if not using sentinels.")
 opt.add_option("--redis-port", action="store", dest="redis_port", default=None,
                help="The port to try to connect to Redis on.")
+opt.add_option("--store-nmrstar", action="store_true", dest="store_nmrstar",
+               default=configuration['redis'].get('store_nmrstar', False),
+               help="Also store a compressed NMR-STAR rendering of each entry, so that NMR-STAR requests don't have to "
+                    "parse the entry.")
+opt.add_option("--no-store-nmrstar", action="store_false", dest="store_nmrstar",
+               help="Don't store the NMR-STAR renderings, even if redis.store_nmrstar is set in the configuration.")
+opt.add_option("--store-entry-index", action="store_true", dest="store_entry_index",
+               default=configuration['redis'].get('store_entry_index', False),
+               help="Also store each saveframe of each entry separately, so that requests for single loops, "
+                    "saveframes, or tags don't have to load the whole entry.")
+opt.add_option("--codec", action="store", dest="codec", default=configuration['redis'].get('codec', 'zlib'),
+               choices=CODECS, help="The compression to store the entries with: %s." % ", ".join(CODECS))
+opt.add_option("--train-zstd-dictionary", action="store_true", dest="train_zstd_dictionary", default=False,
+               help="Train a new zstd dictionary on the entries in Redis, after any entries are loaded. Entries "
+                    "loaded afterwards with --codec zstd use it.")
 opt.add_option("--flush", action="store_true", dest="flush", default=False,
                help="Flush all keys in the DB prior to reloading. This will interrupt service until the DB is rebuilt! "
                     "(So only use it on the staging DB.)")
@@ -128,6 +161,9 @@ configuration['postgres']['host'] = options.sql_host
 configuration['postgres']['database'] = options.sql_database
 configuration['postgres']['port'] = options.sql_port
 configuration['redis']['db'] = options.redis_db
+configuration['redis']['codec'] = options.codec
+configuration['redis']['store_nmrstar'] = options.store_nmrstar
+configuration['redis']['store_entry_index'] = options.store_entry_index
 if options.redis_host:
     configuration['redis']['sentinels'][0][0] = options.redis_host
 if options.redis_port:
@@ -143,7 +179,8 @@ else:
 # Make sure they specify a DB
 if not (options.metabolomics or options.macromolecules or options.chemcomps or options.molprobity_visualization
         or options.molprobity_full or options.uniprot or options.xml or options.inext or options.sql or
-        options.timedomain or options.all):
+        options.timedomain or options.train_zstd_dictionary or options.shift_index or options.fasta or
+        options.validation or options.hsqc or options.all):
     logging.exception("You must specify at least one of the reloaders.")
     sys.exit(1)
 
@@ -158,6 +195,8 @@ if options.all:
     options.sql = True
     options.timedomain = True
     options.xml = True
+    options.shift_index = True
+    options.fasta = True
     #options.inext = True
 
 if options.timedomain:
@@ -248,6 +287,11 @@ if options.chemcomps or options.macromolecules or options.metabolomics:
 
     logger.info('Updating entries in Redis...')
 
+    # Compress with the newest dictionary
+    if options.codec == 'zstd':
+        with RedisConnection() as r:
+            configuration['redis']['zstd_dictionary_id'] = int(r.get(ZSTD_DICTIONARY_ID_KEY) or 0)
+
     with multiprocessing.Pool() as pool:
         for res in pool.map(one_entry, to_process['combined']):
             add_to_loaded(res)
@@ -274,6 +318,40 @@ if options.chemcomps or options.macromolecules or options.metabolomics:
             r_conn.bgsave()
     logger.info('Finished updating list of entries present in Redis...')
 
+# The dictionary is trained on the entries in Redis, so it goes after they are loaded (or flushed)
+if options.train_zstd_dictionary:
+    logger.info('Training zstd dictionary...')
+    zstd_dictionary()
+    logger.info('Finished training zstd dictionary...')
+
+# Only once the entry lists are final is it known which dictionaries are no longer used
+if options.chemcomps or options.macromolecules or options.metabolomics or options.train_zstd_dictionary:
+    logger.info('Deleting unused zstd dictionaries...')
+    delete_unused_zstd_dictionaries()
+    logger.info('Finished deleting unused zstd dictionaries...')
+
+# The shift index is built from the SQL tables, so it goes after the SQL initialization
+if options.shift_index:
+    logger.info('Building chemical shift index...')
+    shift_index(configuration['shift_index_directory'])
+    logger.info('Finished building chemical shift index...')
+
+if options.fasta:
+    logger.info('Building FASTA sequence libraries...')
+    fasta_libraries(configuration['fasta_directory'])
+    logger.info('Finished building FASTA sequence libraries...')
+
+# Validation uses the entries in Redis, so it goes after they are loaded
+if options.validation:
+    logger.info('Filling the validation report cache...')
+    validation_reports()
+    logger.info('Finished filling the validation report cache...')
+
+if options.hsqc:
+    logger.info('Filling the simulated HSQC peak list cache...')
+    hsqc_peak_lists()
+    logger.info('Finished filling the simulated HSQC peak list cache...')
+
 # The quicker molprobity code to generate the data for the molprobity visualizer
 if options.molprobity_visualization:
     logger.info('Doing MolProbity visualization reload...')
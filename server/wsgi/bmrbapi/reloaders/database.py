@@ -1,3 +1,4 @@
+import hashlib
 import logging
 import zlib
 
@@ -5,6 +6,33 @@ import pynmrstar
 
 from bmrbapi import RedisConnection
 from bmrbapi.utils import querymod
+from bmrbapi.utils.compression import compress_entry
+from bmrbapi.utils.configuration import configuration
+
+
+def store_entry(entry_name: str, ent: pynmrstar.Entry, r_conn) -> None:
+    """ Store an entry in REDIS as compressed JSON, and if enabled, its
+    compressed NMR-STAR rendering and saveframe index next to it. """
+
+    entry_json = ent.get_json().encode()
+    compressed = compress_entry(entry_json, configuration['redis'].get('codec', 'zlib'),
+                                configuration['redis'].get('zstd_dictionary_id', 0),
+                                configuration['redis'].get('zstd_level', 19))
+    pipe = r_conn.pipeline()
+    pipe.set(querymod.locate_entry(entry_name, r_conn), compressed)
+    pipe.hset(querymod.get_entry_info_key(entry_name),
+              mapping={"json_length": len(entry_json), "hash": hashlib.sha1(compressed).hexdigest()})
+    nmrstar_key = querymod.get_nmrstar_key(entry_name)
+    if configuration['redis'].get('store_nmrstar', False):
+        pipe.set(nmrstar_key, zlib.compress(str(ent).encode()))
+    else:
+        # Don't leave the rendering of an older version of the entry behind
+        pipe.delete(nmrstar_key)
+    index_key = querymod.get_entry_index_key(entry_name)
+    pipe.delete(index_key)
+    if configuration['redis'].get('store_entry_index', False):
+        pipe.hset(index_key, mapping=querymod.make_entry_index(ent))
+    pipe.execute()
 
 
 def one_entry(work):
@@ -22,8 +50,7 @@ def one_entry(work):
                 logging.exception("On %s: error: %s", entry_name, str(e))
 
             if ent is not None:
-                key = querymod.locate_entry(entry_name, r_conn)
-                r_conn.set(key, zlib.compress(ent.get_json().encode()))
+                store_entry(entry_name, ent, r_conn)
                 logging.info("On %s: loaded", entry_name)
                 return entry_name
         else:
@@ -39,6 +66,5 @@ def one_entry(work):
                 logging.error("On %s: error: %s", entry_name, str(e))
 
             if ent is not None:
-                key = querymod.locate_entry(entry_name, r_conn)
-                r_conn.set(key, zlib.compress(ent.get_json().encode()))
+                store_entry(entry_name, ent, r_conn)
                 return entry_name
@@ -0,0 +1,91 @@
+import logging
+import os
+import tempfile
+from typing import List
+
+import numpy as np
+import simplejson as json
+
+from bmrbapi.reloaders.shift_index import remove_old_versions
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
+from bmrbapi.utils.fasta import FASTA_RESULT_KEY, FASTA_TYPES, fasta_sequences, wrap_sequence
+from bmrbapi.utils.kmer_index import ALPHABET_SIZE, KMER_LENGTH, kmer_codes
+
+
+def build_fasta_library(a_type: str, path: str, shards: int) -> int:
+    """ Writes the FASTA library and lookup table of the polymer type into the given directory. The library is split
+    into shards with about the same number of residues. Returns the number of shards written. """
+
+    sequences = fasta_sequences(a_type)
+    shards = max(1, min(shards, len(sequences)))
+    total_residues = sum(len(sequence[2]) for sequence in sequences)
+
+    shard, residues = 0, 0
+    library_file = open(os.path.join(path, "%s.%d.fasta" % (a_type, shard)), "w")
+    try:
+        for position, sequence in enumerate(sequences, 1):
+            if residues >= total_residues * (shard + 1) / shards and shard + 1 < shards:
+                library_file.close()
+                shard += 1
+                library_file = open(os.path.join(path, "%s.%d.fasta" % (a_type, shard)), "w")
+            library_file.write(">%s\n%s\n" % (position, wrap_sequence(sequence[2])))
+            residues += len(sequence[2])
+    finally:
+        library_file.close()
+
+    with open(os.path.join(path, "%s.json" % a_type), "w") as lookup_file:
+        json.dump([[sequence[0], sequence[1], sequence[3]] for sequence in sequences], lookup_file)
+    build_kmer_index([sequence[2] for sequence in sequences], path, a_type)
+
+    logging.info("Built the %s FASTA library with %d sequences in %d shards.", a_type, len(sequences), shard + 1)
+    return shard + 1
+
+
+def build_kmer_index(sequences: List[str], path: str, a_type: str) -> None:
+    """ Writes the k-mer index of the sequences into the given directory. """
+
+    residues = [sequence.encode() for sequence in sequences]
+    residue_offsets = np.zeros(len(residues) + 1, dtype=np.int64)
+    residue_offsets[1:] = np.cumsum([len(x) for x in residues])
+
+    codes = [kmer_codes(x) for x in residues]
+    all_codes = np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64)
+    positions = np.repeat(np.arange(len(codes), dtype=np.int32), [len(x) for x in codes])
+    order = np.argsort(all_codes, kind='stable')
+    kmer_offsets = np.zeros(ALPHABET_SIZE ** KMER_LENGTH + 1, dtype=np.int64)
+    kmer_offsets[1:] = np.cumsum(np.bincount(all_codes, minlength=ALPHABET_SIZE ** KMER_LENGTH))
+
+    np.save(os.path.join(path, "%s.kmer_offsets.npy" % a_type), kmer_offsets)
+    np.save(os.path.join(path, "%s.kmer_sequences.npy" % a_type), positions[order])
+    np.save(os.path.join(path, "%s.residue_offsets.npy" % a_type), residue_offsets)
+    np.save(os.path.join(path, "%s.residues.npy" % a_type), np.frombuffer(b"".join(residues), dtype=np.uint8))
+
+
+def fasta_libraries(directory: str) -> None:
+    """ Builds the FASTA libraries of all the polymer types. They are built in a new directory, and then a symbolic
+    link is switched to it, so the API never sees partially written libraries. """
+
+    os.makedirs(directory, exist_ok=True)
+
+    build_path = tempfile.mkdtemp(prefix="library.", dir=directory)
+    shards = {a_type: build_fasta_library(a_type, build_path, configuration.get('fasta', {}).get('shards', 1))
+              for a_type in FASTA_TYPES}
+    with open(os.path.join(build_path, "library.json"), "w") as library_file:
+        json.dump({'shards': shards}, library_file)
+    os.chmod(build_path, 0o755)
+
+    link_path = os.path.join(directory, "library")
+    old_path = os.path.realpath(link_path) if os.path.islink(link_path) else None
+    os.symlink(os.path.basename(build_path), "%s.link" % build_path)
+    os.replace("%s.link" % build_path, link_path)
+
+    # A search that is already running against the old libraries has its files open, so they are only removed by
+    #  the next rebuild
+    remove_old_versions(directory, "library.", [build_path, old_path])
+
+    # Drop the cached results of searches of the old libraries
+    with RedisConnection() as r:
+        for key in r.scan_iter(match=FASTA_RESULT_KEY % ("*", "*")):
+            if not key.decode().startswith(FASTA_RESULT_KEY % (os.path.basename(build_path), "")):
+                r.delete(key)
@@ -0,0 +1,41 @@
+import logging
+import multiprocessing
+
+from bmrbapi.utils import querymod
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
+from bmrbapi.utils.hsqc import HSQC_PEAKS_KEY, get_peak_list
+
+
+def one_hsqc_peak_list(entry_id: str) -> bool:
+    """ Makes the simulated HSQC peak list of the entry unless it is already cached. Returns whether it was made. """
+
+    entry_hash = querymod.get_entry_hash(entry_id)
+    if not entry_hash:
+        logging.info("On %s: no entry hash, not simulating the HSQC.", entry_id)
+        return False
+
+    with RedisConnection() as r_conn:
+        if r_conn.exists(HSQC_PEAKS_KEY % (entry_id, entry_hash)):
+            return False
+
+    try:
+        get_peak_list(entry_id, refresh=True)
+    except Exception as e:
+        logging.error("On %s: HSQC simulation error: %s", entry_id, str(e))
+        return False
+    logging.info("On %s: simulated the HSQC.", entry_id)
+    return True
+
+
+def hsqc_peak_lists() -> None:
+    """ Fills the simulated HSQC peak list cache for all the macromolecule entries which don't have a peak list of
+    the current version of the entry yet. """
+
+    with RedisConnection() as r_conn:
+        entry_ids = [x.decode() for x in r_conn.lrange("macromolecules:entry_list", 0, -1)]
+
+    processes = configuration.get('hsqc', {}).get('processes') or None
+    with multiprocessing.Pool(processes) as pool:
+        simulated = sum(pool.imap_unordered(one_hsqc_peak_list, entry_ids, chunksize=50))
+    logging.info("Simulated the HSQC of %d of %d macromolecule entries.", simulated, len(entry_ids))
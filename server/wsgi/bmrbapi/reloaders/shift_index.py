@@ -0,0 +1,73 @@
+import logging
+import os
+import shutil
+import tempfile
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.shift_index import ATOM_TYPES
+
+
+def build_shift_index(database: str, path: str) -> None:
+    """ Writes the shift index of the database into the given directory. """
+
+    with tempfile.TemporaryFile(mode='w+') as shifts_csv:
+        with PostgresConnection(schema=database) as cur:
+            cur.copy_expert('''
+COPY (SELECT DISTINCT "Entry_ID", "Assigned_chem_shift_list_ID"::text, "Val"::text, "Atom_type"
+      FROM "Atom_chem_shift"
+      WHERE "Atom_type" IN ('C', 'N', 'H') AND "Val" IS NOT NULL) TO STDOUT WITH CSV;''', shifts_csv)
+        shifts_csv.seek(0)
+        shifts = pd.read_csv(shifts_csv, header=None, names=['entry_id', 'list_id', 'val', 'atom_type'], dtype=str,
+                             keep_default_na=False)
+
+    shifts['float_val'] = pd.to_numeric(shifts['val'], errors='coerce')
+    shifts = shifts[shifts['float_val'].notna()]
+
+    list_codes, lists = pd.factorize(pd.MultiIndex.from_arrays([shifts['entry_id'], shifts['list_id']]))
+    np.save(os.path.join(path, "list_entries.npy"), np.array(lists.get_level_values(0), dtype=str))
+    np.save(os.path.join(path, "list_ids.npy"), np.array(lists.get_level_values(1), dtype=str))
+
+    for atom_type in ATOM_TYPES:
+        selected = (shifts['atom_type'] == atom_type).to_numpy()
+        values = shifts['float_val'].to_numpy(dtype=np.float64)[selected]
+        order = np.argsort(values, kind='stable')
+        np.save(os.path.join(path, "%s_values.npy" % atom_type), values[order])
+        np.save(os.path.join(path, "%s_lists.npy" % atom_type), list_codes[selected][order].astype(np.int32))
+        np.save(os.path.join(path, "%s_strings.npy" % atom_type),
+                shifts['val'].to_numpy()[selected][order].astype(bytes))
+
+    logging.info("Built the %s shift index with %d shifts in %d lists.", database, len(shifts), len(lists))
+
+
+def remove_old_versions(directory: str, prefix: str, keep: List[str]) -> None:
+    """ Removes the versions built in the directory (named with the prefix), other than those to keep. """
+
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith(prefix) and os.path.isdir(path) and not os.path.islink(path) and path not in keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def shift_index(directory: str) -> None:
+    """ Builds the shift indexes of the metabolomics and macromolecule databases. Each index is built in a new
+    directory, and then a symbolic link is switched to it, so the API never sees a partially written index. """
+
+    os.makedirs(directory, exist_ok=True)
+
+    for database in ['metabolomics', 'macromolecules']:
+        build_path = tempfile.mkdtemp(prefix="%s." % database, dir=directory)
+        build_shift_index(database, build_path)
+        os.chmod(build_path, 0o755)
+
+        link_path = os.path.join(directory, database)
+        old_path = os.path.realpath(link_path) if os.path.islink(link_path) else None
+        os.symlink(os.path.basename(build_path), "%s.link" % build_path)
+        os.replace("%s.link" % build_path, link_path)
+
+        # The workers that still have the old index open keep it until they notice the new one, so it is only
+        #  removed by the next rebuild
+        remove_old_versions(directory, "%s." % database, [build_path, old_path])
@@ -196,6 +196,34 @@ CREATE INDEX cluster_index_tmp ON web.chem_shifts_tmp (database, "Atom_chem_shif
                                                        "Atom_chem_shift.Comp_ID", "Atom_chem_shift.Val",
                                                        "Sample_conditions.pH",
                                                        "Sample_conditions.Temperature_K");
+-- The order /search/chemical_shifts pages through results in
+CREATE INDEX ON web.chem_shifts_tmp (database,
+                                     ("Atom_chem_shift.Atom_type" IS NULL),
+                                     COALESCE("Atom_chem_shift.Atom_type", ''::text),
+                                     ("Atom_chem_shift.Atom_ID" IS NULL),
+                                     COALESCE("Atom_chem_shift.Atom_ID", ''::text),
+                                     ("Atom_chem_shift.Comp_ID" IS NULL),
+                                     COALESCE("Atom_chem_shift.Comp_ID", ''::text),
+                                     ("Atom_chem_shift.Val" IS NULL),
+                                     COALESCE("Atom_chem_shift.Val", 'NaN'::numeric),
+                                     ("Sample_conditions.pH" IS NULL),
+                                     COALESCE("Sample_conditions.pH", 'NaN'::numeric),
+                                     ("Sample_conditions.Temperature_K" IS NULL),
+                                     COALESCE("Sample_conditions.Temperature_K", 'NaN'::numeric),
+                                     ("Atom_chem_shift.Entry_ID" IS NULL),
+                                     COALESCE("Atom_chem_shift.Entry_ID", ''::text),
+                                     ("Atom_chem_shift.Assigned_chem_shift_list_ID" IS NULL),
+                                     COALESCE("Atom_chem_shift.Assigned_chem_shift_list_ID", -1),
+                                     ("Atom_chem_shift.Entity_assembly_ID" IS NULL),
+                                     COALESCE("Atom_chem_shift.Entity_assembly_ID", -1),
+                                     ("Atom_chem_shift.Entity_ID" IS NULL),
+                                     COALESCE("Atom_chem_shift.Entity_ID", -1),
+                                     ("Atom_chem_shift.Comp_index_ID" IS NULL),
+                                     COALESCE("Atom_chem_shift.Comp_index_ID", -1),
+                                     ("Atom_chem_shift.Val_err" IS NULL),
+                                     COALESCE("Atom_chem_shift.Val_err", 'NaN'::numeric),
+                                     ("Atom_chem_shift.Ambiguity_code" IS NULL),
+                                     COALESCE("Atom_chem_shift.Ambiguity_code", -1));
 --CLUSTER web.chem_shifts_tmp USING cluster_index_tmp;
 ANALYZE web.chem_shifts_tmp;
 
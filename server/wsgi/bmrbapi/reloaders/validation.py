@@ -0,0 +1,41 @@
+import logging
+import multiprocessing
+
+from bmrbapi.utils import querymod
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
+from bmrbapi.utils.validation import get_validation_key, get_validation_report
+
+
+def one_validation_report(entry_id: str) -> bool:
+    """ Validates the entry unless its report is already cached. Returns whether it was validated. """
+
+    entry_hash = querymod.get_entry_hash(entry_id)
+    if not entry_hash:
+        logging.info("On %s: no entry hash, not validating.", entry_id)
+        return False
+
+    with RedisConnection() as r_conn:
+        if r_conn.exists(get_validation_key(entry_id, entry_hash)):
+            return False
+
+    try:
+        get_validation_report(entry_id, refresh=True)
+    except Exception as e:
+        logging.error("On %s: validation error: %s", entry_id, str(e))
+        return False
+    logging.info("On %s: validated.", entry_id)
+    return True
+
+
+def validation_reports() -> None:
+    """ Fills the validation report cache for all the macromolecule entries which don't have a report of the
+    current version of the entry yet. """
+
+    with RedisConnection() as r_conn:
+        entry_ids = [x.decode() for x in r_conn.lrange("macromolecules:entry_list", 0, -1)]
+
+    processes = configuration.get('validation', {}).get('processes') or None
+    with multiprocessing.Pool(processes) as pool:
+        validated = sum(pool.imap_unordered(one_validation_report, entry_ids, chunksize=10))
+    logging.info("Validated %d of %d macromolecule entries.", validated, len(entry_ids))
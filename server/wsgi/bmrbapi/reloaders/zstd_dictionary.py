@@ -0,0 +1,64 @@
+import logging
+import random
+from typing import List
+
+from bmrbapi.utils.compression import CODEC_HEADER_SIZE, ZSTD_DICTIONARY_KEY, ZSTD_DICTIONARY_ID_KEY, \
+    decompress_entry, get_entry_dictionary_id
+from bmrbapi.utils.connections import RedisConnection
+
+
+def zstd_dictionary(sample_size: int = 2000, dictionary_size: int = 112640) -> int:
+    """ Trains a zstd dictionary on a random sample of the entries in Redis, stores it under its ID, and makes it the
+    dictionary new entries are compressed with. Returns the ID of the new dictionary. Old dictionaries are kept,
+    since entries compressed with them may still be stored, until delete_unused_zstd_dictionaries() finds them
+    unused. """
+
+    import zstandard
+
+    with RedisConnection() as r_conn:
+        keys = []
+        for database in ['macromolecules', 'metabolomics']:
+            keys.extend("%s:entry:%s" % (database, entry_id.decode())
+                        for entry_id in r_conn.lrange('%s:entry_list' % database, 0, -1))
+        keys = random.sample(keys, min(sample_size, len(keys)))
+        if not keys:
+            raise ValueError("Refusing to train a dictionary, there are no entries in Redis.")
+
+        samples = [decompress_entry(entry) for entry in r_conn.mget(keys) if entry]
+        dictionary = zstandard.train_dictionary(dictionary_size, samples)
+
+        dictionary_id = dictionary.dict_id()
+        r_conn.set(ZSTD_DICTIONARY_KEY % dictionary_id, dictionary.as_bytes())
+        r_conn.set(ZSTD_DICTIONARY_ID_KEY, dictionary_id)
+        logging.info("Trained zstd dictionary %d on %d entries.", dictionary_id, len(samples))
+
+    return dictionary_id
+
+
+def delete_unused_zstd_dictionaries(chunk_size: int = 1000) -> List[int]:
+    """ Deletes the zstd dictionaries which no entry in the entry lists was compressed with, other than the one new
+    entries are compressed with. This should run after a reload, once make_entry_list() removed the entries which
+    are gone. Returns the IDs of the deleted dictionaries. """
+
+    with RedisConnection() as r_conn:
+        used = {int(r_conn.get(ZSTD_DICTIONARY_ID_KEY) or 0)}
+        for database in ['macromolecules', 'metabolomics', 'chemcomps']:
+            keys = ["%s:entry:%s" % (database, entry_id.decode())
+                    for entry_id in r_conn.lrange('%s:entry_list' % database, 0, -1)]
+            # Only the codec header of each entry is needed
+            for chunk_start in range(0, len(keys), chunk_size):
+                pipe = r_conn.pipeline(transaction=False)
+                for key in keys[chunk_start:chunk_start + chunk_size]:
+                    pipe.getrange(key, 0, CODEC_HEADER_SIZE - 1)
+                used.update(get_entry_dictionary_id(header) for header in pipe.execute())
+
+        unused = []
+        for key in r_conn.scan_iter(ZSTD_DICTIONARY_KEY.replace("%d", "*")):
+            dictionary_id = int(key.decode().rsplit(":", 1)[1])
+            if dictionary_id not in used:
+                unused.append(dictionary_id)
+        if unused:
+            r_conn.delete(*[ZSTD_DICTIONARY_KEY % dictionary_id for dictionary_id in unused])
+            logging.info("Deleted the unused zstd dictionaries %s.", ", ".join(str(x) for x in unused))
+
+    return unused
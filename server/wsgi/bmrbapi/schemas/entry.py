@@ -11,6 +11,7 @@ __all__ = ['GetEntry', 'GetSoftwareByEntry', 'GetExperimentData', 'GetCitation',
 class GetEntry(Schema):
     class Format(enum.Enum):
         json = "json"
+        nmrstar = "nmrstar"
         rawnmrstar = "rawnmrstar"
         zlib = "zlib"
 
@@ -59,7 +60,7 @@ class SimulateHsqc(Schema):
 
 
 class ValidateEntry(Schema):
-    pass
+    async_ = fields.Bool(data_key='async')
 
 
 class ListEntries(DatabaseSchema):
@@ -0,0 +1,7 @@
+from marshmallow import Schema
+
+__all__ = ['GetJobStatus']
+
+
+class GetJobStatus(Schema):
+    pass
@@ -1,6 +1,6 @@
 import enum
 
-from marshmallow import fields, Schema
+from marshmallow import fields, Schema, validate
 
 from bmrbapi.schemas.default import DatabaseSchema, CustomErrorEnum
 
@@ -22,6 +22,13 @@ class MultipleShiftSearch(DatabaseSchema):
 
 
 class GetChemicalShifts(DatabaseSchema):
+    class Format(enum.Enum):
+        json = "json"
+        ndjson = "ndjson"
+        csv = "csv"
+        arrow = "arrow"
+        parquet = "parquet"
+
     shift = fields.Float(multiple=True)
     threshold = fields.Float()
     atom_type = fields.String()
@@ -32,10 +39,19 @@ class GetChemicalShifts(DatabaseSchema):
     temperature = fields.Float()
     temperature_threshold = fields.Float()
     dictionary_result = fields.Bool()
+    format = CustomErrorEnum(Format)
+    limit = fields.Integer(validate=validate.Range(min=1))
+    after = fields.String()
 
 
 class GetAllValuesForTag(DatabaseSchema):
-    pass
+    class Format(enum.Enum):
+        json = "json"
+        csv = "csv"
+        arrow = "arrow"
+        parquet = "parquet"
+
+    format = CustomErrorEnum(Format)
 
 
 class GetIdFromSearch(DatabaseSchema):
@@ -62,6 +78,7 @@ class FastaSearch(Schema):
 
 class Instant(DatabaseSchema):
     term = fields.String(required=True)
+    limit = fields.Integer(validate=validate.Range(min=1))
 
 
 class RerouteInstantInternal(Instant):
@@ -0,0 +1,71 @@
+import tempfile
+from contextlib import ExitStack
+from typing import Dict
+
+from flask import Response, send_file
+
+from bmrbapi.exceptions import ServerException
+
+# The formats query results can be exported in, and their mimetypes
+COLUMNAR_FORMATS = {'csv': 'text/csv',
+                    'arrow': 'application/vnd.apache.arrow.stream',
+                    'parquet': 'application/vnd.apache.parquet'}
+
+# Rows are converted to Arrow in blocks of this many bytes of CSV
+CSV_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _import_pyarrow():
+    """ Imports pyarrow, which is only needed for the Arrow and Parquet formats. """
+
+    try:
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ServerException("The pyarrow module must be installed to use the arrow and parquet formats.")
+    return pyarrow
+
+
+def export_query(cur, sql: str, args: list, format_: str, column_types: Dict[str, str], name: str) -> Response:
+    """ Runs the query and returns the results in one of the COLUMNAR_FORMATS. Postgres writes the rows as CSV
+    using COPY, and for Arrow and Parquet the CSV is converted in blocks by pyarrow, so no Python objects are
+    created for the individual rows. column_types maps the columns to the Arrow type to use for them, such as
+    'float64', 'int64', or 'string'.
+
+    The results are spooled to temporary files rather than held in memory. """
+
+    with ExitStack() as stack:
+        csv_file = stack.enter_context(tempfile.TemporaryFile())
+        cur.copy_expert('COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER)' % cur.mogrify(sql, args or None).decode(),
+                        csv_file)
+        csv_file.seek(0)
+
+        if format_ == 'csv':
+            # send_file closes the file once it has been sent
+            stack.pop_all()
+            return send_file(csv_file, mimetype=COLUMNAR_FORMATS[format_], download_name='%s.csv' % name)
+
+        pyarrow = _import_pyarrow()
+        column_types = {column: pyarrow.type_for_alias(type_) for column, type_ in column_types.items()}
+        reader = pyarrow.csv.open_csv(csv_file,
+                                      read_options=pyarrow.csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+                                      convert_options=pyarrow.csv.ConvertOptions(column_types=column_types,
+                                                                                 strings_can_be_null=True,
+                                                                                 quoted_strings_can_be_null=False))
+
+        output_file = tempfile.TemporaryFile()
+        if format_ == 'arrow':
+            writer = pyarrow.ipc.new_stream(output_file, reader.schema)
+        else:
+            writer = pyarrow.parquet.ParquetWriter(output_file, reader.schema)
+        with writer:
+            for batch in reader:
+                if format_ == 'arrow':
+                    writer.write_batch(batch)
+                else:
+                    writer.write_table(pyarrow.Table.from_batches([batch]))
+
+    output_file.seek(0)
+    return send_file(output_file, mimetype=COLUMNAR_FORMATS[format_], download_name='%s.%s' % (name, format_))
@@ -0,0 +1,149 @@
+""" Compression of the entries stored in Redis.
+
+Entries are compressed with zlib by default. The zlib streams are made so that they can be sent to clients that
+accept the deflate content encoding without being decompressed. Entries can instead be compressed with zstd, using
+a dictionary trained on a sample of entries. Those values start with a marker naming the codec and the ID of the
+dictionary; zlib data never starts with a null byte, so values without the marker are zlib. """
+
+import struct
+import zlib
+from typing import TYPE_CHECKING, Dict, List, Optional
+
+from bmrbapi.exceptions import ServerException
+from bmrbapi.utils.connections import RedisConnection
+
+if TYPE_CHECKING:
+    import zstandard
+
+CODECS = ["zlib", "zstd"]
+ZSTD_DICTIONARY_KEY = "codecs:zstd:dictionary:%d"
+ZSTD_DICTIONARY_ID_KEY = "codecs:zstd:dictionary_id"
+
+# The marker, the codec, and the ID of the dictionary (0 for none)
+_CODEC_HEADER = struct.Struct(">cBI")
+CODEC_HEADER_SIZE = _CODEC_HEADER.size
+_CODEC_MARKER = b"\x00"
+_ZSTD = 1
+_zstd_dictionaries: Dict[int, 'zstandard.ZstdCompressionDict'] = {}
+
+# Compressed data ends with an empty stored block from Z_SYNC_FLUSH, then an empty final block and the checksum
+_SPLICEABLE_END = b"\x00\x00\xff\xff\x03\x00"
+_ADLER_BASE = 65521
+
+
+def compress_spliceable(data: bytes) -> bytes:
+    """ Compresses data to a zlib stream whose deflate blocks end on a byte boundary before the final block, so that
+    other data can be spliced around them by wrap_compressed(). The result is still regular zlib data. """
+
+    compressor = zlib.compressobj()
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH) + compressor.flush(zlib.Z_FINISH)
+
+
+def _stored_block(data: bytes, final: bool) -> bytes:
+    """ Returns a deflate stored (uncompressed) block holding the data. """
+
+    return struct.pack("<BHH", 1 if final else 0, len(data), len(data) ^ 0xffff) + data
+
+
+def _adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    """ Returns the Adler-32 checksum of two pieces of data from the checksums of each, and the length of the
+    second. (This is adler32_combine() from zlib, which Python doesn't expose.) """
+
+    remainder = length2 % _ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (remainder * sum1) % _ADLER_BASE
+    sum1 = (sum1 + (adler2 & 0xffff) + _ADLER_BASE - 1) % _ADLER_BASE
+    sum2 = (sum2 + (adler1 >> 16) + (adler2 >> 16) + _ADLER_BASE - remainder) % _ADLER_BASE
+    return (sum2 << 16) | sum1
+
+
+def wrap_compressed(prefix: bytes, compressed: bytes, length: int, suffix: bytes) -> Optional[List[bytes]]:
+    """ Returns the zlib stream of prefix + the data compressed by compress_spliceable() + suffix, as a list of
+    pieces, without decompressing the data. The length of the uncompressed data is needed to compute the checksum.
+    Returns None if the data wasn't compressed by compress_spliceable(). """
+
+    if compressed[:1] == _CODEC_MARKER or compressed[-10:-4] != _SPLICEABLE_END:
+        return None
+    if len(prefix) > 0xffff or len(suffix) > 0xffff:
+        return None
+
+    checksum = _adler32_combine(zlib.adler32(prefix), struct.unpack(">I", compressed[-4:])[0], length)
+    checksum = _adler32_combine(checksum, zlib.adler32(suffix), len(suffix))
+
+    return [compressed[:2] + _stored_block(prefix, False),
+            compressed[2:-6],
+            _stored_block(suffix, True) + struct.pack(">I", checksum)]
+
+
+def _import_zstandard():
+    """ Imports zstandard, which is only needed if entries are stored with zstd. """
+
+    try:
+        import zstandard
+    except ImportError:
+        raise ServerException("The zstandard module must be installed to use zstd compressed entries.")
+    return zstandard
+
+
+def get_zstd_dictionary(dictionary_id: int) -> 'zstandard.ZstdCompressionDict':
+    """ Returns the zstd dictionary with the given ID. The ID is derived from the content of the dictionary, so a
+    dictionary trained after Redis is flushed can't be mistaken for an older one, and they are only loaded once per
+    process. """
+
+    if dictionary_id not in _zstd_dictionaries:
+        zstandard = _import_zstandard()
+        with RedisConnection() as r_conn:
+            dictionary = r_conn.get(ZSTD_DICTIONARY_KEY % dictionary_id)
+        if dictionary is None:
+            raise ServerException("The zstd dictionary %d is missing from Redis." % dictionary_id)
+        dictionary = zstandard.ZstdCompressionDict(dictionary)
+        if dictionary.dict_id() != dictionary_id:
+            raise ServerException("The zstd dictionary stored as %d has ID %d." % (dictionary_id, dictionary.dict_id()))
+        _zstd_dictionaries[dictionary_id] = dictionary
+    return _zstd_dictionaries[dictionary_id]
+
+
+def compress_entry(data: bytes, codec: str = "zlib", dictionary_id: int = 0, level: int = 19) -> bytes:
+    """ Compresses an entry for storage in Redis using the given codec. For zstd, a dictionary ID of 0 means no
+    dictionary is used, and the level is the zstd compression level. """
+
+    if codec == "zlib":
+        return compress_spliceable(data)
+    elif codec == "zstd":
+        zstandard = _import_zstandard()
+        dictionary = get_zstd_dictionary(dictionary_id) if dictionary_id else None
+        compressor = zstandard.ZstdCompressor(level=level, dict_data=dictionary)
+        return _CODEC_HEADER.pack(_CODEC_MARKER, _ZSTD, dictionary_id) + compressor.compress(data)
+    raise ValueError("Unknown codec: %s" % codec)
+
+
+def get_entry_dictionary_id(data: bytes) -> int:
+    """ Returns the ID of the zstd dictionary an entry stored in Redis was compressed with, or 0 if it wasn't
+    compressed with one. Only the first CODEC_HEADER_SIZE bytes of the entry are needed. """
+
+    if data[:1] != _CODEC_MARKER or len(data) < _CODEC_HEADER.size:
+        return 0
+    return _CODEC_HEADER.unpack_from(data)[2]
+
+
+def decompress_entry(data: bytes) -> bytes:
+    """ Decompresses an entry stored in Redis with any codec. """
+
+    if data[:1] != _CODEC_MARKER:
+        return zlib.decompress(data)
+
+    _, codec, dictionary_id = _CODEC_HEADER.unpack_from(data)
+    if codec == _ZSTD:
+        zstandard = _import_zstandard()
+        dictionary = get_zstd_dictionary(dictionary_id) if dictionary_id else None
+        # Decompressors can't be shared between threads
+        return zstandard.ZstdDecompressor(dict_data=dictionary).decompress(data[_CODEC_HEADER.size:])
+    raise ServerException("Entry compressed with unknown codec: %d" % codec)
+
+
+def entry_to_zlib(data: bytes) -> bytes:
+    """ Returns an entry stored in Redis as zlib compressed data, recompressing it if another codec was used. """
+
+    if data[:1] != _CODEC_MARKER:
+        return data
+    return zlib.compress(decompress_entry(data))
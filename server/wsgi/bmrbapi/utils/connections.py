@@ -1,6 +1,10 @@
-from typing import Union
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Union
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
 import redis
 from redis.sentinel import Sentinel
@@ -9,20 +13,132 @@ from bmrbapi.exceptions import RequestException, ServerException
 from bmrbapi.utils.configuration import configuration
 
 
+class _PostgresPool:
+    """ A per-process pool of Postgres connections which all use the same credentials. Connections are health
+    checked when they are checked out (if they have been idle for a while) and are reset before they are
+    returned to the pool, so that no transaction or search_path leaks from one request to the next. """
+
+    def __init__(self, connection_parameters: dict):
+        settings = configuration['postgres'].get('pool', {})
+
+        self._connection_parameters = dict(connection_parameters,
+                                           connect_timeout=settings.get('connect_timeout', 10))
+        self._checkout_timeout: float = settings.get('checkout_timeout', 30)
+        self._health_check_interval: float = settings.get('health_check_interval', 30)
+        self._slots = threading.BoundedSemaphore(settings.get('max_connections', 5))
+        self._lock = threading.Lock()
+        self._idle: List[Tuple[psycopg2.extensions.connection, float]] = []
+
+    def get_connection(self) -> psycopg2.extensions.connection:
+        """ Returns an idle connection if one is available and healthy, otherwise opens a new connection. """
+
+        if not self._slots.acquire(timeout=self._checkout_timeout):
+            raise ServerException('Timed out waiting for a free database connection.')
+
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    connection, returned_at = self._idle.pop()
+                if self._is_healthy(connection, returned_at):
+                    return connection
+                self._close(connection)
+            return psycopg2.connect(**self._connection_parameters)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def return_connection(self, connection: psycopg2.extensions.connection, discard: bool = False) -> None:
+        """ Puts a connection back in the pool after resetting it, or closes it if it is no longer usable. """
+
+        try:
+            if discard or connection.closed:
+                self._close(connection)
+                return
+
+            try:
+                # End any transaction the caller left open and undo any 'SET search_path' they committed
+                connection.rollback()
+                connection.autocommit = True
+                with connection.cursor() as cursor:
+                    cursor.execute('RESET search_path;')
+                connection.autocommit = False
+            except psycopg2.Error:
+                self._close(connection)
+                return
+
+            with self._lock:
+                self._idle.append((connection, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def _is_healthy(self, connection: psycopg2.extensions.connection, returned_at: float) -> bool:
+        """ Make sure the connection is still open. Only actually ask the server if the connection has been idle
+        long enough that the server (or a firewall) may have dropped it. """
+
+        if connection.closed:
+            return False
+        if time.monotonic() - returned_at < self._health_check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1;')
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _close(connection: psycopg2.extensions.connection) -> None:
+        try:
+            connection.close()
+        except psycopg2.Error:
+            pass
+
+
+_postgres_pools: Dict[str, _PostgresPool] = {}
+_postgres_pools_lock = threading.Lock()
+_postgres_pools_pid = os.getpid()
+# Connections inherited from a parent process. They are deliberately never closed or garbage collected, since
+#  that would send a termination message on the socket the parent is still using.
+_inherited_postgres_pools: List[_PostgresPool] = []
+
+
+def _get_postgres_pool(name: str, connection_parameters: dict) -> _PostgresPool:
+    """ Returns the pool for the given account, creating it if needed. Pools are never shared across a fork
+    (uwsgi pre-forks its workers, and the reloaders use multiprocessing) - the child gets fresh pools. """
+
+    global _postgres_pools_pid
+
+    with _postgres_pools_lock:
+        if _postgres_pools_pid != os.getpid():
+            _inherited_postgres_pools.extend(_postgres_pools.values())
+            _postgres_pools.clear()
+            _postgres_pools_pid = os.getpid()
+
+        if name not in _postgres_pools:
+            _postgres_pools[name] = _PostgresPool(connection_parameters)
+        return _postgres_pools[name]
+
+
 class PostgresConnection:
     """ Makes it more convenient to query postgres. It implements a context manager to ensure that the connection
-    is closed.
+    is returned to the (per-process) connection pool.
 
     Specify write_access=True to use the reload user account with write access. Do not use this whenever user input
     is involved!
     Specify ets=True to connect to the ETS database.
-    Specify a schema to set it as the default search path."""
+    Specify a schema to set it as the default search path.
+    Specify server_side=True to get a server side (named) cursor, which only transfers the rows as they are fetched.
+    It can only execute one query."""
 
     def __init__(self, write_access: bool = False, ets: bool = False, schema: str = None,
-                 real_dict_cursor: bool = False):
+                 real_dict_cursor: bool = False, server_side: bool = False):
 
         self._ets = ets
         self._reload = write_access
+        self._server_side = server_side
         self._cursor_type = psycopg2.extras.DictCursor
         if real_dict_cursor:
             self._cursor_type = psycopg2.extras.RealDictCursor
@@ -38,25 +154,36 @@ class PostgresConnection:
     def __enter__(self) -> Union[psycopg2.extras.DictCursor, psycopg2.extras.RealDictCursor]:
 
         if self._ets:
-            self._conn = psycopg2.connect(host=configuration['ets']['host'],
-                                          user=configuration['ets']['user'],
-                                          database=configuration['ets']['database'],
-                                          port=configuration['ets']['port'],
-                                          cursor_factory=self._cursor_type)
+            self._pool = _get_postgres_pool('ets', {'host': configuration['ets']['host'],
+                                                    'user': configuration['ets']['user'],
+                                                    'database': configuration['ets']['database'],
+                                                    'port': configuration['ets']['port']})
         else:
             user = configuration['postgres']['user'] if not self._reload else configuration['postgres']['reload_user']
-            self._conn = psycopg2.connect(host=configuration['postgres']['host'],
-                                          user=user,
-                                          database=configuration['postgres']['database'],
-                                          port=configuration['postgres']['port'],
-                                          cursor_factory=self._cursor_type)
-        cursor = self._conn.cursor()
-        if self._schema:
-            cursor.execute('SET search_path=public,%s;', [self._schema])
+            self._pool = _get_postgres_pool('reload' if self._reload else 'read',
+                                            {'host': configuration['postgres']['host'],
+                                             'user': user,
+                                             'database': configuration['postgres']['database'],
+                                             'port': configuration['postgres']['port']})
+        self._conn = self._pool.get_connection()
+        try:
+            cursor = self._conn.cursor(cursor_factory=self._cursor_type)
+            if self._schema:
+                cursor.execute('SET search_path=public,%s;', [self._schema])
+            if self._server_side:
+                # The cursor lives until the transaction ends, when the connection is returned to the pool
+                cursor = self._conn.cursor(name='server_side', cursor_factory=self._cursor_type)
+                cursor.itersize = 5000
+        except BaseException:
+            # __exit__ isn't called if __enter__ fails, so return the (possibly broken) connection here
+            self._pool.return_connection(self._conn, discard=True)
+            raise
         return cursor
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self._conn.close()
+        # Don't put a connection back in the pool if it broke while we were using it
+        broken = exc_type is not None and issubclass(exc_type, (psycopg2.OperationalError, psycopg2.InterfaceError))
+        self._pool.return_connection(self._conn, discard=broken)
 
     def commit(self):
         self._conn.commit()
@@ -65,41 +192,118 @@ class PostgresConnection:
         self._conn.rollback()
 
 
-class RedisConnection:
-    """ Figures out where the master redis instance is (and other parameters
-    needed to connect like which database to use), and opens a connection
-    to it. It passes back that connection object, using a context manager
-    to clean up after use.
+class _CountingConnectionPool(redis.ConnectionPool):
+    """ A Redis connection pool which keeps track of how many connection checkouts were served by an idle
+    connection (hits) and how many required opening a new connection (misses). """
 
-    If only one "sentinel" is defined, then just connect directly to that machine rather than checking the sentinels. """
+    def reset(self) -> None:
+        # Called on creation and again by redis-py if the pool is used after a fork
+        super().reset()
+        self.checkouts = 0
+        self.hits = 0
+        self.misses = 0
+
+    def make_connection(self):
+        self.misses += 1
+        connection = super().make_connection()
+        connection.checked_out = False
+        return connection
+
+    def get_connection(self, command_name, *keys, **options):
+        connection = super().get_connection(command_name, *keys, **options)
+        self.checkouts += 1
+        if connection.checked_out:
+            self.hits += 1
+        connection.checked_out = True
+        return connection
+
+
+_redis_pool: Optional[_CountingConnectionPool] = None
+_redis_pool_lock = threading.Lock()
+_redis_master_discoveries = 0
 
-    def __init__(self):
-        """ Creates a connection instance. Optionally specify a non-default db. """
+
+def _get_redis_pool() -> _CountingConnectionPool:
+    """ Returns the process-wide Redis connection pool. The master address is only looked up from the sentinels
+    when the pool is created, and again after a failover invalidates the pool. """
+
+    global _redis_pool, _redis_master_discoveries
+
+    with _redis_pool_lock:
+        if _redis_pool is not None:
+            return _redis_pool
 
         # If there is only one sentinel, just treat that as the Redis instance itself, and not a sentinel
         if len(configuration['redis']['sentinels']) == 1:
-            self._redis_host = configuration['redis']['sentinels'][0][0]
-            self._redis_port = configuration['redis']['sentinels'][0][1]
+            redis_host = configuration['redis']['sentinels'][0][0]
+            redis_port = configuration['redis']['sentinels'][0][1]
         else:
             # Connect to the sentinels to determine the master
             try:
                 sentinel = Sentinel(configuration['redis']['sentinels'], socket_timeout=0.5)
-                self._redis_host, self._redis_port = sentinel.discover_master(configuration['redis']['master_name'])
+                redis_host, redis_port = sentinel.discover_master(configuration['redis']['master_name'])
+                _redis_master_discoveries += 1
 
             # Raise an exception if we cannot connect to the database server
             except redis.sentinel.MasterNotFoundError:
                 raise ServerException('Could not determine Redis host. Sentinels offline?')
 
+        password = configuration['redis']['password'] if configuration['redis']['password'] else None
+        _redis_pool = _CountingConnectionPool(host=redis_host,
+                                              port=redis_port,
+                                              db=configuration['redis']['db'],
+                                              password=password,
+                                              max_connections=configuration['redis'].get('max_connections'))
+        return _redis_pool
+
+
+def _invalidate_redis_pool(pool: _CountingConnectionPool) -> None:
+    """ Drops the pool so that the next connection rediscovers the master. Only the pool that failed is dropped,
+    in case another thread already replaced it. Only its idle connections are closed, since other threads may still
+    be using the rest; those are closed once the dropped pool is garbage collected. """
+
+    global _redis_pool
+
+    with _redis_pool_lock:
+        if _redis_pool is pool:
+            _redis_pool = None
+    pool.disconnect(inuse_connections=False)
+
+
+def get_redis_pool_statistics() -> dict:
+    """ Returns the connection reuse counters for the Redis pool of this process. """
+
+    pool = _redis_pool
+    if pool is None:
+        return {'checkouts': 0, 'hits': 0, 'misses': 0, 'master_discoveries': _redis_master_discoveries}
+    return {'checkouts': pool.checkouts,
+            'hits': pool.hits,
+            'misses': pool.misses,
+            'master': '%s:%s' % (pool.connection_kwargs['host'], pool.connection_kwargs['port']),
+            'master_discoveries': _redis_master_discoveries}
+
+
+class RedisConnection:
+    """ Provides a connection to the master redis instance (which is located using the sentinels, and other
+    parameters needed to connect like which database to use). Connections come from a pool shared by the whole
+    process, so using this context manager only costs a socket checkout per command.
+
+    If only one "sentinel" is defined, then just connect directly to that machine rather than checking the sentinels.
+    If the master stops responding or turns out to be a replica (a failover happened) the pool is discarded, so the
+    master will be rediscovered by the next connection. """
+
+    def __init__(self):
+        """ Creates a connection instance. """
+
+        self._pool = _get_redis_pool()
+
     def __enter__(self) -> redis.StrictRedis:
-        try:
-            password = configuration['redis']['password'] if configuration['redis']['password'] else None
-            self._redis_con = redis.StrictRedis(host=self._redis_host,
-                                                port=self._redis_port,
-                                                db=configuration['redis']['db'],
-                                                password=password)
-        except redis.exceptions.ConnectionError:
-            raise ServerException('Could not connect to Redis server.')
+        self._redis_con = redis.StrictRedis(connection_pool=self._pool)
         return self._redis_con
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._redis_con.close()
+        if exc_type is not None and issubclass(exc_type, (redis.exceptions.ConnectionError,
+                                                          redis.exceptions.TimeoutError,
+                                                          redis.exceptions.ReadOnlyError)):
+            _invalidate_redis_pool(self._pool)
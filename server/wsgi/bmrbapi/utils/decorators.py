@@ -1,9 +1,17 @@
+import time
+import zlib
 from functools import wraps
+from hashlib import md5
 
-from flask import request
+import simplejson as json
+from flask import request, make_response, Response
 
 from bmrbapi.exceptions import RequestException
-from bmrbapi.utils.querymod import check_local_ip
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
+from bmrbapi.utils.querymod import check_local_ip, get_data_versions
+
+RESPONSE_CACHE_STATS_KEY = "response_cache:stats"
 
 
 def require_content_type_json(function):
@@ -24,3 +32,75 @@ def require_local(function):
         return function(*args, **kwargs)
 
     return wrapper
+
+
+def cache_response(ttl: int):
+    """ Caches the responses of a view in Redis for up to ttl seconds (which the response_cache.ttl configuration
+    can override per endpoint). Responses are cached per endpoint, view arguments, and query arguments, and for the
+    current version of the data (the update time of each database), so they are replaced as soon as the databases
+    are reloaded. The ttl bounds how stale data not loaded by the entry reloader can get.
+
+    Only one process computes a missing response at a time; the others wait up to response_cache.max_wait seconds
+    for it to be cached, and then compute it themselves. Responses that aren't 200, are streamed, are too large, or
+    that say "Cache-Control: no-store" aren't cached.
+
+    The requests, misses (responses which were computed) and stores of each endpoint are counted in
+    response_cache:stats. The counters are sent along with the commands each request sends anyway. """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            settings = configuration.get('response_cache', {})
+            if not settings.get('enabled', True):
+                return function(*args, **kwargs)
+
+            with RedisConnection() as r:
+                pipe = r.pipeline(transaction=False)
+                pipe.hincrby(RESPONSE_CACHE_STATS_KEY, "%s:requests" % request.endpoint)
+                versions = get_data_versions(r, pipe)
+
+                request_key = json.dumps([sorted(kwargs.items()), sorted(request.args.items(multi=True)), versions])
+                key = "response_cache:%s:%s" % (request.endpoint, md5(request_key.encode()).hexdigest())
+                lock_key = "%s:lock" % key
+
+                # Wait for the response if someone else is already computing it
+                locked = False
+                wait_until = time.time() + settings.get('max_wait', 5)
+                while True:
+                    cached = r.hgetall(key)
+                    if cached:
+                        response = Response(zlib.decompress(cached[b'body']), status=200)
+                        for header, value in json.loads(cached[b'headers']):
+                            response.headers[header] = value
+                        return response
+                    if r.set(lock_key, 1, nx=True, ex=settings.get('lock_timeout', 60)):
+                        locked = True
+                        break
+                    if time.time() > wait_until:
+                        break
+                    time.sleep(0.05)
+
+            response = None
+            try:
+                response = make_response(function(*args, **kwargs))
+                return response
+            finally:
+                with RedisConnection() as r:
+                    pipe = r.pipeline(transaction=False)
+                    pipe.hincrby(RESPONSE_CACHE_STATS_KEY, "%s:misses" % request.endpoint)
+                    if (response is not None and response.status_code == 200 and not response.is_streamed
+                            and not response.direct_passthrough and not response.cache_control.no_store):
+                        body = response.get_data()
+                        if len(body) <= settings.get('max_bytes', 33554432):
+                            headers = [[header, value] for header, value in response.headers.items()
+                                       if header not in ('Content-Length', 'Set-Cookie')]
+                            pipe.hset(key, mapping={'body': zlib.compress(body), 'headers': json.dumps(headers)})
+                            pipe.expire(key, settings.get('ttl', {}).get(request.endpoint, ttl))
+                            pipe.hincrby(RESPONSE_CACHE_STATS_KEY, "%s:stores" % request.endpoint)
+                    if locked:
+                        pipe.delete(lock_key)
+                    pipe.execute()
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import pynmrstar
+
+from bmrbapi.utils.configuration import configuration
+
+# The memory a parsed entry uses, as a multiple of the length of its JSON (measured with tracemalloc on entries
+#  made of large chemical shift loops, which use about 6 times as much)
+JSON_SIZE_MULTIPLIER = 6
+
+
+class EntryCache:
+    """ A per-process LRU cache of parsed entries. Each entry is stored along with the data version it was loaded
+    from, and is only returned if the caller asks for that same version, so a reload invalidates it automatically.
+
+    The cache is bounded by the memory the cached entries use rather than their number. The memory an entry uses is
+    estimated from the length of its JSON times JSON_SIZE_MULTIPLIER. Cached entries are shared, so they must not be
+    modified by the caller. """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: 'OrderedDict[str, Tuple[str, int, pynmrstar.Entry]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, entry_id: str, version: str) -> Optional[pynmrstar.Entry]:
+        """ Returns the cached entry if it is present and was loaded from the given data version. """
+
+        with self._lock:
+            cached = self._entries.get(entry_id)
+            if cached is None or cached[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(entry_id)
+            self.hits += 1
+            return cached[2]
+
+    def put(self, entry_id: str, version: str, entry: pynmrstar.Entry, json_length: int) -> None:
+        """ Adds an entry, given the length of its JSON, to the cache, evicting the least recently used entries to
+        make space. """
+
+        size = json_length * JSON_SIZE_MULTIPLIER
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            self._remove(entry_id)
+            self._entries[entry_id] = (version, size, entry)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, entry_id: str) -> None:
+        """ Removes an entry from the cache, if present. """
+
+        with self._lock:
+            self._remove(entry_id)
+
+    def statistics(self) -> dict:
+        """ Returns the hit, miss, and eviction counters, and the current (estimated) size of the cache. """
+
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'size': self.size, 'max_size': self.max_bytes}
+
+    def _remove(self, entry_id: str) -> None:
+        cached = self._entries.pop(entry_id, None)
+        if cached is not None:
+            self.size -= cached[1]
+
+
+entry_cache = EntryCache(configuration.get('entry_cache', {}).get('max_bytes', 67108864))
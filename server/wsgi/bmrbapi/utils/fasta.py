@@ -0,0 +1,230 @@
+""" The FASTA sequence libraries used by the FASTA search.
+
+The reloader writes one FASTA library per polymer type into a directory (see reloaders/fasta.py), along with a
+lookup table of the entry, entity, and entry title for each sequence. The sequences are named by their position in
+the lookup table, starting from 1. Each library is split into shards which are searched in parallel; library.json
+has the number of shards of each type. Each library also has a k-mer index (see utils/kmer_index.py), which can be
+used to search only the sequences that share k-mers with the query. """
+
+import os
+import subprocess
+import textwrap
+import time
+import uuid
+from contextlib import contextmanager
+from hashlib import md5
+from typing import IO, Dict, Iterator, List, Optional
+
+import simplejson as json
+
+from bmrbapi.exceptions import ServerException
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+from bmrbapi.utils.kmer_index import KmerIndex, load_kmer_index
+
+# The values of the type argument, and the polymer type of the entities they search
+FASTA_TYPES = {'polymer': 'polypeptide(L)', 'rna': 'polyribonucleotide', 'dna': 'polydeoxyribonucleotide'}
+
+FASTA_SLOT_KEY = "fasta:slot:%d"
+FASTA_RESULT_KEY = "fasta:result:%s:%s"
+
+_library: Optional['FastaLibrary'] = None
+
+
+class FastaLibrary:
+    """ The loaded FASTA libraries. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lookups: Dict[str, List[List[str]]] = {}
+        for a_type in FASTA_TYPES:
+            with open(os.path.join(path, "%s.json" % a_type), "r") as lookup_file:
+                self.lookups[a_type] = json.load(lookup_file)
+        with open(os.path.join(path, "library.json"), "r") as library_file:
+            self.shards: Dict[str, int] = json.load(library_file)['shards']
+        self.kmer_indexes: Dict[str, Optional[KmerIndex]] = {}
+
+    @property
+    def version(self) -> str:
+        """ Each build of the libraries is in its own directory, so the name of the directory is the version. """
+
+        return os.path.basename(self.path)
+
+    def result_key(self, sequence: str, a_type: str, e_val: Optional[str]) -> str:
+        """ Returns the Redis key of the cached results of a search of this version of the libraries. The prefilter
+        settings are part of the key, since they can change the results. """
+
+        search = json.dumps([sequence, a_type, e_val, configuration.get('fasta', {}).get('prefilter', {})],
+                            sort_keys=True)
+        return FASTA_RESULT_KEY % (self.version, md5(search.encode()).hexdigest())
+
+    def library_files(self, a_type: str) -> List[str]:
+        """ Returns the paths of the shards of the FASTA library of the type. """
+
+        return [os.path.join(self.path, "%s.%d.fasta" % (a_type, shard)) for shard in range(self.shards[a_type])]
+
+    def size(self, a_type: str) -> int:
+        """ Returns the number of sequences in the FASTA library of the type. """
+
+        return len(self.lookups[a_type])
+
+    def lookup(self, a_type: str, sequence_id: int) -> List[str]:
+        """ Returns the entry ID, entity ID, and entry title of a sequence in the FASTA library of the type. """
+
+        return self.lookups[a_type][sequence_id - 1]
+
+    def kmer_index(self, a_type: str) -> Optional[KmerIndex]:
+        """ Returns the k-mer index of the FASTA library of the type, or None if it wasn't built. """
+
+        if a_type not in self.kmer_indexes:
+            self.kmer_indexes[a_type] = load_kmer_index(self.path, a_type)
+        return self.kmer_indexes[a_type]
+
+    def write_candidates(self, a_type: str, query: str, candidates_file: IO[bytes]) -> Optional[int]:
+        """ Writes the sequences of the FASTA library of the type that pass the k-mer prefilter into the file, and
+        returns how many there were. Returns None, without writing anything, if the whole library should be searched
+        instead: when the prefilter is turned off, the query is too short for k-mers to be selective, or too many
+        sequences pass. """
+
+        settings = configuration.get('fasta', {}).get('prefilter', {})
+        kmer_index = self.kmer_index(a_type)
+        if not settings.get('enabled', False) or not kmer_index or len(query) < settings.get('min_query_length', 30):
+            return None
+
+        candidates = kmer_index.candidates(query, settings.get('min_shared_kmers', 2))
+        if len(candidates) > settings.get('max_candidates', .05) * len(kmer_index):
+            return None
+
+        candidates_file.write("".join(">%s\n%s\n" % (position + 1, wrap_sequence(kmer_index.sequence(position)))
+                                      for position in candidates).encode())
+        candidates_file.flush()
+        return len(candidates)
+
+
+def fasta_sequences(a_type: str) -> list:
+    """ Returns the entry ID, entity ID, sequence, and entry title of the entities of the polymer type. """
+
+    with PostgresConnection(schema="macromolecules") as cur:
+        cur.execute('''
+SELECT entity."Entry_ID", entity."ID",
+  regexp_replace(entity."Polymer_seq_one_letter_code", E'[\\n\\r]+', '', 'g' ),
+  replace(regexp_replace(entry."Title", E'[\\n\\r]+', ' ', 'g' ), '  ', ' ')
+FROM "Entity" as entity
+  LEFT JOIN "Entry" as entry
+  ON entity."Entry_ID" = entry."ID"
+  WHERE entity."Polymer_seq_one_letter_code" IS NOT NULL AND "Polymer_type" = %s
+ORDER BY entity."Entry_ID", entity."ID"''', [FASTA_TYPES[a_type]])
+        return cur.fetchall()
+
+
+def wrap_sequence(sequence: str) -> str:
+    """ Wraps a sequence to 80 characters per line. """
+
+    wrapper = textwrap.TextWrapper(width=80, expand_tabs=False,
+                                   replace_whitespace=False,
+                                   drop_whitespace=False, break_on_hyphens=False)
+    return "\n".join(wrapper.wrap(sequence))
+
+
+@contextmanager
+def fasta_search_slot() -> Iterator[None]:
+    """ Waits for one of the fasta.max_concurrent search slots, so that a burst of FASTA searches can't tie up every
+    worker. The slots are shared by all the workers through Redis, and expire a while after a search would have
+    timed out in case a worker dies while holding one. Raises a ServerException if no slot frees up within
+    fasta.slot_wait seconds. """
+
+    settings = configuration.get('fasta', {})
+    token = uuid.uuid4().hex
+    # Long enough that a slot can't expire while its search is still running
+    timeout = settings.get('timeout', 60) + 30
+
+    with RedisConnection() as r:
+        wait_until = time.time() + settings.get('slot_wait', 10)
+        slot_key = None
+        while not slot_key:
+            for slot in range(settings.get('max_concurrent', 4)):
+                if r.set(FASTA_SLOT_KEY % slot, token, nx=True, ex=timeout):
+                    slot_key = FASTA_SLOT_KEY % slot
+                    break
+            else:
+                if time.time() > wait_until:
+                    raise ServerException("Too many FASTA searches are running. Please try again later.",
+                                          status_code=503)
+                time.sleep(0.1)
+
+    try:
+        yield
+    finally:
+        with RedisConnection() as r:
+            if r.get(slot_key) == token.encode():
+                r.delete(slot_key)
+
+
+def run_fasta(fasta_arguments: List[str], query_file: str, library_files: List[str],
+              database_size: Optional[int] = None) -> List[List[str]]:
+    """ Runs fasta36 on each of the library files in parallel, and returns the columns of the hits (in -m 8 format)
+    merged in order of E-value, as fasta36 would for a single library. database_size is the number of sequences in
+    the whole library, so that searching shards or a subset of the library gives E-values for the whole library. All
+    of the searches together must finish within fasta.timeout seconds.
+
+    Like fasta36, every hit within the E-value cutoff is returned, unless fasta.max_hits is set. Then only the best
+    max_hits hits of each search (passed as -b) and of the merged results are kept. """
+
+    settings = configuration.get('fasta', {})
+    max_hits = settings.get('max_hits')
+    fasta_arguments = list(fasta_arguments)
+    if max_hits:
+        fasta_arguments.extend(["-b", str(max_hits)])
+    if settings.get('threads'):
+        fasta_arguments.extend(["-T", str(settings['threads'])])
+    if database_size:
+        fasta_arguments.extend(["-Z", str(database_size)])
+
+    deadline = time.monotonic() + settings.get('timeout', 60)
+    processes = [subprocess.Popen(fasta_arguments + [query_file, library_file], stdout=subprocess.PIPE,
+                                  stderr=subprocess.STDOUT) for library_file in library_files]
+    try:
+        outputs = [process.communicate(timeout=max(0, deadline - time.monotonic()))[0] for process in processes]
+    except subprocess.TimeoutExpired:
+        raise ServerException("The FASTA search took too long.", status_code=504)
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+    hits = []
+    for process, output in zip(processes, outputs):
+        if process.returncode != 0:
+            raise ServerException("FASTA search failed: %s" % output.decode().strip())
+        for line in output.decode().split("\n"):
+            cols = line.split()
+            if len(cols) == 12:
+                hits.append(cols)
+
+    # Each shard is already in order, and has its own best max_hits hits
+    if len(library_files) > 1:
+        hits.sort(key=lambda cols: (float(cols[10]), -float(cols[11])))
+        if max_hits:
+            del hits[max_hits:]
+    return hits
+
+
+def get_fasta_library() -> Optional[FastaLibrary]:
+    """ Returns the FASTA libraries, or None if the reloader hasn't built them. They are loaded once per process,
+    and loaded again when the reloader replaces them. """
+
+    global _library
+
+    directory = configuration.get('fasta_directory')
+    if not directory:
+        return None
+
+    # The reloader swaps a symbolic link to the newest version of the libraries
+    path = os.path.realpath(os.path.join(directory, "library"))
+    if _library is None or _library.path != path:
+        try:
+            _library = FastaLibrary(path)
+        except OSError:
+            _library = None
+    return _library
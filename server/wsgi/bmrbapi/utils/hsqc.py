@@ -0,0 +1,142 @@
+""" The simulated 1H-15N HSQC peak lists of entries, made with PyBMRB.
+
+The peak list of an entry (with the side chain peaks) is made once per version of the stored entry and cached in
+Redis. The csv, sparky, and json renderings, with or without the side chain peaks, are made from the cached peak
+list. The HTML plot is cached separately, unless it is larger than hsqc.max_html_size bytes compressed. Released
+entries are cached for hsqc.cache_ttl seconds, uploaded entries for as long as the upload is kept. """
+
+import os
+import tempfile
+import zlib
+from typing import List, Optional, Union
+
+import pynmrstar
+import simplejson as json
+
+from bmrbapi.exceptions import ServerException
+from bmrbapi.utils import querymod
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
+
+HSQC_PEAKS_KEY = "hsqc:peaks:%s:%s"
+HSQC_HTML_KEY = "hsqc:html:%s:%s"
+
+# The atoms export_peak_list() of PyBMRB considers the backbone
+BACKBONE_ATOMS = {'H', 'N', 'C', 'CA'}
+
+
+def _get_entry(entry_id: str) -> pynmrstar.Entry:
+    return next(querymod.get_valid_entries_from_redis(entry_id))[1]
+
+
+def _cache_ttl(entry_id: str) -> int:
+    if len(entry_id) == 32:
+        return configuration['redis']['upload_timeout']
+    return configuration.get('hsqc', {}).get('cache_ttl', 2592000)
+
+
+def make_peak_list(entry: pynmrstar.Entry) -> List[list]:
+    """ Returns the simulated peaks of the entry as [sequence, chem_comp_ID, X_atom_name, Y_atom_name, X_shift,
+    Y_shift] rows, in the order PyBMRB makes them. """
+
+    from pybmrb import Spectra
+
+    x, y, _, info, _, _ = Spectra.create_n15hsqc_peaklist(entry_objects=entry, include_sidechain=True)
+    peaks = []
+    for x_shift, y_shift, peak_info in zip(x, y, info):
+        peak_info = peak_info.split("-")
+        peaks.append([peak_info[3], peak_info[4], peak_info[5], peak_info[6], float(x_shift), float(y_shift)])
+    return peaks
+
+
+def get_peak_list(entry_id: str, refresh: bool = False) -> List[list]:
+    """ Returns the simulated peaks of the entry from the cache, or makes them and caches them. """
+
+    entry_hash = querymod.get_entry_hash(entry_id)
+    key = HSQC_PEAKS_KEY % (entry_id, entry_hash) if entry_hash else None
+    ttl = _cache_ttl(entry_id)
+
+    if key and ttl and not refresh:
+        with RedisConnection() as r:
+            cached = r.get(key)
+            if cached:
+                if len(entry_id) == 32:
+                    r.expire(key, ttl)
+                return json.loads(zlib.decompress(cached))
+
+    peaks = make_peak_list(_get_entry(entry_id))
+    if key and ttl:
+        with RedisConnection() as r:
+            r.set(key, zlib.compress(json.dumps(peaks, separators=(',', ':')).encode()), ex=ttl)
+    return peaks
+
+
+def render_peak_list(peaks: List[list], format_: str, include_sidechain: bool) -> Union[str, dict]:
+    """ Renders the peaks the way export_peak_list() of PyBMRB writes them (csv or sparky), or as its dictionary of
+    columns (json). """
+
+    from pybmrb import ChemicalShiftStatistics
+
+    if not include_sidechain:
+        peaks = [peak for peak in peaks if peak[2] in BACKBONE_ATOMS and peak[3] in BACKBONE_ATOMS]
+
+    if format_ == 'csv':
+        lines = ['sequence,chem_comp_ID,X_shift,Y_shift,X_atom_name,Y_atom_name\n']
+        for sequence, comp, atom_x, atom_y, x_shift, y_shift in peaks:
+            lines.append('{},{},{},{},{},{}\n'.format(sequence, comp, round(x_shift, 3), round(y_shift, 3),
+                                                      atom_x, atom_y))
+        return "".join(lines)
+    elif format_ == 'sparky':
+        lines = ['Assignment  \t{:>6}\t\t{:>6}\n\n'.format('w1', 'w2')]
+        for sequence, comp, atom_x, atom_y, x_shift, y_shift in peaks:
+            assignment = '{}{}{}-{}'.format(ChemicalShiftStatistics.one_letter_code.get(comp, 'X'), sequence,
+                                            atom_x, atom_y)
+            lines.append('{:<10}\t\t{:>6}\t\t{:>6}\n'.format(assignment, round(y_shift, 3), round(x_shift, 3)))
+        return "".join(lines)
+    elif format_ == 'json':
+        return {'sequence': [peak[0] for peak in peaks],
+                'chem_comp_ID': [peak[1] for peak in peaks],
+                'X_shift': [peak[4] for peak in peaks],
+                'Y_shift': [peak[5] for peak in peaks],
+                'X_atom_name': [peak[2] for peak in peaks],
+                'Y_atom_name': [peak[3] for peak in peaks]}
+    raise ValueError('Unsupported peak list format: %s' % format_)
+
+
+def get_hsqc_html(entry_id: str) -> Optional[bytes]:
+    """ Returns the zlib compressed HTML plot of the simulated spectrum of the entry, or None if the entry has no
+    amide proton and nitrogen chemical shifts. """
+
+    entry_hash = querymod.get_entry_hash(entry_id)
+    key = HSQC_HTML_KEY % (entry_id, entry_hash) if entry_hash else None
+    ttl = _cache_ttl(entry_id)
+
+    if key and ttl:
+        with RedisConnection() as r:
+            cached = r.get(key)
+            if cached is not None:
+                if len(entry_id) == 32:
+                    r.expire(key, ttl)
+                # An empty value means there is nothing to plot
+                return cached or None
+
+    # Only make the plot if there are peaks, which is quicker to check in the cached peak list
+    if get_peak_list(entry_id):
+        from pybmrb import Spectra
+
+        with tempfile.TemporaryDirectory() as output_directory:
+            output_file = os.path.join(output_directory, 'hsqc.html')
+            Spectra.n15hsqc(entry_objects=_get_entry(entry_id), legend='residue', show_visualization=False,
+                            output_format='html', output_file=output_file)
+            with open(output_file, 'rb') as html_file:
+                html = html_file.read()
+        if not html:
+            raise ServerException('PyBMRB failed to generate valid output.')
+        html = zlib.compress(html)
+    else:
+        html = b""
+
+    if key and ttl and len(html) <= configuration.get('hsqc', {}).get('max_html_size', 2097152):
+        with RedisConnection() as r:
+            r.set(key, html, ex=ttl)
+    return html or None
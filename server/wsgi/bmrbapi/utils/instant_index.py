@@ -0,0 +1,188 @@
+""" An in-process prefix index of the entry IDs, titles, and extra search terms used by the instant search, so that
+the autocomplete widget can be answered without querying Postgres while someone is still typing an ID or the first
+few letters of a word. Longer terms are left to the full search, which also finds words in the middle of titles.
+
+The index is loaded from web.instant_cache and web.instant_extra_search_terms the first time it is needed, and
+loaded again when the databases are reloaded. The keys are kept in one sorted list, so the keys starting with a
+prefix are a contiguous range found by bisection. Each process only keeps the keys and what is needed to rank the
+matches; the titles, citations and so on of the few rows which are returned are fetched from Postgres by ID.
+
+The results have the same shape as those of the full search, and are ranked the same way: the rows which matched by
+their ID or title come first, exact ID matches first, then macromolecules before metabolomics, then newest first.
+The rows which only matched by an extra search term come after them, with the similarity of the term as "sml",
+highest first. """
+
+import datetime
+import re
+import threading
+import time
+from bisect import bisect_left
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import PostgresConnection
+
+_index: Optional['InstantIndex'] = None
+_index_lock = threading.Lock()
+_index_loading = False
+
+# The start of a macromolecule or metabolomics entry ID
+ENTRY_ID_PREFIX = re.compile(r"^(bms[et]?)?\d*$", re.IGNORECASE)
+# The words of a term, as pg_trgm splits them
+WORDS = re.compile(r"[^\W_]+")
+
+
+def _trigrams(text: str) -> Set[str]:
+    """ Returns the trigrams of the text, like pg_trgm's show_trgm(). """
+
+    trigrams = set()
+    for word in WORDS.findall(text.lower()):
+        word = "  %s " % word
+        trigrams.update(word[x:x + 3] for x in range(len(word) - 2))
+    return trigrams
+
+
+def similarity(term: str, extra_term: str) -> float:
+    """ Returns how similar the extra search term is to the search term, as the full search reports it: 1 if every
+    word of the term is a word of the extra term, otherwise the pg_trgm similarity() of the two. """
+
+    words = set(WORDS.findall(term.lower()))
+    if words and words <= set(WORDS.findall(extra_term.lower())):
+        return 1.0
+    term_trigrams, extra_trigrams = _trigrams(term), _trigrams(extra_term)
+    if not term_trigrams or not extra_trigrams:
+        return 0.0
+    # pg_trgm returns a real, which reaches Python as its shortest decimal representation
+    return float(str(np.float32(len(term_trigrams & extra_trigrams) / len(term_trigrams | extra_trigrams))))
+
+
+class InstantIndex:
+    """ The loaded prefix index. """
+
+    def __init__(self, versions: List[Optional[str]]):
+        self.versions = versions
+        self.loaded = time.time()
+
+        with PostgresConnection() as cur:
+            cur.execute('''
+SELECT instant_cache.id, title, sub_date, is_metab = 'True' AS is_metab, ms.id IS NOT NULL AS has_summary
+FROM web.instant_cache
+         LEFT JOIN web.metabolomics_summary AS ms
+                   ON instant_cache.id = ms.id''')
+            rows = cur.fetchall()
+            cur.execute('''
+SELECT id, termname, term
+FROM web.instant_extra_search_terms
+WHERE term IS NOT NULL''')
+            extra_terms = cur.fetchall()
+
+        # What is needed to filter and rank the rows: ID, is_metab, has_summary, sub_date
+        self.entries = [(row['id'], bool(row['is_metab']), bool(row['has_summary']),
+                         row['sub_date'] or datetime.date.min) for row in rows]
+
+        # Each key refers to a row, and for the extra search terms to the term which matched
+        positions = {row['id']: position for position, row in enumerate(rows)}
+        keys = []
+        for position, row in enumerate(rows):
+            keys.append((row['id'].lower(), position, None))
+            if row['title']:
+                keys.append((row['title'].lower(), position, None))
+        for extra_term in extra_terms:
+            if extra_term['id'] in positions:
+                keys.append((extra_term['term'].lower(), positions[extra_term['id']],
+                             (extra_term['term'], extra_term['termname'])))
+        keys.sort(key=lambda x: x[0])
+        self.keys = [x[0] for x in keys]
+        self.references = [x[1:] for x in keys]
+
+    def complete(self, prefix: str, database: str, limit: int,
+                 max_keys: int) -> Optional[List[Tuple[dict, Optional[dict], Optional[float]]]]:
+        """ Returns up to limit of the rows of the database with a key starting with the prefix, the extra search
+        term which matched (if any), and its similarity to the prefix, in the order of the full search. Returns None
+        if nothing matches, or if more than max_keys keys match, since the full search ranks broad prefixes better. """
+
+        start = bisect_left(self.keys, prefix.lower())
+        end = bisect_left(self.keys, prefix.lower() + "\uffff", lo=start)
+        if start == end or end - start > max_keys:
+            return None
+
+        matches = []
+        for position, extra_term in self.references[start:end]:
+            entry_id, is_metab, has_summary, sub_date = self.entries[position]
+            if database == "metabolomics" and not (is_metab and has_summary):
+                continue
+            if database == "macromolecules" and is_metab:
+                continue
+            if extra_term is None:
+                matches.append(((False, entry_id != prefix, is_metab, datetime.date.max - sub_date), entry_id,
+                                None, None))
+            else:
+                sml = similarity(prefix, extra_term[0])
+                matches.append(((True, -sml, is_metab, datetime.date.max - sub_date), entry_id,
+                                {"term": extra_term[0], "termname": extra_term[1]}, sml))
+        matches.sort(key=lambda x: x[0])
+
+        results, seen = [], set()
+        for match in matches:
+            if match[1] not in seen:
+                seen.add(match[1])
+                results.append(match[1:])
+        del results[limit:]
+        if not results:
+            return None
+
+        with PostgresConnection() as cur:
+            cur.execute('''
+SELECT instant_cache.id, title, citations, authors, link, sub_date, data_types, ms.formula, ms.inchi, ms.smiles,
+       ms.average_mass, ms.molecular_weight, ms.monoisotopic_mass
+FROM web.instant_cache
+         LEFT JOIN web.metabolomics_summary AS ms
+                   ON instant_cache.id = ms.id
+WHERE instant_cache.id = ANY (%s)''', [[result[0] for result in results]])
+            rows = {row['id']: row for row in cur.fetchall()}
+
+        # A row may be gone if the database was reloaded since the index was
+        return [(rows[entry_id], extra, sml) for entry_id, extra, sml in results if entry_id in rows] or None
+
+
+def is_prefix_term(term: str) -> bool:
+    """ Returns whether the search term should be answered from the prefix index: it must be at least
+    instant.prefix_min_length characters long, and either the start of an entry ID or no longer than
+    instant.prefix_max_length characters. """
+
+    settings = configuration.get('instant', {})
+    if len(term) < settings.get('prefix_min_length', 3):
+        return False
+    return bool(ENTRY_ID_PREFIX.match(term)) or len(term) <= settings.get('prefix_max_length', 4)
+
+
+def get_instant_index(versions: List[Optional[str]]) -> Optional[InstantIndex]:
+    """ Returns the prefix index, or None if it's turned off. The index is loaded once per process, and loaded again
+    when the data versions change or it is older than instant.index_ttl seconds. While one thread loads it, the
+    others keep using the old index (or get None if there isn't one yet) rather than waiting. """
+
+    global _index, _index_loading
+
+    settings = configuration.get('instant', {})
+    if not settings.get('prefix_index', True):
+        return None
+
+    with _index_lock:
+        index = _index
+        if index is not None and index.versions == versions and \
+                time.time() - index.loaded <= settings.get('index_ttl', 3600):
+            return index
+        if _index_loading:
+            return index
+        _index_loading = True
+
+    try:
+        index = InstantIndex(versions)
+        with _index_lock:
+            _index = index
+    finally:
+        with _index_lock:
+            _index_loading = False
+    return index
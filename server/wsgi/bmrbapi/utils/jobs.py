@@ -0,0 +1,137 @@
+""" A Redis backed queue of jobs which take too long to run while a client waits, such as validating a large entry.
+
+The API adds a job to the queue and returns its ID. Separate worker processes (python -m bmrbapi.jobs) take jobs
+off the queue, run them, and store the result with the job, where the client can poll for it (/jobs/<id>). Each
+client can only have jobs.max_per_client jobs queued or running at a time. Jobs and their results expire
+jobs.result_ttl seconds after they last changed. """
+
+import logging
+import time
+import traceback
+import uuid
+import zlib
+from typing import Callable, Dict, Optional
+
+import simplejson as json
+
+from bmrbapi.exceptions import APIException, RequestException
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
+from bmrbapi.utils.validation import get_validation_report
+
+JOB_QUEUE_KEY = "jobs:queue"
+JOB_KEY = "jobs:job:%s"
+JOB_CLIENT_KEY = "jobs:client:%s"
+
+
+def _validate(entry_id: str) -> dict:
+    return {entry_id: get_validation_report(entry_id)}
+
+
+# The functions which run each type of job, given its argument
+JOB_TYPES: Dict[str, Callable[[str], dict]] = {'validate': _validate}
+
+
+def enqueue_job(job_type: str, argument: str, client: str) -> str:
+    """ Adds a job to the queue and returns its ID. Raises a RequestException if the client already has as many
+    jobs as it is allowed. """
+
+    settings = configuration.get('jobs', {})
+    result_ttl = settings.get('result_ttl', 3600)
+    client_key = JOB_CLIENT_KEY % client
+
+    with RedisConnection() as r:
+        # The count expires in case a worker dies without finishing a job
+        pipe = r.pipeline()
+        pipe.incr(client_key)
+        pipe.expire(client_key, result_ttl)
+        if pipe.execute()[0] > settings.get('max_per_client', 2):
+            r.decr(client_key)
+            raise RequestException("You already have the maximum number of jobs queued or running. Please wait for "
+                                   "them to finish.", status_code=429)
+
+        job_id = uuid.uuid4().hex
+        pipe = r.pipeline()
+        pipe.hset(JOB_KEY % job_id, mapping={"type": job_type, "argument": argument, "client": client,
+                                             "status": "queued", "created": time.time()})
+        pipe.expire(JOB_KEY % job_id, result_ttl)
+        # The client is queued with the job, so its count can be decremented even if the job expires while queued
+        pipe.rpush(JOB_QUEUE_KEY, "%s:%s" % (job_id, client))
+        pipe.execute()
+    return job_id
+
+
+def get_job(job_id: str) -> Optional[dict]:
+    """ Returns the status of the job, and its result or error if it finished. Returns None if there is no such job
+    (or it expired). """
+
+    with RedisConnection() as r:
+        job = r.hgetall(JOB_KEY % job_id)
+    if not job:
+        return None
+    job = {key.decode(): value for key, value in job.items()}
+
+    result = {"job_id": job_id, "type": job["type"].decode(), "status": job["status"].decode()}
+    for timestamp in ["created", "started", "finished"]:
+        if timestamp in job:
+            result[timestamp] = float(job[timestamp])
+    if "result" in job:
+        result["result"] = json.loads(zlib.decompress(job["result"]))
+    if "error" in job:
+        result["error"] = job["error"].decode()
+    return result
+
+
+def _set_job(job_id: str, mapping: dict) -> None:
+    """ Updates the job and restarts its expiration. """
+
+    with RedisConnection() as r:
+        pipe = r.pipeline()
+        pipe.hset(JOB_KEY % job_id, mapping=mapping)
+        pipe.expire(JOB_KEY % job_id, configuration.get('jobs', {}).get('result_ttl', 3600))
+        pipe.execute()
+
+
+def run_job(job_id: str, client: str) -> None:
+    """ Runs the job and stores its result. The client's count of jobs is decremented however the job ends. """
+
+    try:
+        with RedisConnection() as r:
+            job = r.hmget(JOB_KEY % job_id, ["type", "argument"])
+        if not job[0]:
+            logging.warning("Job %s expired before it could run.", job_id)
+            return
+        job_type, argument = [x.decode() for x in job]
+
+        _set_job(job_id, {"status": "running", "started": time.time()})
+        try:
+            result = JOB_TYPES[job_type](argument)
+            _set_job(job_id, {"status": "finished", "finished": time.time(),
+                              "result": zlib.compress(json.dumps(result, separators=(',', ':')).encode())})
+        except APIException as error:
+            _set_job(job_id, {"status": "failed", "finished": time.time(), "error": str(error.message)})
+        except Exception:
+            logging.critical("Job %s (%s %s) failed:\n\n%s", job_id, job_type, argument, traceback.format_exc())
+            _set_job(job_id, {"status": "failed", "finished": time.time(),
+                              "error": "The job failed because of a server error."})
+    finally:
+        with RedisConnection() as r:
+            # The count may have expired while the job ran
+            if r.decr(JOB_CLIENT_KEY % client) < 0:
+                r.delete(JOB_CLIENT_KEY % client)
+
+
+def run_jobs() -> None:
+    """ Runs jobs from the queue forever. """
+
+    while True:
+        try:
+            with RedisConnection() as r:
+                queued = r.blpop(JOB_QUEUE_KEY, timeout=5)
+            if queued:
+                job_id, _, client = queued[1].decode().partition(":")
+                run_job(job_id, client)
+        except Exception:
+            # Most likely Redis is unreachable or failing over, so wait a bit before trying again
+            logging.exception("Error while running jobs.")
+            time.sleep(5)
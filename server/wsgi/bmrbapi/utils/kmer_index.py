@@ -0,0 +1,69 @@
+""" A k-mer inverted index of the sequences in a FASTA library, for picking the sequences that could match a query
+before running fasta36 on them.
+
+The reloader builds the index of each library along with the library (see reloaders/fasta.py). For each k-mer,
+the index has the (0 based) positions of the sequences containing it. It also has the residues of all the sequences,
+so the candidate sequences can be written out without reading the library. The files are memory mapped, so they
+are only in memory once per server. """
+
+import os
+from typing import Optional
+
+import numpy as np
+
+KMER_LENGTH = 3
+ALPHABET_SIZE = 26
+
+
+def kmer_codes(sequence: bytes) -> np.ndarray:
+    """ Returns the sorted unique codes of the k-mers in the sequence. K-mers with anything other than the letters A
+    to Z aren't indexed. """
+
+    residues = np.frombuffer(sequence.upper(), dtype=np.uint8).astype(np.int64) - ord('A')
+    if len(residues) < KMER_LENGTH:
+        return np.zeros(0, dtype=np.int64)
+    valid = (residues >= 0) & (residues < ALPHABET_SIZE)
+
+    codes = np.zeros(len(residues) - KMER_LENGTH + 1, dtype=np.int64)
+    usable = np.ones(len(codes), dtype=bool)
+    for offset in range(KMER_LENGTH):
+        codes = codes * ALPHABET_SIZE + residues[offset:offset + len(codes)]
+        usable &= valid[offset:offset + len(codes)]
+    return np.unique(codes[usable])
+
+
+class KmerIndex:
+    """ The loaded k-mer index of one FASTA library. """
+
+    def __init__(self, path: str, a_type: str):
+        self.kmer_offsets = np.load(os.path.join(path, "%s.kmer_offsets.npy" % a_type), mmap_mode='r')
+        self.kmer_sequences = np.load(os.path.join(path, "%s.kmer_sequences.npy" % a_type), mmap_mode='r')
+        self.residue_offsets = np.load(os.path.join(path, "%s.residue_offsets.npy" % a_type), mmap_mode='r')
+        self.residues = np.load(os.path.join(path, "%s.residues.npy" % a_type), mmap_mode='r')
+
+    def __len__(self) -> int:
+        return len(self.residue_offsets) - 1
+
+    def candidates(self, query: str, min_shared: int = 1) -> np.ndarray:
+        """ Returns the positions of the sequences which share at least min_shared k-mers with the query. """
+
+        codes = kmer_codes(query.encode())
+        postings = [self.kmer_sequences[self.kmer_offsets[code]:self.kmer_offsets[code + 1]] for code in codes]
+        if not postings:
+            return np.zeros(0, dtype=np.int64)
+        shared = np.bincount(np.concatenate(postings), minlength=len(self))
+        return np.flatnonzero(shared >= min_shared)
+
+    def sequence(self, position: int) -> str:
+        """ Returns the residues of the sequence at the position. """
+
+        return self.residues[self.residue_offsets[position]:self.residue_offsets[position + 1]].tobytes().decode()
+
+
+def load_kmer_index(path: str, a_type: str) -> Optional[KmerIndex]:
+    """ Returns the k-mer index of the library, or None if it wasn't built. """
+
+    try:
+        return KmerIndex(path, a_type)
+    except OSError:
+        return None
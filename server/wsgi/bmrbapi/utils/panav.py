@@ -0,0 +1,196 @@
+""" Runs PANAV on chemical shift loops.
+
+Starting a JVM for every chemical shift loop takes longer than PANAV itself, so each process keeps a pool of
+long-lived JVMs running the worker in panav_worker/ (compiled by its Makefile), which read one loop after another
+from stdin and write what PANAV printed to stdout. Workers are replaced after panav.max_jobs loops in case PANAV
+holds on to memory between runs, and killed (and replaced) if a loop takes longer than panav.timeout seconds to send,
+run, or read back. If the worker hasn't been compiled (or panav.workers is 0) a new JVM is started for each loop
+instead. """
+
+import atexit
+import os
+import queue
+import select
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Optional
+
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.querymod import SUBMODULE_DIR
+
+PANAV_JAR = os.path.join(SUBMODULE_DIR, "panav", "panav.jar")
+WORKER_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), "panav_worker")
+
+_pool: Optional['_PanavPool'] = None
+_pool_lock = threading.Lock()
+_pool_pid = os.getpid()
+
+
+class _PanavWorker:
+    """ One JVM running the PANAV worker. """
+
+    def __init__(self):
+        # The worker keeps its temporary file in here, so it can be removed even if the worker has to be killed
+        self.directory = tempfile.mkdtemp(prefix="panav.", dir="/dev/shm")
+        self.process = subprocess.Popen(["java", "-cp", "%s:%s" % (PANAV_JAR, WORKER_DIRECTORY), "PanavWorker",
+                                         self.directory, PANAV_JAR], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, bufsize=0)
+        # So that sending a loop to a stuck worker can't block past the deadline once the pipe is full
+        os.set_blocking(self.process.stdin.fileno(), False)
+        self.jobs = 0
+        self._buffer = b""
+
+    def run(self, loop: bytes, timeout: float) -> bytes:
+        """ Returns what PANAV printed for the loop. Raises CalledProcessError if PANAV failed, TimeoutExpired if
+        it took too long, and OSError if the worker died. """
+
+        self.jobs += 1
+        deadline = time.monotonic() + timeout
+        self._write(b"%d\n" % len(loop) + loop, deadline, timeout)
+
+        while b"\n" not in self._buffer:
+            self._read(deadline, timeout)
+        header, self._buffer = self._buffer.split(b"\n", 1)
+        status, length = header.split()
+        while len(self._buffer) < int(length):
+            self._read(deadline, timeout)
+        output, self._buffer = self._buffer[:int(length)], self._buffer[int(length):]
+
+        if status != b"OK":
+            raise subprocess.CalledProcessError(1, self.process.args, output=output)
+        return output
+
+    def _write(self, data: bytes, deadline: float, timeout: float) -> None:
+        """ Writes the data to the worker, waiting until the deadline for it to read what doesn't fit in the pipe. """
+
+        data = memoryview(data)
+        while data:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not select.select([], [self.process.stdin], [], remaining)[1]:
+                raise subprocess.TimeoutExpired(self.process.args, timeout)
+            try:
+                data = data[os.write(self.process.stdin.fileno(), data):]
+            except BlockingIOError:
+                pass
+
+    def _read(self, deadline: float, timeout: float) -> None:
+        """ Adds what the worker has written to the buffer, waiting until the deadline for it to write something. """
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select.select([self.process.stdout], [], [], remaining)[0]:
+            raise subprocess.TimeoutExpired(self.process.args, timeout)
+        chunk = os.read(self.process.stdout.fileno(), 65536)
+        if not chunk:
+            raise OSError("The PANAV worker exited unexpectedly.")
+        self._buffer += chunk
+
+    def close(self, kill: bool = False) -> None:
+        """ Ends the worker and removes its temporary file. Closing its stdin lets it exit normally. It is killed
+        if it doesn't exit in time, or right away with kill (when it is stuck or out of step). """
+
+        try:
+            self.process.stdin.close()
+        except OSError:
+            pass
+        if not kill:
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                kill = True
+        if kill:
+            self.process.kill()
+            self.process.wait()
+        self.process.stdout.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class _PanavPool:
+    """ A per-process pool of PANAV workers. Workers are started when they are first needed. """
+
+    def __init__(self):
+        settings = configuration.get('panav', {})
+
+        self._max_jobs: int = settings.get('max_jobs', 200)
+        self._timeout: float = settings.get('timeout', 60)
+        self._slots = threading.BoundedSemaphore(settings.get('workers', 2))
+        self._idle: queue.LifoQueue = queue.LifoQueue()
+        atexit.register(self.close)
+
+    def run(self, loop: bytes) -> bytes:
+        """ Runs PANAV on the loop with an idle worker, waiting up to panav.timeout seconds for one to free up. """
+
+        if not self._slots.acquire(timeout=self._timeout):
+            raise subprocess.TimeoutExpired(["PanavWorker"], self._timeout)
+
+        try:
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                worker = _PanavWorker()
+
+            try:
+                output = worker.run(loop, self._timeout)
+            except subprocess.CalledProcessError:
+                self._recycle(worker, worker.jobs >= self._max_jobs)
+                raise
+            except (subprocess.TimeoutExpired, OSError, ValueError):
+                # The worker is stuck, dead, or out of step with us, so start its replacement right away
+                worker.close(kill=True)
+                self._idle.put(_PanavWorker())
+                raise
+            self._recycle(worker, worker.jobs >= self._max_jobs)
+            return output
+        finally:
+            self._slots.release()
+
+    def _recycle(self, worker: _PanavWorker, discard: bool) -> None:
+        if discard:
+            worker.close()
+        else:
+            self._idle.put(worker)
+
+    def close(self) -> None:
+        """ Ends the idle workers. """
+
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def panav_workers() -> int:
+    """ Returns how many loops can be run through PANAV at the same time by this process. """
+
+    if not os.path.exists(os.path.join(WORKER_DIRECTORY, "PanavWorker.class")):
+        return 1
+    return max(1, configuration.get('panav', {}).get('workers', 2))
+
+
+def run_panav(loop: bytes) -> bytes:
+    """ Returns what PANAV printed for the NMR-STAR chemical shift loop. Raises CalledProcessError if PANAV failed
+    and TimeoutExpired if it took longer than panav.timeout seconds. """
+
+    global _pool, _pool_pid
+
+    settings = configuration.get('panav', {})
+    if not settings.get('workers', 2) or not os.path.exists(os.path.join(WORKER_DIRECTORY, "PanavWorker.class")):
+        with tempfile.NamedTemporaryFile(dir="/dev/shm") as chem_shifts:
+            chem_shifts.write(loop)
+            chem_shifts.flush()
+            return subprocess.check_output(["java", "-cp", PANAV_JAR, "CLI", "-f", "star", "-i", chem_shifts.name],
+                                           stderr=subprocess.STDOUT, timeout=settings.get('timeout', 60))
+
+    with _pool_lock:
+        # The workers' pipes can't be shared across a fork, so a child process starts its own
+        if _pool is None or _pool_pid != os.getpid():
+            _pool, _pool_pid = _PanavPool(), os.getpid()
+        pool = _pool
+    try:
+        return pool.run(loop)
+    except OSError:
+        # The worker died, so try once more with a new one
+        return pool.run(loop)
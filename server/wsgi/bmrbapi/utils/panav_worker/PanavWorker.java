@@ -0,0 +1,113 @@
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.lang.reflect.InvocationTargetException;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.nio.charset.StandardCharsets;
+import java.security.Permission;
+
+/**
+ * Runs PANAV (the CLI class of panav.jar) on one chemical shift loop after another in the same JVM, so the JVM
+ * start up is only paid once. Used by bmrbapi/utils/panav.py.
+ *
+ * Each request on stdin is the length of a NMR-STAR chemical shift loop in bytes on its own line, followed by the
+ * loop. Each response on stdout is "OK" or "ERROR", a space, and the length of the output in bytes on its own line,
+ * followed by what PANAV printed (or the error).
+ *
+ * PANAV keeps state in static fields, so each loop is run with the PANAV classes loaded by a new class loader. That
+ * way nothing one loop leaves behind can change the result for the next, while the JVM itself is still reused.
+ *
+ * Arguments: the directory for the temporary loop file, and the path of panav.jar.
+ */
+public class PanavWorker {
+
+    /** PANAV calls System.exit() when it fails, which would otherwise end the worker. */
+    private static class ExitException extends SecurityException {
+        ExitException(int status) {
+            super("PANAV exited with status " + status);
+        }
+    }
+
+    public static void main(String[] args) throws IOException {
+        OutputStream responses = new BufferedOutputStream(new FileOutputStream(FileDescriptor.out));
+        DataInputStream requests = new DataInputStream(System.in);
+
+        System.setSecurityManager(new SecurityManager() {
+            @Override
+            public void checkPermission(Permission permission) {
+            }
+
+            @Override
+            public void checkExit(int status) {
+                throw new ExitException(status);
+            }
+        });
+
+        File loopFile = File.createTempFile("panav", ".str", new File(args.length > 0 ? args[0] : "/tmp"));
+        loopFile.deleteOnExit();
+        URL[] panavJar = {new File(args.length > 1 ? args[1] : "panav.jar").toURI().toURL()};
+
+        String header;
+        while ((header = readLine(requests)) != null) {
+            byte[] loop = new byte[Integer.parseInt(header.trim())];
+            requests.readFully(loop);
+
+            ByteArrayOutputStream output = new ByteArrayOutputStream();
+            PrintStream capture = new PrintStream(output, true);
+            String status = "OK";
+            System.setOut(capture);
+            System.setErr(capture);
+            try {
+                try (FileOutputStream loopStream = new FileOutputStream(loopFile)) {
+                    loopStream.write(loop);
+                }
+                runPanav(panavJar, new String[]{"-f", "star", "-i", loopFile.getPath()});
+            } catch (Throwable error) {
+                status = "ERROR";
+                capture.println(error.toString());
+            }
+            capture.flush();
+
+            byte[] result = output.toByteArray();
+            responses.write((status + " " + result.length + "\n").getBytes(StandardCharsets.US_ASCII));
+            responses.write(result);
+            responses.flush();
+        }
+    }
+
+    /**
+     * Runs the main method of PANAV's CLI class, loaded from the jar by a new class loader so that its static state
+     * starts out the same every time. The parent is the system loader's parent, which doesn't see panav.jar.
+     */
+    private static void runPanav(URL[] panavJar, String[] arguments) throws Throwable {
+        ClassLoader contextLoader = Thread.currentThread().getContextClassLoader();
+        try (URLClassLoader loader = new URLClassLoader(panavJar, ClassLoader.getSystemClassLoader().getParent())) {
+            Thread.currentThread().setContextClassLoader(loader);
+            loader.loadClass("CLI").getMethod("main", String[].class).invoke(null, (Object) arguments);
+        } catch (InvocationTargetException error) {
+            throw error.getCause();
+        } finally {
+            Thread.currentThread().setContextClassLoader(contextLoader);
+        }
+    }
+
+    /** Reads a line from the stream, or returns null at the end of the stream. */
+    private static String readLine(DataInputStream stream) throws IOException {
+        StringBuilder line = new StringBuilder();
+        int character;
+        while ((character = stream.read()) != '\n') {
+            if (character == -1) {
+                return line.length() == 0 ? null : line.toString();
+            }
+            line.append((char) character);
+        }
+        return line.toString();
+    }
+}
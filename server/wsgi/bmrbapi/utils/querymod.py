@@ -16,10 +16,13 @@ from psycopg2 import ProgrammingError
 from psycopg2.extensions import AsIs
 from psycopg2.extras import DictCursor
 from redis import StrictRedis
+from redis.client import Pipeline
 
 from bmrbapi.exceptions import RequestException, ServerException
+from bmrbapi.utils.compression import decompress_entry, entry_to_zlib, wrap_compressed
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+from bmrbapi.utils.entry_cache import entry_cache
 
 # Determine submodules folder
 _QUERYMOD_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -29,26 +32,72 @@ SUBMODULE_DIR = os.path.join(os.path.dirname(_QUERYMOD_DIR), "submodules")
 logging.basicConfig()
 
 
-def locate_entry(entry_id: str, r_conn: StrictRedis) -> str:
+def get_entry_key(entry_id: str) -> str:
     """ Determines what the Redis key is for an entry given the database
-    provided."""
+    provided, without contacting Redis."""
 
     if entry_id.startswith("bm"):
         return "metabolomics:entry:%s" % entry_id
     elif entry_id.startswith("chemcomp"):
         return "chemcomps:entry:%s" % entry_id
     elif len(entry_id) == 32:
-        entry_loc = "uploaded:entry:%s" % entry_id
-
-        # Update the expiration time if the entry is used
-        if r_conn.exists(entry_loc):
-            r_conn.expire(entry_loc, configuration['redis']['upload_timeout'])
-
-        return entry_loc
+        return "uploaded:entry:%s" % entry_id
     else:
         return "macromolecules:entry:%s" % entry_id
 
 
+def get_nmrstar_key(entry_id: str) -> str:
+    """ Determines what the Redis key is for the pre-rendered NMR-STAR of an
+    entry, without contacting Redis."""
+
+    return get_entry_key(entry_id).replace(":entry:", ":nmrstar:", 1)
+
+
+def get_entry_index_key(entry_id: str) -> str:
+    """ Determines what the Redis key is for the saveframe index of an
+    entry, without contacting Redis."""
+
+    return get_entry_key(entry_id).replace(":entry:", ":entry_index:", 1)
+
+
+def get_entry_info_key(entry_id: str) -> str:
+    """ Determines what the Redis key is for the information hash of an
+    entry, without contacting Redis."""
+
+    return get_entry_key(entry_id).replace(":entry:", ":entry_info:", 1)
+
+
+def make_entry_index(entry: pynmrstar.Entry) -> dict:
+    """ Creates the contents of the saveframe index hash of an entry. The "index" field lists what each
+    saveframe contains, and the "frame:<name>" fields hold the saveframes themselves, all as zlib compressed JSON.
+    """
+
+    index = {'entry_id': entry.entry_id, 'saveframes': []}
+    entry_index = {}
+    for frame in entry.frame_list:
+        category = frame.get_tag("sf_category")
+        index['saveframes'].append([frame.name, category[0] if category else None,
+                                    frame.tag_prefix.lower() if frame.tag_prefix else None,
+                                    [loop.category.lower() for loop in frame.loops if loop.category]])
+        entry_index["frame:%s" % frame.name] = zlib.compress(frame.get_json().encode())
+    entry_index['index'] = zlib.compress(json.dumps(index).encode())
+
+    return entry_index
+
+
+def locate_entry(entry_id: str, r_conn: StrictRedis) -> str:
+    """ Determines what the Redis key is for an entry given the database
+    provided. Uploaded entries have their expiration time refreshed."""
+
+    entry_loc = get_entry_key(entry_id)
+
+    # Update the expiration time if the entry is used (this does nothing if the key doesn't exist)
+    if entry_loc.startswith("uploaded:"):
+        r_conn.expire(entry_loc, configuration['redis']['upload_timeout'])
+
+    return entry_loc
+
+
 def get_database_from_entry_id(entry_id: str) -> str:
     """ Returns the appropriate database to inspect based on ID."""
 
@@ -58,6 +107,60 @@ def get_database_from_entry_id(entry_id: str) -> str:
         return "macromolecules"
 
 
+_ENTRY_FORMATS = {"zlib", "json", "dict", "object", "nmrstar", "rawnmrstar"}
+
+
+def _decode_entry(entry_id: str, entry: bytes, format_: str,
+                  version: Optional[str] = None) -> Union[bytes, str, dict, pynmrstar.Entry]:
+    """ Converts an entry as stored in Redis (compressed JSON) to the requested format. If a data version
+    is provided, parsed entry objects are added to the entry cache under that version. """
+
+    # Return the compressed entry
+    if format_ == "zlib":
+        return entry_to_zlib(entry)
+
+    # Uncompress the entry into serialized JSON
+    entry_json = decompress_entry(entry)
+    if format_ == "json":
+        return entry_json
+
+    # Parse the JSON into python dict
+    entry = json.loads(entry_json)
+    if format_ == "dict":
+        return entry
+
+    # Parse the dict into object
+    entry = pynmrstar.Entry.from_json(entry)
+    if format_ == "object":
+        if version:
+            entry_cache.put(entry_id, version, entry, len(entry_json))
+        return entry
+
+    # Return NMR-STAR
+    return str(entry)
+
+
+def _get_entry_versions(r_conn: StrictRedis, keys: List[str]) -> List[Optional[str]]:
+    """ Returns the data version of each of the entries: the update time of the database the entry is in. Uploaded
+    entries can't change, so they all share one version as long as they exist (and their expiration time is
+    refreshed). None is returned for entries without a known version. """
+
+    pipe = r_conn.pipeline(transaction=False)
+    for key in keys:
+        if key.startswith("uploaded:"):
+            pipe.expire(key, configuration['redis']['upload_timeout'])
+        else:
+            pipe.hget("%s:meta" % key.split(":")[0], "update_time")
+
+    versions = []
+    for key, result in zip(keys, pipe.execute()):
+        if key.startswith("uploaded:"):
+            versions.append("uploaded" if result else None)
+        else:
+            versions.append(result.decode() if result else None)
+    return versions
+
+
 def get_valid_entries_from_redis(search_ids: Union[str, list],
                                  format_: str = "object",
                                  max_results: int = 500) -> \
@@ -65,12 +168,19 @@ def get_valid_entries_from_redis(search_ids: Union[str, list],
     """ Given a list of entries, yield them as the appropriate type as determined by the "format_"
     variable. Throw an exception if any of the provided IDs do not exist.
 
+    Entries are fetched from Redis in chunks (one round trip per chunk) and decoded as they are
+    yielded, in the order requested. The exception for a missing ID is raised when that ID is
+    reached, after the entries before it were yielded.
+
+    Entry objects come from the per-process entry cache when the cached copy is from the current
+    data version. They are shared with other requests - do not modify them.
+
     Valid entry formats:
     nmrstar: Return the entry as NMR-STAR text
     json: Return the entry in serialized JSON format
     dict: Return the entry JSON data as a python dict
     object: Return the PyNMR-STAR object for the entry
-    zlib: Return the entry straight from the DB as zlib compressed JSON
+    zlib: Return the entry as zlib compressed JSON (straight from the DB unless stored with another codec)
     """
 
     # Wrap the IDs in a list if necessary
@@ -82,45 +192,143 @@ def get_valid_entries_from_redis(search_ids: Union[str, list],
         raise RequestException('Too many IDs queried. Please query %s or fewer entries at a time. You attempted to '
                                'query %d IDs.' % (max_results, len(search_ids)))
 
+    if format_ not in _ENTRY_FORMATS:
+        raise RequestException("Invalid format: %s." % format_)
+
+    chunk_size = configuration['redis'].get('fetch_chunk_size', 100)
+
     # Get the connection to redis if needed
     with RedisConnection() as r_conn:
 
         # Go through the IDs
-        for entry_id in search_ids:
+        for chunk_start in range(0, len(search_ids), chunk_size):
+            chunk = search_ids[chunk_start:chunk_start + chunk_size]
+            keys = [get_entry_key(entry_id) for entry_id in chunk]
+
+            # See which entries we already have parsed
+            versions: List[Optional[str]] = [None] * len(chunk)
+            cached: List[Optional[pynmrstar.Entry]] = [None] * len(chunk)
+            if format_ == "object":
+                versions = _get_entry_versions(r_conn, keys)
+                cached = [entry_cache.get(entry_id, version) if version else None
+                          for entry_id, version in zip(chunk, versions)]
+
+            # Fetch the rest of the chunk at once, refreshing the expiration time of any uploaded entries
+            entries: List[Optional[bytes]] = [None] * len(chunk)
+            to_fetch = [pos for pos, hit in enumerate(cached) if hit is None]
+            if to_fetch:
+                pipe = r_conn.pipeline(transaction=False)
+                if format_ != "object":
+                    for key in keys:
+                        if key.startswith("uploaded:"):
+                            pipe.expire(key, configuration['redis']['upload_timeout'])
+                pipe.mget([keys[pos] for pos in to_fetch])
+                for pos, entry in zip(to_fetch, pipe.execute()[-1]):
+                    entries[pos] = entry
+
+            for pos, entry_id in enumerate(chunk):
+                if cached[pos] is not None:
+                    yield entry_id, cached[pos]
+                elif not entries[pos]:
+                    raise RequestException("Entry '%s' does not exist in the public database." % entry_id,
+                                           status_code=404)
+                else:
+                    yield entry_id, _decode_entry(entry_id, entries[pos], format_, versions[pos])
 
-            entry = r_conn.get(locate_entry(entry_id, r_conn=r_conn))
 
-            # See if it is in redis
-            if entry:
-                # Return the compressed entry
-                if format_ == "zlib":
-                    yield entry_id, entry
+def get_entry_hash(entry_id: str) -> Optional[str]:
+    """ Returns the hash of the entry as stored in Redis, which changes whenever the stored entry does, without
+    fetching the entry. Returns None if the reloader didn't store one. """
 
-                else:
-                    # Uncompress the zlib into serialized JSON
-                    entry = zlib.decompress(entry)
-                    if format_ == "json":
-                        yield entry_id, entry
-                    else:
-                        # Parse the JSON into python dict
-                        entry = json.loads(entry)
-                        if format_ == "dict":
-                            yield entry_id, entry
-                        else:
-                            # Parse the dict into object
-                            entry = pynmrstar.Entry.from_json(entry)
-                            if format_ == "object":
-                                yield entry_id, entry
-                            else:
-                                # Return NMR-STAR
-                                if format_ == "nmrstar" or format_ == "rawnmrstar":
-                                    yield entry_id, str(entry)
-
-                                # Unknown format
-                                else:
-                                    raise RequestException("Invalid format: %s." % format_)
-            else:
-                raise RequestException("Entry '%s' does not exist in the public database." % entry_id, status_code=404)
+    # Uploaded entries are named by the hash of their contents
+    if entry_id and len(entry_id) == 32:
+        return entry_id
+
+    with RedisConnection() as r_conn:
+        entry_hash = r_conn.hget(get_entry_info_key(entry_id), "hash")
+    return entry_hash.decode() if entry_hash else None
+
+
+def get_data_versions(r_conn: StrictRedis, pipe: Optional[Pipeline] = None) -> List[Optional[str]]:
+    """ Returns the update time of each database. Together they change whenever any database is reloaded, so they
+    can be used as the version of anything derived from the databases.
+
+    If a pipeline is given, the commands already queued on it are sent along with the lookups (and their results
+    are discarded). """
+
+    if pipe is None:
+        pipe = r_conn.pipeline(transaction=False)
+    databases = ['metabolomics', 'macromolecules', 'chemcomps', 'combined']
+    for database in databases:
+        pipe.hget("%s:meta" % database, "update_time")
+    return [x.decode() if x else None for x in pipe.execute()[-len(databases):]]
+
+
+def get_nmrstar_from_redis(entry_id: str) -> Optional[bytes]:
+    """ Returns the zlib compressed NMR-STAR text of an entry as rendered by the reloader, or None
+    if the reloader didn't store a rendering of the entry. """
+
+    with RedisConnection() as r_conn:
+        return r_conn.get(get_nmrstar_key(entry_id))
+
+
+def get_wrapped_json_from_redis(entry_id: str) -> Optional[List[bytes]]:
+    """ Returns the zlib stream of the entry as JSON, wrapped as {"<entry_id>": <entry>}, made from the stored entry
+    without decompressing it. The stream is returned in pieces, to avoid joining them. Returns None if the entry
+    wasn't stored by a reloader that makes that possible. """
+
+    if entry_id and len(entry_id) == 32:
+        return None
+
+    with RedisConnection() as r_conn:
+        pipe = r_conn.pipeline()
+        pipe.get(get_entry_key(entry_id))
+        pipe.hget(get_entry_info_key(entry_id), "json_length")
+        compressed, length = pipe.execute()
+
+    if compressed is None or length is None:
+        return None
+    return wrap_compressed(('{"%s": ' % entry_id).encode(), compressed, int(length), b"}")
+
+
+def get_partial_entry_from_redis(entry_id: str,
+                                 saveframe_names: List[str] = None,
+                                 saveframe_categories: List[str] = None,
+                                 loop_categories: List[str] = None,
+                                 tags: List[str] = None) -> Tuple[str, pynmrstar.Entry]:
+    """ Returns an entry containing only the saveframes needed to look up the given saveframes, loops, or tags,
+    so that the same pynmrstar methods can be used on it as on the full entry. Only those saveframes are fetched
+    from Redis and parsed.
+
+    Falls back to the full entry if the reloader didn't store a saveframe index for the entry, or if the entry
+    was reloaded while it was being read. """
+
+    saveframe_names = set(saveframe_names or [])
+    saveframe_categories = set(saveframe_categories or [])
+    loop_categories = {pynmrstar.utils.format_category(x).lower() for x in loop_categories or []}
+    tag_categories = {pynmrstar.utils.format_category(x).lower() for x in tags or []}
+
+    with RedisConnection() as r_conn:
+        index_key = get_entry_index_key(entry_id)
+        index = r_conn.hget(index_key, "index")
+
+        if index is not None:
+            index = json.loads(zlib.decompress(index))
+            names = []
+            for name, category, tag_prefix, loops in index['saveframes']:
+                if (name in saveframe_names or category in saveframe_categories or
+                        loop_categories.intersection(loops) or
+                        tag_prefix in tag_categories or tag_categories.intersection(loops)):
+                    names.append(name)
+
+            frames = r_conn.hmget(index_key, ["frame:%s" % name for name in names]) if names else []
+            if None not in frames:
+                entry = pynmrstar.Entry.from_scratch(index['entry_id'])
+                for frame in frames:
+                    entry.add_saveframe(pynmrstar.Saveframe.from_json(json.loads(zlib.decompress(frame))))
+                return entry_id, entry
+
+    return next(get_valid_entries_from_redis(entry_id))
 
 
 def wrap_it_up(item: all) -> AsIs:
@@ -0,0 +1,86 @@
+""" An in-memory index of the assigned chemical shifts in a database, for finding the shift lists with shifts close
+to a set of peaks without querying Postgres.
+
+The reloader builds the index of each database into a directory of numpy files (see reloaders/shift_index.py). The
+workers memory map those files, so the index is only in memory once per server. For each atom type, the index has
+the shift values sorted as floats, the matching shift lists, and the values as they are written in the entry. """
+
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from bmrbapi.utils.configuration import configuration
+
+ATOM_TYPES = ['C', 'N', 'H']
+
+_indexes: Dict[str, 'ShiftIndex'] = {}
+
+
+class ShiftIndex:
+    """ The loaded shift index of one database. """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.list_entries = np.load(os.path.join(path, "list_entries.npy"))
+        self.list_ids = np.load(os.path.join(path, "list_ids.npy"))
+        self.values = {}
+        self.lists = {}
+        self.strings = {}
+        for atom_type in ATOM_TYPES:
+            self.values[atom_type] = np.load(os.path.join(path, "%s_values.npy" % atom_type), mmap_mode='r')
+            self.lists[atom_type] = np.load(os.path.join(path, "%s_lists.npy" % atom_type), mmap_mode='r')
+            self.strings[atom_type] = np.load(os.path.join(path, "%s_strings.npy" % atom_type), mmap_mode='r')
+
+    def find_shift_lists(self, shifts: List[float],
+                         thresholds: Dict[str, float]) -> List[Tuple[str, str, List[Tuple[str, str]]]]:
+        """ Returns the shift lists with at least one shift within the threshold for its atom type of one of the
+        given shifts, as (entry ID, list ID, the matching [value, atom type] pairs). This matches the shifts selected
+        by the SQL of multiple_shift_search: the comparisons are done on the same floats, and the pairs are
+        distinct and sorted by their "value,atom type" text. Lists with more distinct matching values come first.
+
+        The values are float64 rather than float32, since the SQL compares them as float8. With float32 a value just
+        outside a threshold can round onto it and match. """
+
+        shifts = np.array(shifts, dtype=np.float64)
+        matches: Dict[int, List[str]] = {}
+
+        for atom_type in ATOM_TYPES:
+            values = self.values[atom_type]
+            starts = np.searchsorted(values, shifts - thresholds[atom_type], side='left')
+            ends = np.searchsorted(values, shifts + thresholds[atom_type], side='right')
+            windows = [np.arange(start, end) for start, end in zip(starts, ends) if end > start]
+            if not windows:
+                continue
+
+            positions = np.unique(np.concatenate(windows))
+            for list_index, value in zip(self.lists[atom_type][positions].tolist(),
+                                         self.strings[atom_type][positions].tolist()):
+                matches.setdefault(list_index, []).append("%s,%s" % (value.decode(), atom_type))
+
+        results = []
+        # Like count(DISTINCT "Val"), the same value matched for two atom types only counts once
+        for list_index, pairs in sorted(matches.items(), key=lambda x: -len({float(pair.split(',')[0])
+                                                                            for pair in x[1]})):
+            results.append((str(self.list_entries[list_index]), str(self.list_ids[list_index]),
+                            [tuple(pair.split(',')) for pair in sorted(pairs)]))
+        return results
+
+
+def get_shift_index(database: str) -> Optional[ShiftIndex]:
+    """ Returns the shift index of a database, or None if the reloader hasn't built one. The index is loaded once per
+    process, and loaded again when the reloader replaces it. """
+
+    directory = configuration.get('shift_index_directory')
+    if not directory:
+        return None
+
+    # The reloader swaps a symbolic link to the newest version of the index
+    path = os.path.realpath(os.path.join(directory, database))
+    if database not in _indexes or _indexes[database].path != path:
+        try:
+            _indexes[database] = ShiftIndex(path)
+        except OSError:
+            _indexes.pop(database, None)
+            return None
+    return _indexes[database]
@@ -0,0 +1,153 @@
+""" Scoring of the shift lists found by multiple_shift_search against the queried peaks.
+
+Every shift list gets a Combined_offset, the sum over its shifts of the distance to the closest peak, and a count of
+Shifts_matched, the number of peaks whose closest shift is within the threshold for that shift's atom type. The
+lists are then ranked by the number of matched peaks, then by offset.
+
+The shifts and peaks are decimals, and the results have always been computed exactly. To compute them with numpy
+but still exactly, the values are converted to integers by scaling them by a power of ten that makes all of them
+whole numbers. When that isn't possible without overflowing, the original Decimal implementation is used. """
+
+from decimal import Decimal, Inexact, localcontext
+from fractions import Fraction
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Stay well away from overflowing int64 when summing the offsets of a list
+_MAX_SCALED = 2 ** 62
+_USUAL_PLACES = 3
+_MAX_PLACES = 9
+# Limits the size of the (lists, shifts, peaks) arrays
+_CHUNK_ELEMENTS = 2 ** 21
+
+
+def _scale(values: List[Decimal], places: int, longest: int) -> Optional[List[int]]:
+    """ Returns the values multiplied by 10 ** places as integers, or None if that doesn't make all of them whole
+    numbers, or if they could overflow an int64 when summing up to longest + 1 of them. """
+
+    with localcontext() as context:
+        context.traps[Inexact] = True
+        try:
+            scaled = [int(x.scaleb(places).to_integral_exact()) for x in values]
+        except (Inexact, OverflowError, ValueError):
+            return None
+
+    if max(abs(min(scaled)), abs(max(scaled))) * 2 * (longest + 1) >= _MAX_SCALED:
+        return None
+    return scaled
+
+
+def score_shift_lists_decimal(shift_lists: List[dict], peaks: List[Decimal],
+                              thresholds: Dict[str, float]) -> List[dict]:
+    """ Sets Combined_offset and Shifts_matched on each of the shift lists, and returns them ranked. This is the
+    original implementation, using Decimal. """
+
+    def get_closest(collection, number):
+        """ Returns the closest number from a list of numbers. """
+        return min(collection, key=lambda _: abs(_ - number))
+
+    def get_closest_by_atom(collection: dict,
+                            shift_value: Decimal) -> dict:
+        """ Returns the closest [shift,atom_name] pair from the options. """
+
+        # Start with impossibly bad peak of the correct atom type, in case no matches for this peak exist
+        best_match: dict = {'Shift': Decimal('inf'), 'Atom_type': None}
+        for item in collection:
+            if abs(item['Shift'] - shift_value) < best_match['Shift']:
+                best_match = {'Shift': item['Shift'], 'Atom_type': item['Atom_type']}
+        return best_match
+
+    def get_sort_key(res) -> [int, Decimal, str]:
+        """ Returns the sort key. """
+
+        key: Decimal = Decimal(0)
+
+        # Add the difference of all the shifts
+        for item in res['Val']:
+            key += abs(get_closest(peaks, item['Shift']) - item['Shift'])
+        res['Combined_offset'] = round(key, 3)
+
+        # Determine how many of the queried shifts were matched
+        num_match = 0
+        for check_peak in peaks:
+            closest = get_closest_by_atom(res['Val'], check_peak)
+            if abs(check_peak - closest['Shift']) <= thresholds[closest['Atom_type']]:
+                num_match += 1
+        res['Shifts_matched'] = num_match
+
+        return -num_match, key, res['Entry_ID']
+
+    return sorted(shift_lists, key=get_sort_key)
+
+
+def score_shift_lists(shift_lists: List[dict], peaks: List[Decimal], thresholds: Dict[str, float]) -> List[dict]:
+    """ Sets Combined_offset and Shifts_matched on each of the shift lists, and returns them ranked. The results are
+    exactly those of score_shift_lists_decimal(), including its choice of the closest shift to each peak: it keeps
+    the last shift, in list order, that is closer to the peak than the value of the shift kept before it. """
+
+    if not shift_lists or not peaks or any(not x['Val'] for x in shift_lists):
+        return score_shift_lists_decimal(shift_lists, peaks, thresholds)
+
+    shifts = [y['Shift'] for x in shift_lists for y in x['Val']]
+    lengths = np.array([len(x['Val']) for x in shift_lists])
+    longest = int(lengths.max())
+
+    atom_types = sorted(thresholds)
+    type_index = {x: pos for pos, x in enumerate(atom_types)}
+    try:
+        shift_types = [type_index[y['Atom_type']] for x in shift_lists for y in x['Val']]
+    except KeyError:
+        return score_shift_lists_decimal(shift_lists, peaks, thresholds)
+
+    # Scale everything to integers. Shifts rarely have more than three decimal places, so try that first.
+    places, scaled = None, None
+    peak_places = [-x.as_tuple().exponent for x in peaks if x.is_finite()]
+    for places in sorted({max(peak_places + [_USUAL_PLACES]), _MAX_PLACES}):
+        scaled = _scale(peaks + shifts, places, longest)
+        if scaled is not None:
+            break
+    if scaled is None:
+        return score_shift_lists_decimal(shift_lists, peaks, thresholds)
+    scaled_peaks = np.array(scaled[:len(peaks)], dtype=np.int64)
+
+    # A whole number distance is within a threshold if it is within its floor
+    scaled_thresholds = np.array([int(Fraction(thresholds[x]) * 10 ** places // 1) for x in atom_types],
+                                 dtype=np.int64)
+
+    # Pad the lists to the same length
+    present = np.arange(longest)[None, :] < lengths[:, None]
+    values = np.zeros((len(shift_lists), longest), dtype=np.int64)
+    values[present] = scaled[len(peaks):]
+    types = np.zeros((len(shift_lists), longest), dtype=np.int64)
+    types[present] = shift_types
+
+    offsets = np.empty(len(shift_lists), dtype=np.int64)
+    matched = np.empty(len(shift_lists), dtype=np.int64)
+    chunk = max(1, _CHUNK_ELEMENTS // (longest * len(peaks)))
+    for start in range(0, len(shift_lists), chunk):
+        chunk_values = values[start:start + chunk]
+        chunk_present = present[start:start + chunk]
+
+        # The distance from each shift to its closest peak
+        distances = np.abs(chunk_values[:, :, None] - scaled_peaks[None, None, :]).min(axis=2)
+        offsets[start:start + chunk] = np.where(chunk_present, distances, 0).sum(axis=1)
+
+        # Walk the shifts in order to pick the "closest" shift to each peak the same way as before
+        best_values = np.full((len(chunk_values), len(peaks)), np.iinfo(np.int64).max, dtype=np.int64)
+        best_types = np.zeros((len(chunk_values), len(peaks)), dtype=np.int64)
+        for column in range(longest):
+            column_values = chunk_values[:, column, None]
+            update = chunk_present[:, column, None] & (np.abs(column_values - scaled_peaks[None, :]) < best_values)
+            best_values = np.where(update, column_values, best_values)
+            best_types = np.where(update, types[start:start + chunk, column, None], best_types)
+        within = np.abs(scaled_peaks[None, :] - best_values) <= scaled_thresholds[best_types]
+        matched[start:start + chunk] = within.sum(axis=1)
+
+    offsets, matched = offsets.tolist(), matched.tolist()
+    for shift_list, offset, count in zip(shift_lists, offsets, matched):
+        shift_list['Combined_offset'] = round(Decimal(offset).scaleb(-places), 3)
+        shift_list['Shifts_matched'] = count
+
+    order = sorted(range(len(shift_lists)), key=lambda x: (-matched[x], offsets[x], shift_lists[x]['Entry_ID']))
+    return [shift_lists[x] for x in order]
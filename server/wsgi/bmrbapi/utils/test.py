@@ -1,15 +1,42 @@
 #!/usr/bin/env python3
 
+import base64
+import copy
+import datetime
+import fnmatch
+import os
+import random
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 import unittest
+import zlib
+from decimal import Decimal
 from io import StringIO
+from unittest import mock
 
+import numpy as np
+import psycopg2
 import pynmrstar
 import requests
+import simplejson as json
+from flask import Flask, jsonify
 
+from bmrbapi import application
+from bmrbapi.reloaders import fasta as fasta_reloader
+from bmrbapi.reloaders import shift_index as shift_index_reloader
 from bmrbapi.utils import querymod
+from bmrbapi.utils import connections, decorators, fasta, instant_index, jobs, shift_index, shift_scoring, validation
+from bmrbapi.reloaders import zstd_dictionary as zstd_dictionary_reloader
+from bmrbapi.utils import columnar, compression, hsqc, panav
+from bmrbapi.utils.compression import compress_spliceable, wrap_compressed
+from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import RedisConnection
+from bmrbapi.utils.entry_cache import JSON_SIZE_MULTIPLIER, EntryCache, entry_cache
+from bmrbapi.views import entry as entry_views, search as search_views
 
 url = 'http://localhost'
 
@@ -64,6 +91,26 @@ class TestAPI(unittest.TestCase):
         shifts = shifts.json()['data']
         self.assertGreater(len(shifts), 850)
 
+    def test_instant_negation(self):
+        """ Make sure a negated term excludes the results that only mention it in a citation."""
+
+        results = self.session.get(url + "/search/instant?term=ubiquitin&database=macromolecules").json()
+        negated = None
+        for result in results:
+            words = " ".join(citation for citation in result['citations'] if citation).lower().split()
+            words = [word for word in words if word.isalpha() and len(word) > 6 and word not in result['label'].lower()
+                     and word not in result.get('extra', {}).get('term', '').lower()]
+            if words:
+                negated, excluded = words[0], result['value']
+                break
+        self.assertIsNotNone(negated)
+
+        results = self.session.get(url + "/search/instant?term=ubiquitin -%s&database=macromolecules" %
+                                   negated).json()
+        self.assertNotIn(excluded, [result['value'] for result in results])
+        for result in results:
+            self.assertFalse(any(negated in citation.lower() for citation in result['citations'] if citation))
+
     def test_enumerations(self):
         """ Test that the enumerations is working."""
 
@@ -115,7 +162,1823 @@ class TestAPI(unittest.TestCase):
             self.assertEquals(local, ligand_expo_ent)
 
 
+class TestCompression(unittest.TestCase):
+
+    def test_wrap_compressed(self):
+        """ Make sure wrapping compressed data gives the same zlib stream as compressing the wrapped data."""
+
+        for size in [0, 1, 1000, 65535, 65536, 5 * 1024 * 1024]:
+            # Half random, so that there are both compressed and stored blocks
+            data = os.urandom(size // 2) + b"x" * (size - size // 2)
+            compressed = compress_spliceable(data)
+            for prefix, suffix in [(b"", b""), (b"{", b"}"), (b"p" * 0xffff, b"s" * 0xffff)]:
+                wrapped = wrap_compressed(prefix, compressed, len(data), suffix)
+                self.assertTrue(all(isinstance(piece, bytes) for piece in wrapped))
+                self.assertEqual(zlib.decompress(b"".join(wrapped)), prefix + data + suffix)
+
+        # Too long to fit in a stored block
+        compressed = compress_spliceable(b"data")
+        self.assertIsNone(wrap_compressed(b"p" * 0x10000, compressed, 4, b""))
+        self.assertIsNone(wrap_compressed(b"", compressed, 4, b"s" * 0x10000))
+        # Not compressed by compress_spliceable()
+        self.assertIsNone(wrap_compressed(b"", zlib.compress(b"data"), 4, b""))
+
+
+class TestZstd(unittest.TestCase):
+
+    def setUp(self):
+        import zstandard
+
+        self.redis = _FakeRedis()
+        samples = [('{"entry_id": "%d", "title": "Sample entry %d", "shifts": [%s]}' %
+                    (x, x, ", ".join(str(x * y % 997) for y in range(50)))).encode() for x in range(500)]
+        self.dictionary = zstandard.train_dictionary(4096, samples)
+        self.redis.set(compression.ZSTD_DICTIONARY_KEY % self.dictionary.dict_id(), self.dictionary.as_bytes())
+        self.data = samples[0]
+
+        compression._zstd_dictionaries.clear()
+        patcher = mock.patch.object(compression, 'RedisConnection', self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(compression._zstd_dictionaries.clear)
+
+    def test_round_trip(self):
+        """ Make sure entries round trip through the codec header, with and without a dictionary, and that entries
+        stored with zlib (with or without compress_spliceable()) still decompress."""
+
+        dictionary_id = self.dictionary.dict_id()
+        for used_id in [0, dictionary_id]:
+            stored = compression.compress_entry(self.data, codec="zstd", dictionary_id=used_id)
+            self.assertEqual(compression._CODEC_HEADER.unpack_from(stored), (b"\x00", 1, used_id))
+            self.assertEqual(compression.get_entry_dictionary_id(stored[:compression.CODEC_HEADER_SIZE]), used_id)
+            self.assertEqual(compression.decompress_entry(stored), self.data)
+            self.assertEqual(zlib.decompress(compression.entry_to_zlib(stored)), self.data)
+
+        for stored in [zlib.compress(self.data), compress_spliceable(self.data),
+                       compression.compress_entry(self.data)]:
+            self.assertEqual(compression.get_entry_dictionary_id(stored), 0)
+            self.assertEqual(compression.decompress_entry(stored), self.data)
+            self.assertIs(compression.entry_to_zlib(stored), stored)
+
+        with self.assertRaises(compression.ServerException):
+            compression.decompress_entry(compression._CODEC_HEADER.pack(b"\x00", 9, 0) + b"data")
+        with self.assertRaises(compression.ServerException):
+            compression.compress_entry(self.data, codec="zstd", dictionary_id=1)
+
+    def test_level(self):
+        """ Make sure the configured compression level is used."""
+
+        import zstandard
+
+        with mock.patch.object(zstandard, 'ZstdCompressor', wraps=zstandard.ZstdCompressor) as compressor:
+            compression.compress_entry(self.data, codec="zstd", level=3)
+        self.assertEqual(compressor.call_args[1]['level'], 3)
+
+    def test_delete_unused(self):
+        """ Make sure only the dictionaries that no listed entry uses, and which aren't current, are deleted."""
+
+        dictionary_id = self.dictionary.dict_id()
+        for unused_id in [11, 12]:
+            self.redis.set(compression.ZSTD_DICTIONARY_KEY % unused_id, b"unused")
+        self.redis.set(compression.ZSTD_DICTIONARY_KEY % 13, b"current")
+        self.redis.set(compression.ZSTD_DICTIONARY_ID_KEY, 13)
+
+        self.redis.rpush("macromolecules:entry_list", "1", "2", "3")
+        self.redis.set("macromolecules:entry:1", compression.compress_entry(self.data, "zstd", dictionary_id))
+        self.redis.set("macromolecules:entry:2", compression.compress_entry(self.data))
+        self.redis.set("macromolecules:entry:3", compression.compress_entry(self.data, "zstd"))
+        # Not in an entry list anymore
+        self.redis.set("metabolomics:entry:bmse000001",
+                       compression._CODEC_HEADER.pack(b"\x00", 1, 12) + b"data")
+
+        with mock.patch.object(zstd_dictionary_reloader, 'RedisConnection', self.redis):
+            self.assertEqual(sorted(zstd_dictionary_reloader.delete_unused_zstd_dictionaries(chunk_size=2)), [11, 12])
+        self.assertEqual(sorted(self.redis.scan_iter(compression.ZSTD_DICTIONARY_KEY.replace("%d", "*"))),
+                         sorted([(compression.ZSTD_DICTIONARY_KEY % x).encode() for x in [dictionary_id, 13]]))
+
+
+class _FakeRedis:
+    """ Stands in for a Redis connection, keeping the data in dictionaries. Expiration times are recorded but
+    nothing expires unless a test deletes it. """
+
+    def __init__(self):
+        self.data = {}
+        self.ttls = {}
+
+    def __call__(self, *args, **kwargs):
+        # So it can replace the RedisConnection class
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    @staticmethod
+    def _bytes(value) -> bytes:
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode()
+
+    def pipeline(self, transaction: bool = True):
+        return _FakePipeline(self)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def mget(self, keys):
+        return [self.data.get(key) for key in keys]
+
+    def set(self, key, value, ex=None, nx=False):
+        if nx and key in self.data:
+            return None
+        self.data[key] = self._bytes(value)
+        if ex:
+            self.ttls[key] = ex
+        return True
+
+    def setex(self, key, ttl, value):
+        return self.set(key, value, ex=ttl)
+
+    def delete(self, *keys):
+        deleted = 0
+        for key in keys:
+            key = key.decode() if isinstance(key, bytes) else key
+            deleted += self.data.pop(key, None) is not None
+            self.ttls.pop(key, None)
+        return deleted
+
+    def getrange(self, key, start, end):
+        return self.data.get(key, b"")[start:end + 1]
+
+    def exists(self, key):
+        return int(key in self.data)
+
+    def expire(self, key, ttl):
+        if key not in self.data:
+            return False
+        self.ttls[key] = ttl
+        return True
+
+    def ttl(self, key):
+        return self.ttls.get(key, -1) if key in self.data else -2
+
+    def incr(self, key, amount: int = 1):
+        self.data[key] = self._bytes(int(self.data.get(key, 0)) + amount)
+        return int(self.data[key])
+
+    def decr(self, key, amount: int = 1):
+        return self.incr(key, -amount)
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        fields = self.data.setdefault(key, {})
+        for field, value in (mapping or {field: value}).items():
+            fields[self._bytes(field)] = self._bytes(value)
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(self._bytes(field))
+
+    def hmget(self, key, fields):
+        return [self.hget(key, field) for field in fields]
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def hincrby(self, key, field, amount: int = 1):
+        fields = self.data.setdefault(key, {})
+        fields[self._bytes(field)] = self._bytes(int(fields.get(self._bytes(field), 0)) + amount)
+        return int(fields[self._bytes(field)])
+
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(self._bytes(value) for value in values)
+
+    def lrange(self, key, start, end):
+        values = self.data.get(key, [])
+        return values[start:] if end == -1 else values[start:end + 1]
+
+    def blpop(self, key, timeout=0):
+        if self.data.get(key):
+            return key.encode(), self.data[key].pop(0)
+        return None
+
+    def scan_iter(self, match: str = "*"):
+        return [key.encode() for key in list(self.data) if fnmatch.fnmatchcase(key, match)]
+
+
+class _FakePipeline:
+    """ Queues the commands for a _FakeRedis, and runs them on execute(). """
+
+    def __init__(self, redis: _FakeRedis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.commands.append((getattr(self.redis, name), args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        results = [command(*args, **kwargs) for command, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class _FakeCursor:
+    """ Stands in for a Postgres cursor. COPY writes the given CSV, and queries return the given rows, or each the
+    next of the given results. """
+
+    def __init__(self, csv: str = "", rows: list = None, results: list = None):
+        self.csv = csv
+        self.rows = rows or []
+        self.results = list(results or [])
+        self.executed = []
+        self.arguments = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def copy_expert(self, sql, file):
+        self.executed.append(sql)
+        file.write(self.csv if 'b' not in getattr(file, 'mode', 'b') else self.csv.encode())
+
+    def mogrify(self, sql, args):
+        return sql.encode()
+
+    def execute(self, sql, args=None):
+        self.executed.append(sql)
+        self.arguments.append(args)
+        if self.results:
+            self.rows = self.results.pop(0)
+
+    def fetchall(self):
+        return self.rows
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class TestExport(unittest.TestCase):
+
+    csv = 'id,val,name\n' + ''.join('%d,%d.5,"atom %d"\n' % (x, x, x) for x in range(1, 200)) + '200,,\n201,1.5,""\n'
+    column_types = {'id': 'int64', 'val': 'float64', 'name': 'string'}
+
+    def export(self, format_: str) -> bytes:
+        """ Returns the body of the export of the CSV in the given format. """
+
+        cursor = _FakeCursor(csv=self.csv)
+        with application.test_request_context(), mock.patch.object(columnar, 'CSV_BLOCK_SIZE', 1024):
+            response = columnar.export_query(cursor, 'SELECT 1', [], format_, self.column_types, 'shifts')
+            response.direct_passthrough = False
+            self.assertEqual(response.mimetype, columnar.COLUMNAR_FORMATS[format_])
+            self.assertIn('shifts.%s' % format_, response.headers['Content-Disposition'])
+            body = response.get_data()
+            response.close()
+        self.assertEqual(cursor.executed, ['COPY (SELECT 1) TO STDOUT WITH (FORMAT csv, HEADER)'])
+        return body
+
+    def test_formats(self):
+        """ Make sure each format has all the rows, with the given column types, and with NULLs told apart from
+        empty strings."""
+
+        import pyarrow.ipc
+        import pyarrow.parquet
+
+        self.assertEqual(self.export('csv').decode(), self.csv)
+        # Converted in more than one block
+        self.assertGreater(pyarrow.ipc.open_stream(self.export('arrow')).read_all()['id'].num_chunks, 1)
+
+        for table in [pyarrow.ipc.open_stream(self.export('arrow')).read_all(),
+                      pyarrow.parquet.read_table(pyarrow.BufferReader(self.export('parquet')))]:
+            self.assertEqual([str(x) for x in table.schema.types], ['int64', 'double', 'string'])
+            rows = table.to_pylist()
+            self.assertEqual(len(rows), 201)
+            self.assertEqual(rows[0], {'id': 1, 'val': 1.5, 'name': 'atom 1'})
+            self.assertEqual(rows[-2:], [{'id': 200, 'val': None, 'name': None},
+                                         {'id': 201, 'val': 1.5, 'name': ''}])
+
+
+class TestShiftIndex(unittest.TestCase):
+
+    # Entry ID, shift list ID, value as written in the entry, atom type
+    shifts = [("1", "1", "1.20", "H"), ("1", "1", "120.5", "N"), ("1", "1", "55.0", "C"),
+              ("1", "2", "1.21", "H"), ("2", "1", "1.2", "H"), ("2", "1", "1.2", "C"),
+              ("3", "1", "100.2000001", "C"), ("3", "1", "99.8", "C"), ("4", "1", "7.5", "H")]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, name: str, shifts: list) -> str:
+        """ Builds an index of the shifts with the reloader, as if Postgres had them. """
+
+        path = os.path.join(self.directory, name)
+        os.mkdir(path)
+        csv = "".join("%s,%s,%s,%s\n" % row for row in shifts)
+        with mock.patch.object(shift_index_reloader, 'PostgresConnection', lambda **kwargs: _FakeCursor(csv)):
+            shift_index_reloader.build_shift_index('metabolomics', path)
+        return path
+
+    @staticmethod
+    def sql_search(shifts: list, peaks: list, thresholds: dict) -> list:
+        """ What the SQL of multiple_shift_search selects: the distinct "value,atom type" pairs of each list with a
+        value within the threshold of a peak, compared as float8. """
+
+        matches = {}
+        for entry_id, list_id, value, atom_type in shifts:
+            if any(peak - thresholds[atom_type] <= float(value) <= peak + thresholds[atom_type] for peak in peaks):
+                matches.setdefault((entry_id, list_id), set()).add((value, atom_type))
+        return [(key[0], key[1], sorted(pairs, key=lambda pair: "%s,%s" % pair)) for key, pairs in matches.items()]
+
+    def assertMatchesSQL(self, index: shift_index.ShiftIndex, peaks: list, thresholds: dict):
+        found = index.find_shift_lists(peaks, thresholds)
+        expected = self.sql_search(self.shifts, peaks, thresholds)
+        self.assertCountEqual(found, expected)
+        # Ordered like ORDER BY count(DISTINCT "Val") DESC
+        counts = [len({float(pair[0]) for pair in pairs}) for _, _, pairs in found]
+        self.assertEqual(counts, sorted(counts, reverse=True))
+
+    def test_find_shift_lists(self):
+        """ Make sure the shift index finds the same shift lists as the SQL search."""
+
+        index = shift_index.ShiftIndex(self.build("index", self.shifts))
+        thresholds = {'C': .2, 'N': .2, 'H': .01}
+        for peaks in [[1.2], [1.2, 120.4, 55.1], [100.0], [7.5, 1.21], [1.19, 1.21]]:
+            self.assertMatchesSQL(index, peaks, thresholds)
+
+        # The pairs keep the values as they are written in the entry
+        self.assertEqual(index.find_shift_lists([120.5], thresholds), [("1", "1", [("120.5", "N")])])
+
+    def test_threshold_edges(self):
+        """ Make sure values on the thresholds match, and values just outside don't even when float32 would round
+        them onto the threshold."""
+
+        index = shift_index.ShiftIndex(self.build("index", self.shifts))
+        thresholds = {'C': .2, 'N': .2, 'H': .01}
+
+        # 99.8 is exactly 100 - .2, and 100.2000001 is just outside 100 + .2
+        self.assertEqual(index.find_shift_lists([100.0], thresholds), [("3", "1", [("99.8", "C")])])
+        self.assertGreater(float("100.2000001"), 100.0 + .2)
+        self.assertLessEqual(float(np.float32("100.2000001")), 100.0 + .2)
+        # 1.20 and 1.21 are both within .01 of 1.2 with floats
+        self.assertMatchesSQL(index, [1.2], thresholds)
+        self.assertMatchesSQL(index, [1.2], {'C': 0, 'N': 0, 'H': 0})
+
+    def test_empty_results(self):
+        """ Make sure searches with nothing nearby, and indexes without some atom types, return nothing."""
+
+        index = shift_index.ShiftIndex(self.build("index", self.shifts))
+        self.assertEqual(index.find_shift_lists([500.0], {'C': .2, 'N': .2, 'H': .01}), [])
+        self.assertEqual(index.find_shift_lists([], {'C': .2, 'N': .2, 'H': .01}), [])
+
+        index = shift_index.ShiftIndex(self.build("only_h", [("1", "1", "1.2", "H")]))
+        self.assertEqual(index.find_shift_lists([120.0], {'C': 1, 'N': 1, 'H': 1}), [])
+
+    def test_get_shift_index(self):
+        """ Make sure the index is reloaded when the reloader switches the link to a new version."""
+
+        with mock.patch.dict(configuration, {'shift_index_directory': self.directory}), \
+                mock.patch.dict(shift_index._indexes, clear=True):
+            self.assertIsNone(shift_index.get_shift_index('metabolomics'))
+
+            first = self.build("metabolomics.1", self.shifts)
+            os.symlink("metabolomics.1", os.path.join(self.directory, "metabolomics"))
+            index = shift_index.get_shift_index('metabolomics')
+            self.assertEqual(index.path, first)
+            self.assertIs(shift_index.get_shift_index('metabolomics'), index)
+
+            second = self.build("metabolomics.2", [("5", "1", "1.2", "H")])
+            os.symlink("metabolomics.2", os.path.join(self.directory, "metabolomics.link"))
+            os.replace(os.path.join(self.directory, "metabolomics.link"), os.path.join(self.directory, "metabolomics"))
+            index = shift_index.get_shift_index('metabolomics')
+            self.assertEqual(index.path, second)
+            self.assertEqual(index.find_shift_lists([1.2], {'C': 0, 'N': 0, 'H': 0}), [("5", "1", [("1.2", "H")])])
+
+            os.remove(os.path.join(self.directory, "metabolomics"))
+            self.assertIsNone(shift_index.get_shift_index('metabolomics'))
+
+
+class TestShiftScoring(unittest.TestCase):
+
+    thresholds = {'N': .2, 'C': .2, 'H': .01}
+
+    @staticmethod
+    def shift_list(entry_id: str, shifts: list) -> dict:
+        return {'Entry_ID': entry_id, 'Assigned_chem_shift_list_ID': '1',
+                'Val': [{'Shift': Decimal(value), 'Atom_type': atom_type} for value, atom_type in shifts]}
+
+    def assertSameScores(self, shift_lists: list, peaks: list, thresholds: dict = None, uses_numpy: bool = True):
+        """ Make sure both implementations rank and score the lists identically, and that the numpy one didn't
+        just fall back to the Decimal one (unless it should). """
+
+        thresholds = thresholds or self.thresholds
+        peaks = sorted(Decimal(x) for x in peaks)
+        expected = shift_scoring.score_shift_lists_decimal(copy.deepcopy(shift_lists), peaks, thresholds)
+        if uses_numpy:
+            with mock.patch.object(shift_scoring, 'score_shift_lists_decimal', side_effect=AssertionError):
+                result = shift_scoring.score_shift_lists(copy.deepcopy(shift_lists), peaks, thresholds)
+        else:
+            result = shift_scoring.score_shift_lists(copy.deepcopy(shift_lists), peaks, thresholds)
+        self.assertEqual(json.dumps(result), json.dumps(expected))
+        return result
+
+    def test_ties(self):
+        """ Make sure lists with the same score keep the same order, and the same closest shift is chosen."""
+
+        shift_lists = [self.shift_list("3", [("1.00", "H"), ("120.0", "N")]),
+                       self.shift_list("2", [("1.00", "H"), ("120.0", "N")]),
+                       self.shift_list("2", [("120.0", "N"), ("1.00", "H")]),
+                       self.shift_list("1", [("0.99", "H"), ("1.01", "H")]),
+                       self.shift_list("1", [("1.01", "H"), ("0.99", "H")]),
+                       # Equally far from the peak on either side, with different atom types
+                       self.shift_list("4", [("119.8", "C"), ("120.2", "N")]),
+                       self.shift_list("4", [("120.2", "N"), ("119.8", "C")])]
+        result = self.assertSameScores(shift_lists, ["1.00", "120.0"])
+        # The closest shift is compared by distance against the value of the shift kept before it, so the order of
+        #  the shifts can change how many peaks match
+        self.assertEqual([x['Shifts_matched'] for x in result if x['Entry_ID'] == "2"], [2, 1])
+        self.assertEqual([x['Entry_ID'] for x in result[:2]], ["2", "3"])
+
+    def test_thresholds(self):
+        """ Make sure distances exactly on a threshold which isn't exact as a float are counted the same way."""
+
+        shift_lists = [self.shift_list("1", [("50.3", "C")]), self.shift_list("2", [("49.7", "C")]),
+                       self.shift_list("3", [("50.299", "C")]), self.shift_list("4", [("50.301", "C")])]
+        for threshold in [.3, .1, .2, 0, 1]:
+            thresholds = {'N': threshold, 'C': threshold, 'H': threshold}
+            self.assertSameScores(shift_lists, ["50.0"], thresholds)
+        result = self.assertSameScores(shift_lists, ["50.0"], {'N': .3, 'C': .3, 'H': .3})
+        self.assertEqual({x['Entry_ID']: x['Shifts_matched'] for x in result}, {"1": 0, "2": 0, "3": 1, "4": 0})
+
+    def test_decimal_places(self):
+        """ Make sure values with more decimal places than the usual scale are still scored exactly, and those with
+        too many to scale use the Decimal implementation."""
+
+        shift_lists = [self.shift_list("1", [("1.00049", "H"), ("1.0005", "H")]),
+                       self.shift_list("2", [("1.0004", "H"), ("130.123456789", "N")])]
+        self.assertSameScores(shift_lists, ["1.0", "130.12345678"])
+
+        shift_lists.append(self.shift_list("3", [("1.0000000000001", "H")]))
+        self.assertSameScores(shift_lists, ["1.0"], uses_numpy=False)
+        self.assertSameScores(shift_lists[:2], ["1.00000000001"], uses_numpy=False)
+
+    def test_empty(self):
+        """ Make sure there is nothing to score if no lists were found."""
+
+        self.assertEqual(shift_scoring.score_shift_lists([], [Decimal("1.0")], self.thresholds), [])
+        self.assertEqual(shift_scoring.score_shift_lists_decimal([], [Decimal("1.0")], self.thresholds), [])
+
+    def test_generated(self):
+        """ Make sure both implementations agree on made up queries that look like real ones."""
+
+        generator = random.Random(1)
+        for _ in range(20):
+            peaks = ["%.2f" % generator.uniform(0, 180) for _ in range(generator.randint(1, 6))]
+            shift_lists = []
+            for number in range(generator.randint(1, 50)):
+                shifts = []
+                for _ in range(generator.randint(1, 10)):
+                    value = float(generator.choice(peaks)) + generator.uniform(-.3, .3)
+                    shifts.append(("%.*f" % (generator.randint(0, 3), value), generator.choice('CNH')))
+                shift_lists.append(self.shift_list(str(generator.randint(1, 10)), shifts))
+            self.assertSameScores(shift_lists, peaks)
+
+
+class TestEntryCache(unittest.TestCase):
+
+    star = "data_test\nsave_test\n_Entry.Sf_category entry\n_Entry.Sf_framecode test\n_Entry.ID test\nsave_\n"
+
+    def setUp(self):
+        self.entry = pynmrstar.Entry.from_string(self.star)
+
+    def test_size_bounded_eviction(self):
+        """ Make sure the least recently used entries are evicted once the estimated size is over the limit."""
+
+        cache = EntryCache(10 * JSON_SIZE_MULTIPLIER)
+        cache.put("1", "v1", self.entry, 4)
+        cache.put("2", "v1", self.entry, 4)
+        self.assertIs(cache.get("1", "v1"), self.entry)
+        cache.put("3", "v1", self.entry, 4)
+
+        self.assertIsNone(cache.get("2", "v1"))
+        self.assertIs(cache.get("1", "v1"), self.entry)
+        self.assertIs(cache.get("3", "v1"), self.entry)
+        self.assertEqual(cache.statistics()['size'], 8 * JSON_SIZE_MULTIPLIER)
+        self.assertEqual(cache.evictions, 1)
+
+        # Too large to cache at all
+        cache.put("4", "v1", self.entry, 11)
+        self.assertIsNone(cache.get("4", "v1"))
+        self.assertEqual(cache.statistics()['entries'], 2)
+
+        # Replacing an entry doesn't count it twice
+        cache.put("1", "v1", self.entry, 5)
+        self.assertEqual(cache.statistics()['size'], 9 * JSON_SIZE_MULTIPLIER)
+
+    def test_version_mismatch(self):
+        """ Make sure an entry is only returned for the data version it was loaded from."""
+
+        cache = EntryCache(1000 * JSON_SIZE_MULTIPLIER)
+        cache.put("1", "v1", self.entry, 10)
+        self.assertIsNone(cache.get("1", "v2"))
+        self.assertIs(cache.get("1", "v1"), self.entry)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+        cache.invalidate("1")
+        self.assertIsNone(cache.get("1", "v1"))
+        self.assertEqual(cache.statistics()['size'], 0)
+
+    def test_upload_invalidates(self):
+        """ Make sure uploading an entry drops the object parsed from an earlier upload with the same ID."""
+
+        redis = _FakeRedis()
+        with mock.patch.object(entry_views, 'RedisConnection', redis), \
+                mock.patch.dict(configuration['redis'], {'upload_timeout': 60}):
+            response = application.test_client().post("/entry", data=self.star)
+        entry_id = response.get_json()['entry_id']
+        self.assertIn("uploaded:entry:%s" % entry_id, redis.data)
+
+        entry_cache.put(entry_id, "uploaded", pynmrstar.Entry.from_string(self.star.replace("test", "stale")), 10)
+        with mock.patch.object(entry_views, 'RedisConnection', redis), \
+                mock.patch.dict(configuration['redis'], {'upload_timeout': 60}):
+            application.test_client().post("/entry", data=self.star)
+        self.assertIsNone(entry_cache.get(entry_id, "uploaded"))
+
+
+class TestJobs(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = _FakeRedis()
+        patcher = mock.patch.object(jobs, 'RedisConnection', self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_queued_job(self):
+        """ Runs the next job in the queue the way run_jobs() does. """
+
+        job_id, _, client = self.redis.blpop(jobs.JOB_QUEUE_KEY)[1].decode().partition(":")
+        jobs.run_job(job_id, client)
+        return job_id
+
+    def test_client_count(self):
+        """ Make sure a client's count goes back down whether its jobs finish, fail, or expire while queued."""
+
+        with mock.patch.dict(jobs.JOB_TYPES, {'validate': lambda argument: {'ok': argument}}):
+            jobs.enqueue_job('validate', '15000', '::1')
+            self.assertEqual(self.redis.get(jobs.JOB_CLIENT_KEY % '::1'), b"1")
+            job_id = self.run_queued_job()
+            self.assertEqual(jobs.get_job(job_id)['result'], {'ok': '15000'})
+            self.assertEqual(self.redis.get(jobs.JOB_CLIENT_KEY % '::1'), b"0")
+
+        with mock.patch.dict(jobs.JOB_TYPES, {'validate': mock.Mock(side_effect=ValueError)}), \
+                mock.patch.object(jobs.logging, 'critical'):
+            job_id = jobs.enqueue_job('validate', '15000', '::1')
+            self.run_queued_job()
+            self.assertEqual(jobs.get_job(job_id)['status'], 'failed')
+            self.assertEqual(self.redis.get(jobs.JOB_CLIENT_KEY % '::1'), b"0")
+
+        # The job expires while it is queued
+        job_id = jobs.enqueue_job('validate', '15000', '::1')
+        self.redis.delete(jobs.JOB_KEY % job_id)
+        with mock.patch.object(jobs.logging, 'warning'):
+            self.run_queued_job()
+        self.assertIsNone(jobs.get_job(job_id))
+        self.assertEqual(self.redis.get(jobs.JOB_CLIENT_KEY % '::1'), b"0")
+
+    def test_limit(self):
+        """ Make sure a client can't queue more than jobs.max_per_client jobs."""
+
+        with mock.patch.dict(configuration, {'jobs': {'max_per_client': 2}}):
+            jobs.enqueue_job('validate', '1', 'client')
+            jobs.enqueue_job('validate', '2', 'client')
+            with self.assertRaises(jobs.RequestException):
+                jobs.enqueue_job('validate', '3', 'client')
+        self.assertEqual(self.redis.get(jobs.JOB_CLIENT_KEY % 'client'), b"2")
+
+
+class TestValidation(unittest.TestCase):
+
+    star = """data_test
+save_shifts
+   _Assigned_chem_shift_list.Sf_category assigned_chemical_shifts
+   _Assigned_chem_shift_list.Sf_framecode shifts
+   loop_
+      _Atom_chem_shift.ID
+      _Atom_chem_shift.Comp_ID
+      _Atom_chem_shift.Atom_ID
+      _Atom_chem_shift.Val
+      1 ALA H 8.1
+      2 ALA N 120.1
+   stop_
+save_
+"""
+
+    avs_tags = ["Assembly_ID", "Entity_assembly_ID", "Entity_ID", "Comp_index_ID", "Comp_ID",
+                "Comp_overall_assignment_score", "Comp_typing_score", "Comp_SRO_score",
+                "Comp_1H_shifts_analysis_status", "Comp_13C_shifts_analysis_status",
+                "Comp_15N_shifts_analysis_status"]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.entry = pynmrstar.Entry.from_string(self.star)
+        self.panav_loops = []
+
+    def fake_avs(self, output: str) -> str:
+        """ Writes a script which prints the output like AVS. """
+
+        path = os.path.join(self.directory, "avs")
+        with open(path, "w") as script:
+            script.write("#!/bin/sh\ncat <<'EOF'\n%sEOF\n" % output)
+        os.chmod(path, 0o755)
+        return path
+
+    def run_panav(self, loop: bytes) -> bytes:
+        self.panav_loops.append(pynmrstar.Loop.from_string(loop.decode()))
+        raise subprocess.CalledProcessError(1, ["PANAV"])
+
+    def validate(self, avs_output: str) -> dict:
+        with mock.patch.object(validation, 'AVS_SCRIPT', self.fake_avs(avs_output)), \
+                mock.patch.object(validation, 'run_panav', self.run_panav), \
+                mock.patch.object(validation, 'panav_workers', lambda: 1):
+            return validation.validate_entry("test", self.entry)
+
+    def test_avs_status_columns(self):
+        """ Make sure PANAV only gets the AVS status columns if AVS produced its analysis loop."""
+
+        avs_output = "data_test\nsave_avs\n_AVS.Sf_category avs\nloop_\n%s\n%s\nstop_\nsave_\n" % (
+            "\n".join("_AVS_analysis_r.%s" % tag for tag in self.avs_tags), " ".join(["1"] * len(self.avs_tags)))
+        report = self.validate(avs_output)
+        self.assertEqual(report['avs']['category'], "AVS_analysis")
+        self.assertEqual(report['panav'], {0: {"error": "PANAV failed on this entry."}})
+        self.assertEqual(len(self.panav_loops), 1)
+        self.assertIn("AVS_analysis_status", self.panav_loops[0].tags)
+        self.assertEqual(self.panav_loops[0].data[0][-2:], ["Consistent", "Consistent"])
+
+        self.panav_loops = []
+        report = self.validate("data_test\n")
+        self.assertEqual(report['avs'], {'error': "AVS failed to run on this entry."})
+        self.assertEqual(report['panav'], {0: {"error": "PANAV failed on this entry."}})
+        # The loops with the columns were run while AVS worked, then the ones without them
+        self.assertEqual(len(self.panav_loops), 2)
+        self.assertNotIn("AVS_analysis_status", self.panav_loops[1].tags)
+        self.assertEqual(self.panav_loops[1].data[0], ["1", "ALA", "H", "8.1"])
+
+        # The cached entry isn't changed
+        self.assertNotIn("AVS_analysis_status", self.entry.get_loops_by_category("atom_chem_shift")[0].tags)
+
+    def test_report_cache(self):
+        """ Make sure reports are cached per entry hash and tool version, that reports with temporary errors are
+        only cached briefly, and that cached uploaded reports last as long as the upload."""
+
+        entry_cache.invalidate("15000")
+        self.addCleanup(entry_cache.invalidate, "15000")
+        redis = _FakeRedis()
+        redis.hset("macromolecules:meta", "update_time", "1")
+        redis.set("macromolecules:entry:15000", zlib.compress(self.entry.get_json().encode()))
+        redis.hset("macromolecules:entry_info:15000", "hash", "first")
+        uploaded_id = "0123456789abcdef0123456789abcdef"
+        redis.set("uploaded:entry:%s" % uploaded_id, zlib.compress(self.entry.get_json().encode()))
+
+        reports = []
+
+        def validate_entry(entry_id: str, entry: pynmrstar.Entry) -> dict:
+            reports.append(entry_id)
+            return copy.deepcopy(report)
+
+        def get_report(entry_id: str = "15000", refresh: bool = False) -> None:
+            """ Gets the report, which must look the same whether or not it was cached. """
+
+            with mock.patch.object(validation, 'RedisConnection', redis), \
+                    mock.patch.object(querymod, 'RedisConnection', redis), \
+                    mock.patch.object(validation, 'validate_entry', validate_entry), \
+                    mock.patch.object(validation, '_tool_version', tool_version), \
+                    mock.patch.dict(configuration, {'validation': {'cache_ttl': 1000, 'error_cache_ttl': 60}}), \
+                    mock.patch.dict(configuration['redis'], {'upload_timeout': 500}):
+                result = validation.get_validation_report(entry_id, refresh=refresh)
+            self.assertEqual(result, json.loads(json.dumps(report)))
+
+        report, tool_version = {'avs': {}, 'panav': {0: {"error": "PANAV failed on this entry."}}}, "tools1"
+        get_report()
+        get_report()
+        self.assertEqual(reports, ["15000"])
+        self.assertEqual(redis.ttls["validation:15000:first:tools1"], 1000)
+        get_report(refresh=True)
+        self.assertEqual(len(reports), 2)
+
+        # A new version of the entry, or of the tools
+        redis.hset("macromolecules:entry_info:15000", "hash", "second")
+        get_report()
+        tool_version = "tools2"
+        get_report()
+        get_report()
+        self.assertEqual(len(reports), 4)
+        self.assertIn("validation:15000:second:tools2", redis.data)
+
+        # Only busy, so it is run again soon
+        report = {'avs': {'error': validation.AVS_TIMEOUT_ERROR}, 'panav': {}}
+        get_report(refresh=True)
+        self.assertEqual(redis.ttls["validation:15000:second:tools2"], 60)
+
+        report = {'avs': {}, 'panav': {}}
+        get_report(uploaded_id)
+        self.assertEqual(redis.ttls["validation:%s:%s:tools2" % (uploaded_id, uploaded_id)], 500)
+        redis.ttls["validation:%s:%s:tools2" % (uploaded_id, uploaded_id)] = 10
+        get_report(uploaded_id)
+        self.assertEqual(reports[-1], uploaded_id)
+        self.assertEqual(len(reports), 6)
+        self.assertEqual(redis.ttls["validation:%s:%s:tools2" % (uploaded_id, uploaded_id)], 500)
+
+        # Entries stored before there were hashes aren't cached
+        redis.delete("macromolecules:entry_info:15000")
+        get_report()
+        get_report()
+        self.assertEqual(len(reports), 8)
+
+
+# Speaks the PanavWorker protocol. "fail" loops fail, "sleep" loops hang, and loops over 1 MB are never read.
+_FAKE_PANAV_WORKER = """
+import sys, time
+requests, responses = sys.stdin.buffer, sys.stdout.buffer
+for header in iter(requests.readline, b""):
+    if int(header) > 1000000:
+        time.sleep(30)
+    loop = requests.read(int(header))
+    if loop == b"sleep":
+        time.sleep(30)
+    status, output = (b"ERROR", b"failed") if loop == b"fail" else (b"OK", b"PANAV " + loop)
+    # Split the response, to make sure it is read until it is complete
+    responses.write(b"%s %d\\n" % (status, len(output)) + output[:3])
+    responses.flush()
+    time.sleep(0.05)
+    responses.write(output[3:])
+    responses.flush()
+"""
+
+
+class TestPanav(unittest.TestCase):
+
+    def setUp(self):
+        popen = subprocess.Popen
+
+        def fake_worker(args, **kwargs):
+            return popen([sys.executable, "-c", _FAKE_PANAV_WORKER], **kwargs)
+
+        patchers = [mock.patch.object(panav.subprocess, 'Popen', fake_worker),
+                    mock.patch.dict(configuration, {'panav': {'workers': 1, 'max_jobs': 3, 'timeout': 1}})]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pool = panav._PanavPool()
+        self.addCleanup(self.pool.close)
+
+    def idle_worker(self) -> panav._PanavWorker:
+        return self.pool._idle.queue[-1]
+
+    def test_framing(self):
+        """ Make sure the responses are read according to their header, and that workers are reused until they
+        ran panav.max_jobs loops."""
+
+        self.assertEqual(self.pool.run(b"loop"), b"PANAV loop")
+        worker = self.idle_worker()
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            self.pool.run(b"fail")
+        self.assertEqual(context.exception.output, b"failed")
+        self.assertIs(self.idle_worker(), worker)
+
+        # Larger than the pipe buffer
+        self.assertEqual(self.pool.run(b"x" * 500000), b"PANAV " + b"x" * 500000)
+        self.assertEqual(self.pool._idle.qsize(), 0)
+        self.assertIsNotNone(worker.process.poll())
+
+    def test_timeout(self):
+        """ Make sure a worker that doesn't answer, or doesn't read the loop, in time is killed and replaced."""
+
+        for loop in [b"sleep", b"x" * 2000000]:
+            self.pool.run(b"loop")
+            worker = self.idle_worker()
+
+            start = time.monotonic()
+            with self.assertRaises(subprocess.TimeoutExpired):
+                self.pool.run(loop)
+            self.assertLess(time.monotonic() - start, 5)
+            self.assertIsNotNone(worker.process.poll())
+            self.assertFalse(os.path.exists(worker.directory))
+
+            self.assertIsNot(self.idle_worker(), worker)
+            self.assertEqual(self.pool.run(b"loop"), b"PANAV loop")
+
+
+class TestFasta(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        # Prints the hits written next to the library, and records the arguments it was run with
+        self.fasta36 = os.path.join(self.directory, "fasta36")
+        with open(self.fasta36, "w") as script:
+            script.write('#!/bin/sh\necho "$@" >> "%s/arguments"\nfor last; do :; done\ncat "$last.hits"\n'
+                         % self.directory)
+        os.chmod(self.fasta36, 0o755)
+
+    def write_shard(self, name: str, hits: list) -> str:
+        """ Writes a library shard, and the -m 8 lines fasta36 finds in it for the (E-value, bit score) pairs. """
+
+        path = os.path.join(self.directory, name)
+        open(path, "w").close()
+        with open(path + ".hits", "w") as hits_file:
+            for number, (e_value, bit_score) in enumerate(hits):
+                hits_file.write("query\t%s.%d\t100.0\t10\t0\t0\t1\t10\t1\t10\t%s\t%s\n" %
+                                (name, number, e_value, bit_score))
+        return path
+
+    def arguments(self) -> list:
+        with open(os.path.join(self.directory, "arguments")) as arguments:
+            return [line.split() for line in arguments]
+
+    def test_run_fasta(self):
+        """ Make sure the hits of all the shards are merged in order, and all kept unless fasta.max_hits is set."""
+
+        shards = [self.write_shard("polymer.0.fasta", [("1e-10", "50"), ("0.5", "20")]),
+                  self.write_shard("polymer.1.fasta", [("1e-10", "60"), ("1e-5", "30"), ("2", "10")])]
+
+        with mock.patch.dict(configuration, {'fasta': {}}):
+            hits = fasta.run_fasta([self.fasta36, "-m", "8"], "query.fasta", shards, 1000)
+        self.assertEqual([(x[10], x[11]) for x in hits],
+                         [("1e-10", "60"), ("1e-10", "50"), ("1e-5", "30"), ("0.5", "20"), ("2", "10")])
+        self.assertTrue(all("-b" not in arguments and arguments[-3:-2] == ["1000"]
+                            for arguments in self.arguments()))
+
+        with mock.patch.dict(configuration, {'fasta': {}}):
+            hits = fasta.run_fasta([self.fasta36, "-m", "8"], "query.fasta", shards[1:])
+        self.assertEqual(len(hits), 3)
+
+        with mock.patch.dict(configuration, {'fasta': {'max_hits': 2}}):
+            hits = fasta.run_fasta([self.fasta36, "-m", "8"], "query.fasta", shards)
+        self.assertEqual([(x[10], x[11]) for x in hits], [("1e-10", "60"), ("1e-10", "50")])
+        self.assertEqual(self.arguments()[-1][2:4], ["-b", "2"])
+
+    def test_run_fasta_errors(self):
+        """ Make sure a failed or slow search is reported."""
+
+        shard = self.write_shard("polymer.0.fasta", [])
+        with self.assertRaises(fasta.ServerException) as error:
+            fasta.run_fasta(["false"], "query.fasta", [shard])
+        self.assertEqual(error.exception.status_code, 500)
+
+        sleeper = os.path.join(self.directory, "sleeper")
+        with open(sleeper, "w") as script:
+            script.write("#!/bin/sh\nsleep 5\n")
+        os.chmod(sleeper, 0o755)
+        start = time.monotonic()
+        with mock.patch.dict(configuration, {'fasta': {'timeout': .5}}), \
+                self.assertRaises(fasta.ServerException) as error:
+            fasta.run_fasta([sleeper], "query.fasta", [shard, shard, shard])
+        self.assertEqual(error.exception.status_code, 504)
+        # All the shards share one deadline
+        self.assertLess(time.monotonic() - start, 2)
+
+
+class TestFastaLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        generator = random.Random(15)
+        self.sequences = {a_type: [("%d" % (10000 + x), "1", "%s entry %d" % (a_type, x),
+                                    "".join(generator.choice(letters) for _ in range(generator.randint(60, 200))))
+                                   for x in range(count)]
+                          for a_type, letters, count in [('polymer', "ACDEFGHIKLMNPQRSTVWY", 300), ('rna', "ACGU", 5),
+                                                         ('dna', "ACGT", 5)]}
+
+        # Prints a hit for every sequence in the library it is run on, and records the library
+        submodules = os.path.join(self.directory, "submodules")
+        os.makedirs(os.path.join(submodules, "fasta36", "bin"))
+        with open(os.path.join(submodules, "fasta36", "bin", "fasta36"), "w") as script:
+            script.write('#!/bin/sh\nfor last; do :; done\necho "$last" >> "%s/searched"\n'
+                         'grep "^>" "$last" | cut -c2- | while read id; do\n'
+                         '  printf "query\\t%%s\\t100.0\\t10\\t0\\t0\\t1\\t10\\t1\\t10\\t1e-10\\t50\\n" "$id"\n'
+                         'done\n' % self.directory)
+        os.chmod(os.path.join(submodules, "fasta36", "bin", "fasta36"), 0o755)
+
+        self.redis = _FakeRedis()
+        self.library_directory = os.path.join(self.directory, "fasta")
+        patchers = [mock.patch.object(fasta_reloader, 'fasta_sequences',
+                                      lambda a_type: [(x[0], x[1], x[3], x[2]) for x in self.sequences[a_type]]),
+                    mock.patch.object(fasta_reloader, 'RedisConnection', self.redis),
+                    mock.patch.object(fasta, 'RedisConnection', self.redis),
+                    mock.patch.object(search_views, 'RedisConnection', self.redis),
+                    mock.patch.object(search_views, 'SUBMODULE_DIR', submodules),
+                    mock.patch.object(fasta, '_library', None),
+                    mock.patch.dict(configuration, {'fasta_directory': self.library_directory,
+                                                    'fasta': {'shards': 2, 'prefilter': {'enabled': False}}})]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        fasta_reloader.fasta_libraries(self.library_directory)
+
+    def search(self, sequence: str, a_type: str = 'polymer') -> list:
+        """ Returns the results of the FASTA search through the API. """
+
+        response = application.test_client().get("/search/fasta/%s?type=%s" % (sequence, a_type))
+        self.assertEqual(response.status_code, 200)
+        return response.get_json()
+
+    def searched(self) -> list:
+        """ Returns the libraries fasta36 was run on since the last call. """
+
+        path = os.path.join(self.directory, "searched")
+        if not os.path.exists(path):
+            return []
+        with open(path) as searched:
+            libraries = searched.read().split()
+        os.unlink(path)
+        return libraries
+
+    def test_library(self):
+        """ Make sure the sequences are split over the shards in order, that the hits are looked up as the entities
+        they came from, and that the previous libraries are kept until the next rebuild."""
+
+        library = fasta.get_fasta_library()
+        for a_type, sequences in self.sequences.items():
+            self.assertEqual(library.size(a_type), len(sequences))
+            library_sequences = []
+            for library_file in library.library_files(a_type):
+                with open(library_file) as shard:
+                    library_sequences.extend(shard.read().split(">")[1:])
+            self.assertEqual([x.split("\n", 1)[0] for x in library_sequences],
+                             [str(x) for x in range(1, len(sequences) + 1)])
+            self.assertEqual([x.split("\n", 1)[1].replace("\n", "") for x in library_sequences],
+                             [x[3] for x in sequences])
+            self.assertEqual(library.lookup(a_type, 3), list(sequences[2][:3]))
+        self.assertEqual(len(library.library_files('polymer')), 2)
+
+        results = self.search(self.sequences['rna'][0][3], 'rna')
+        self.assertEqual(sorted((x['entry_id'], x['entity_id'], x['entry_title']) for x in results),
+                         sorted(x[:3] for x in self.sequences['rna']))
+        self.assertEqual(sorted(self.searched()), sorted(library.library_files('rna')))
+
+        fasta_reloader.fasta_libraries(self.library_directory)
+        self.assertNotEqual(fasta.get_fasta_library().version, library.version)
+        self.assertTrue(os.path.isdir(library.path))
+        fasta_reloader.fasta_libraries(self.library_directory)
+        self.assertFalse(os.path.exists(library.path))
+
+    def test_result_cache(self):
+        """ Make sure search results are cached per search, prefilter settings, and version of the libraries, and
+        that the cached results of older versions are dropped by a rebuild."""
+
+        library = fasta.get_fasta_library()
+        sequence = self.sequences['polymer'][0][3]
+        key = library.result_key(sequence, 'polymer', None)
+        self.assertEqual(library.result_key(sequence, 'polymer', None), key)
+        self.assertEqual(len({key, library.result_key(sequence[1:], 'polymer', None),
+                              library.result_key(sequence, 'rna', None),
+                              library.result_key(sequence, 'polymer', '0.1')}), 4)
+        with mock.patch.dict(configuration['fasta'], {'prefilter': {'enabled': True}}):
+            self.assertNotEqual(library.result_key(sequence, 'polymer', None), key)
+
+        results = self.search(sequence)
+        self.assertEqual(len(results), len(self.sequences['polymer']))
+        self.assertEqual(len(self.searched()), 2)
+        self.assertEqual(self.search(sequence), results)
+        self.assertEqual(self.searched(), [])
+        self.assertEqual(self.redis.ttls[key], 86400)
+
+        # Another search isn't answered from the cache
+        self.search(sequence[1:])
+        self.assertEqual(len(self.searched()), 2)
+
+        fasta_reloader.fasta_libraries(self.library_directory)
+        self.assertEqual(self.redis.scan_iter(fasta.FASTA_RESULT_KEY % ("*", "*")), [])
+        self.assertEqual(self.search(sequence), results)
+        self.assertEqual(len(self.searched()), 2)
+
+    def test_prefilter(self):
+        """ Make sure the k-mer prefilter keeps every library sequence a query was mutated from, and that only
+        the candidates are searched, with hits looked up as the same entities as without the prefilter."""
+
+        library = fasta.get_fasta_library()
+        kmer_index = library.kmer_index('polymer')
+        self.assertEqual(len(kmer_index), len(self.sequences['polymer']))
+        self.assertEqual(kmer_index.sequence(7), self.sequences['polymer'][7][3])
+
+        # A fifth of the residues substituted
+        generator = random.Random(18)
+        queries = []
+        for position, (_, _, _, sequence) in enumerate(self.sequences['polymer'][:50]):
+            residues = list(sequence)
+            for mutated in generator.sample(range(len(residues)), len(residues) // 5):
+                residues[mutated] = generator.choice("ACDEFGHIKLMNPQRSTVWY")
+            queries.append((position, "".join(residues)))
+        found = sum(position in kmer_index.candidates(query, 2) for position, query in queries)
+        self.assertEqual(found, len(queries))
+
+        settings = {'enabled': True, 'min_query_length': 30, 'min_shared_kmers': 2, 'max_candidates': 1}
+        position, query = queries[0]
+        with mock.patch.dict(configuration['fasta'], {'prefilter': settings}):
+            candidates = kmer_index.candidates(query, 2)
+            self.assertLess(len(candidates), len(kmer_index))
+            results = self.search(query)
+            self.assertEqual(len(self.searched()), 1)
+            self.assertEqual(sorted((x['entry_id'], x['entry_title']) for x in results),
+                             sorted(tuple(library.lookup('polymer', x + 1)[::2]) for x in candidates))
+            self.assertIn(self.sequences['polymer'][position][0], [x['entry_id'] for x in results])
+
+            # Too short to be selective, or too many candidates, so the whole library is searched
+            with tempfile.TemporaryFile() as candidates_file:
+                self.assertIsNone(library.write_candidates('polymer', query[:29], candidates_file))
+                with mock.patch.dict(settings, {'max_candidates': 0.01}):
+                    self.assertIsNone(library.write_candidates('polymer', query, candidates_file))
+                self.assertEqual(candidates_file.tell(), 0)
+            self.assertEqual(len(self.search(query[:29])), len(self.sequences['polymer']))
+            self.assertEqual(len(self.searched()), 2)
+
+
 # Set up the tests
+class TestInstantSearch(unittest.TestCase):
+
+    # ID, title, sub_date, is_metab, extra search term
+    entries = [("15000", "RNA binding protein", datetime.date(2020, 1, 1), False, None),
+               ("15001", "RNA helicase", datetime.date(2021, 1, 1), False, None),
+               ("bmse000001", "RNA nucleotide", datetime.date(2010, 1, 1), True, None),
+               ("16000", "Lysozyme", datetime.date(2019, 1, 1), False, ("RNA polymerase", "Synonym")),
+               ("16001", "Kinase", datetime.date(2018, 1, 1), False, ("RNAi", "Synonym"))]
+
+    def rows(self, *entry_ids, **similarities) -> list:
+        """ Returns the rows of the full search for the entries, with their extra search term if they matched by
+        it. """
+
+        entries = {entry[0]: entry for entry in self.entries}
+        rows = []
+        for entry_id in entry_ids:
+            title, sub_date, is_metab, extra_term = entries[entry_id][1:]
+            rows.append({"id": entry_id, "title": title, "citations": ["Citation of %s" % entry_id],
+                         "authors": ["Author"], "link": "/%s" % entry_id, "sub_date": sub_date,
+                         "data_types": [], "is_metab": str(is_metab), "formula": "C" if is_metab else None,
+                         "inchi": None, "smiles": None, "average_mass": None, "molecular_weight": None,
+                         "monoisotopic_mass": None})
+            if entry_id in similarities:
+                rows[-1].update({"term": extra_term[0], "termname": extra_term[1], "sml": similarities[entry_id]})
+        return rows
+
+    def search(self, term: str, database: str, prefix: bool, results: list):
+        """ Returns the results of the instant search, using either the prefix index or the full search. """
+
+        index = None
+        if prefix:
+            cursor = _FakeCursor(results=[
+                [{"id": entry_id, "title": title, "sub_date": sub_date, "is_metab": is_metab, "has_summary": is_metab}
+                 for entry_id, title, sub_date, is_metab, extra_term in self.entries],
+                [{"id": entry_id, "term": extra_term[0], "termname": extra_term[1]}
+                 for entry_id, title, sub_date, is_metab, extra_term in self.entries if extra_term]])
+            with mock.patch.object(instant_index, 'PostgresConnection', lambda: cursor):
+                index = instant_index.InstantIndex([])
+
+        with mock.patch.object(search_views, 'get_instant_index', lambda versions: index), \
+                mock.patch.object(instant_index, 'PostgresConnection', lambda: _FakeCursor(rows=results[0])), \
+                mock.patch.object(search_views, 'PostgresConnection', lambda: _FakeCursor(results=results)), \
+                mock.patch.object(search_views, 'RedisConnection', _FakeRedis()), \
+                mock.patch.dict(configuration, {'debug': False}):
+            response = application.test_client().get("/search/instant?term=%s&database=%s" % (term, database))
+        return response.get_json()
+
+    def test_prefix_index_parity(self):
+        """ Make sure the prefix index returns the same results in the same order as the full search."""
+
+        everything = self.rows("15000", "15001", "bmse000001", "16000", "16001")
+        for term, database, query_one, query_two in [
+                ("rna", "combined", ["15001", "15000", "bmse000001"], ["16000", "16001"]),
+                ("rna", "macromolecules", ["15001", "15000"], ["16000", "16001"]),
+                ("rna", "metabolomics", ["bmse000001"], []),
+                ("15000", "combined", ["15000"], [])]:
+            full = self.search(term, database, False,
+                               [self.rows(*query_one), self.rows(*query_two, **{"16000": 1.0, "16001": 0.5})])
+            prefix = self.search(term, database, True, [everything])
+            self.assertEqual([result['value'] for result in full], query_one + query_two)
+            self.assertEqual(prefix, full)
+        self.assertEqual([result.get('sml') for result in full], [None])
+
+        # The similarity of extra search terms which don't contain the whole term is that of pg_trgm
+        self.assertEqual(instant_index.similarity("rna", "RNA polymerase"), 1.0)
+        self.assertEqual(instant_index.similarity("rna", "RNAi"), 0.5)
+        self.assertEqual(instant_index.similarity("rna", "rnase a"), 0.33333334)
+        self.assertEqual(instant_index.similarity("", "rna"), 0.0)
+
+    def test_negated_terms(self):
+        """ Make sure negated terms exclude results by their title, citations and extra term, in both queries."""
+
+        cursor = _FakeCursor()
+        with mock.patch.object(search_views, 'PostgresConnection', lambda: cursor), \
+                mock.patch.object(search_views, 'RedisConnection', _FakeRedis()), \
+                mock.patch.dict(configuration, {'debug': False}):
+            response = application.test_client().get("/search/instant?term=ubiquitin not 50%_yield -Folding"
+                                                     "&database=macromolecules")
+        self.assertEqual(response.get_json(), [])
+
+        query_one, query_two = cursor.executed
+        arguments = cursor.arguments[0]
+        self.assertIs(arguments, cursor.arguments[1])
+        self.assertEqual(arguments['term'], "ubiquitin")
+        # Substrings, with the LIKE wildcards escaped
+        self.assertEqual((arguments['negated_0'], arguments['negated_1']), ("%50\\%\\_yield%", "%folding%"))
+        for query in [query_one, query_two]:
+            for position in [0, 1]:
+                self.assertIn("COALESCE(instant_cache.title, '') NOT ILIKE %%(negated_%d)s" % position, query)
+                self.assertIn("FROM unnest(instant_cache.citations) AS citation WHERE citation ILIKE "
+                              "%%(negated_%d)s" % position, query)
+        self.assertNotIn("tt.term, '') NOT ILIKE", query_one)
+        self.assertIn("COALESCE(tt.term, '') NOT ILIKE %(negated_1)s", query_two)
+
+
+class _KeysetCursor(_FakeCursor):
+    """ Runs the paged chemical shift search on the given rows, ordered and compared by keyset like Postgres. """
+
+    def __init__(self, rows: list, real_dict_cursor: bool = False):
+        super().__init__(rows=rows)
+        self.real_dict_cursor = real_dict_cursor
+        self.description = [(column,) for column in search_views.CHEMICAL_SHIFTS_COLUMN_TYPES]
+        self.query = b""
+
+    @staticmethod
+    def key(values) -> tuple:
+        # NULLs sort last, and compare equal to each other
+        return tuple(part for value in values for part in ((True, 0) if value is None else (False, value)))
+
+    def row_key(self, row: dict) -> tuple:
+        return self.key(row[column] for column, sentinel in search_views.CHEMICAL_SHIFTS_KEYSET)
+
+    def execute(self, sql, args=None):
+        super().execute(sql, args)
+        rows = sorted(self.rows, key=self.row_key)
+        if ") > (" in sql:
+            # Each value of the token is passed twice, before the limit
+            after = self.key(args[-1 - 2 * len(search_views.CHEMICAL_SHIFTS_KEYSET):-1:2])
+            rows = [row for row in rows if self.row_key(row) > after]
+        self.results = [rows[:args[-1]]]
+
+    def fetchall(self):
+        if self.real_dict_cursor:
+            return self.results[0]
+        return [tuple(row[column[0]] for column in self.description) for row in self.results[0]]
+
+
+class TestChemicalShifts(unittest.TestCase):
+
+    def setUp(self):
+        # Rows which only differ by a NULL or an empty string, or by a NULL or a number
+        self.rows = []
+        for entry_id in ["2", "1"]:
+            for comp_id in ["", None, "ALA"]:
+                for value in [Decimal("1.50"), None]:
+                    row = dict.fromkeys(search_views.CHEMICAL_SHIFTS_COLUMN_TYPES)
+                    row.update({"Atom_chem_shift.Entry_ID": entry_id, "Atom_chem_shift.Comp_ID": comp_id,
+                                "Atom_chem_shift.Atom_ID": "HA", "Atom_chem_shift.Atom_type": "H",
+                                "Atom_chem_shift.Val": value, "Atom_chem_shift.Comp_index_ID": 1})
+                    self.rows.append(row)
+
+    def get(self, query: str):
+        """ Returns the response of the chemical shift search. """
+
+        with mock.patch.object(search_views, 'PostgresConnection',
+                               lambda real_dict_cursor=False: _KeysetCursor(self.rows, real_dict_cursor)):
+            return application.test_client().get("/search/chemical_shifts?atom_type=H&" + query)
+
+    def test_after_token(self):
+        """ Make sure paging with the 'after' token returns every row once, in the keyset order."""
+
+        expected = [(row["Atom_chem_shift.Entry_ID"], row["Atom_chem_shift.Comp_ID"], row["Atom_chem_shift.Val"])
+                    for row in sorted(self.rows, key=_KeysetCursor(self.rows).row_key)]
+        for limit in [1, 4, 12, 20]:
+            for dictionary_result in [False, True]:
+                paging = "limit=%d%s" % (limit, "&dictionary_result=true" if dictionary_result else "")
+                shifts, query = [], paging
+                while True:
+                    response = self.get(query)
+                    self.assertEqual(response.status_code, 200)
+                    page = response.get_json() if dictionary_result else \
+                        [dict(zip(response.get_json()['columns'], row)) for row in response.get_json()['data']]
+                    shifts.extend((row["Atom_chem_shift.Entry_ID"], row["Atom_chem_shift.Comp_ID"],
+                                   None if row["Atom_chem_shift.Val"] is None else
+                                   Decimal(str(row["Atom_chem_shift.Val"]))) for row in page)
+                    after = response.headers.get('X-Next-After')
+                    if not dictionary_result:
+                        self.assertEqual(response.get_json()['next'], after)
+                    if not after:
+                        break
+                    self.assertEqual(len(page), limit)
+                    query = "%s&after=%s" % (paging, after)
+                self.assertEqual(shifts, expected)
+
+        # The token keeps the exact values
+        token = search_views._encode_after_token(self.rows[0])
+        self.assertEqual(search_views._decode_after_token(token),
+                         [self.rows[0][column] for column, sentinel in search_views.CHEMICAL_SHIFTS_KEYSET])
+        self.assertEqual(str(search_views._decode_after_token(token)[3]), "1.50")
+
+    def test_after_token_errors(self):
+        """ Make sure bad 'after' tokens, and 'after' without 'limit', are rejected."""
+
+        token = search_views._encode_after_token(self.rows[0])
+        self.assertEqual(self.get("after=%s" % token).status_code, 400)
+        self.assertEqual(self.get("limit=5&after=notatoken").status_code, 400)
+        values = [self.rows[0][column] for column, sentinel in search_views.CHEMICAL_SHIFTS_KEYSET]
+        for position, value in [(0, 1), (3, "1.5"), (7, True), (7, Decimal("1.5"))]:
+            bad = list(values)
+            bad[position] = value
+            token = base64.urlsafe_b64encode(json.dumps(bad).encode()).decode()
+            self.assertEqual(self.get("limit=5&after=%s" % token).status_code, 400)
+        token = base64.urlsafe_b64encode(json.dumps(values[1:]).encode()).decode()
+        self.assertEqual(self.get("limit=5&after=%s" % token).status_code, 400)
+
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = _FakeRedis()
+        self.redis.hset("combined:meta", "update_time", "1")
+        self.calls = []
+        self.status = 200
+
+        self.app = Flask(__name__)
+
+        @self.app.route('/view')
+        @decorators.cache_response(ttl=60)
+        def view():
+            self.calls.append(1)
+            response = jsonify({"calls": len(self.calls)})
+            response.headers['X-Test'] = "test"
+            return response, self.status
+
+    def get(self, max_wait: float = 5):
+        """ Returns the response of the cached view. """
+
+        with mock.patch.object(decorators, 'RedisConnection', self.redis), \
+                mock.patch.dict(configuration, {'response_cache': {'max_wait': max_wait, 'lock_timeout': 60}}):
+            return self.app.test_client().get("/view")
+
+    def cached_keys(self) -> list:
+        return [key for key in self.redis.data if key.startswith("response_cache:view:")]
+
+    def test_hit_and_miss(self):
+        """ Make sure a response is computed once and then served from the cache, headers included."""
+
+        first, second = self.get(), self.get()
+        self.assertEqual(first.get_json(), {"calls": 1})
+        self.assertEqual(second.get_json(), {"calls": 1})
+        self.assertEqual(second.headers['X-Test'], "test")
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.redis.ttls[self.cached_keys()[0]], 60)
+        self.assertEqual(self.redis.hgetall(decorators.RESPONSE_CACHE_STATS_KEY),
+                         {b"view:requests": b"2", b"view:misses": b"1", b"view:stores": b"1"})
+        # The lock is released
+        self.assertEqual(len(self.redis.data), 3)
+
+        # Errors aren't cached
+        self.redis.data.clear()
+        self.status = 500
+        self.get()
+        self.get()
+        self.assertEqual(len(self.calls), 3)
+        self.assertEqual(self.cached_keys(), [])
+
+    def test_version_invalidation(self):
+        """ Make sure responses cached for an older version of the data aren't used."""
+
+        self.get()
+        self.redis.hset("combined:meta", "update_time", "2")
+        self.assertEqual(self.get().get_json(), {"calls": 2})
+        self.assertEqual(self.get().get_json(), {"calls": 2})
+        self.assertEqual(len(self.cached_keys()), 2)
+
+    def test_lock_timeout(self):
+        """ Make sure a request waits for the response someone else is computing, but only for max_wait."""
+
+        self.get()
+        key = self.cached_keys()[0]
+        cached = self.redis.data.pop(key)
+        self.redis.set("%s:lock" % key, 1)
+
+        # The response is cached while waiting
+        timer = threading.Timer(0.2, lambda: self.redis.data.__setitem__(key, cached))
+        timer.start()
+        self.assertEqual(self.get().get_json(), {"calls": 1})
+        timer.join()
+        self.assertEqual(len(self.calls), 1)
+
+        # The response isn't cached in time
+        self.redis.data.pop(key)
+        start = time.time()
+        self.assertEqual(self.get(max_wait=0.2).get_json(), {"calls": 2})
+        self.assertLess(time.time() - start, 2)
+        # The lock of the other request is left alone
+        self.assertIn("%s:lock" % key, self.redis.data)
+
+
+class _FakePostgresConnection:
+    """ Stands in for a psycopg2 connection, recording the queries run on it. Queries fail once it is broken. """
+
+    def __init__(self, **kwargs):
+        self.closed = 0
+        self.broken = False
+        self.autocommit = False
+        self.executed = []
+        self.rollbacks = 0
+
+    def cursor(self, **kwargs):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def execute(self, sql, args=None):
+        if self.broken:
+            raise psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.executed.append(sql)
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.InterfaceError("connection already closed")
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = 1
+
+
+class TestPostgresPool(unittest.TestCase):
+
+    def setUp(self):
+        patchers = [mock.patch.object(connections.psycopg2, 'connect', _FakePostgresConnection),
+                    mock.patch.dict(configuration['postgres'], {'pool': {'max_connections': 2, 'checkout_timeout': 0.1,
+                                                                         'health_check_interval': 30}})]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pool = connections._PostgresPool({'host': 'postgres'})
+
+    def test_checkout(self):
+        """ Make sure returned connections are reset and reused, and broken or discarded ones are closed."""
+
+        connection = self.pool.get_connection()
+        connection.executed.clear()
+        self.pool.return_connection(connection)
+        self.assertEqual(connection.executed, ['RESET search_path;'])
+        self.assertEqual(connection.rollbacks, 1)
+        self.assertFalse(connection.autocommit)
+        self.assertIs(self.pool.get_connection(), connection)
+        # Not health checked, since it was only just returned
+        self.assertEqual(connection.executed, ['RESET search_path;'])
+
+        # Broken while it was checked out
+        connection.broken = True
+        self.pool.return_connection(connection)
+        self.assertTrue(connection.closed)
+        replacement = self.pool.get_connection()
+        self.assertIsNot(replacement, connection)
+
+        self.pool.return_connection(replacement, discard=True)
+        self.assertTrue(replacement.closed)
+        self.assertIsNot(self.pool.get_connection(), replacement)
+
+    def test_health_check(self):
+        """ Make sure connections idle for longer than the health check interval are only reused if they answer."""
+
+        healthy, broken = self.pool.get_connection(), self.pool.get_connection()
+        self.pool.return_connection(healthy)
+        self.pool.return_connection(broken)
+        broken.broken = True
+
+        self.pool._health_check_interval = 0
+        self.assertIs(self.pool.get_connection(), healthy)
+        self.assertEqual(healthy.executed[-1], 'SELECT 1;')
+        self.assertTrue(broken.closed)
+
+    def test_checkout_timeout(self):
+        """ Make sure no more than max_connections connections are checked out at once."""
+
+        first, second = self.pool.get_connection(), self.pool.get_connection()
+        with self.assertRaises(connections.ServerException):
+            self.pool.get_connection()
+        self.pool.return_connection(second)
+        self.assertIs(self.pool.get_connection(), second)
+        self.pool.return_connection(first, discard=True)
+        self.assertIsNot(self.pool.get_connection(), first)
+
+    def test_fork(self):
+        """ Make sure a forked process gets new pools, and keeps the ones it inherited from being closed."""
+
+        with mock.patch.object(connections, '_postgres_pools', {}), \
+                mock.patch.object(connections, '_inherited_postgres_pools', []), \
+                mock.patch.object(connections, '_postgres_pools_pid', os.getpid()):
+            parent = connections._get_postgres_pool('read', {'host': 'postgres'})
+            self.assertIs(connections._get_postgres_pool('read', {'host': 'postgres'}), parent)
+
+            connections._postgres_pools_pid = -1
+            child = connections._get_postgres_pool('read', {'host': 'postgres'})
+            self.assertIsNot(child, parent)
+            self.assertEqual(connections._inherited_postgres_pools, [parent])
+            self.assertEqual(connections._postgres_pools_pid, os.getpid())
+            self.assertIs(connections._get_postgres_pool('read', {'host': 'postgres'}), child)
+
+
+class _FakeRedisSocket:
+    """ Stands in for a redis-py Connection, recording whether it is connected. """
+
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+        self.connected = False
+
+    def connect(self):
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def can_read(self):
+        return False
+
+
+class TestRedisPool(unittest.TestCase):
+
+    def test_counters(self):
+        """ Make sure checkouts of idle connections count as hits, and new connections as misses."""
+
+        pool = connections._CountingConnectionPool(connection_class=_FakeRedisSocket, host="redis", port=6379)
+        first = pool.get_connection("GET")
+        pool.release(first)
+        self.assertIs(pool.get_connection("GET"), first)
+        second = pool.get_connection("GET")
+        self.assertIsNot(second, first)
+        pool.release(second)
+        self.assertIs(pool.get_connection("GET"), second)
+
+        with mock.patch.object(connections, '_redis_pool', pool):
+            statistics = connections.get_redis_pool_statistics()
+        self.assertEqual((statistics['checkouts'], statistics['hits'], statistics['misses']), (4, 2, 2))
+
+    def test_invalidate(self):
+        """ Make sure invalidating the pool only closes the connections nobody is using."""
+
+        pool = connections._CountingConnectionPool(connection_class=_FakeRedisSocket)
+        in_use, idle = pool.get_connection("GET"), pool.get_connection("GET")
+        pool.release(idle)
+
+        with mock.patch.object(connections, '_redis_pool', pool):
+            connections._invalidate_redis_pool(pool)
+            self.assertIsNone(connections._redis_pool)
+        self.assertTrue(in_use.connected)
+        self.assertFalse(idle.connected)
+
+        # A pool which already replaced the failed one is kept
+        replacement = connections._CountingConnectionPool(connection_class=_FakeRedisSocket)
+        with mock.patch.object(connections, '_redis_pool', replacement):
+            connections._invalidate_redis_pool(pool)
+            self.assertIs(connections._redis_pool, replacement)
+
+
+class TestEntryFormats(unittest.TestCase):
+
+    star = "data_15000\nsave_entry_information\n_Entry.Sf_category entry_information\n" \
+           "_Entry.Sf_framecode entry_information\n_Entry.ID 15000\nsave_\n"
+
+    def setUp(self):
+        # Other tests cache their own entry 15000
+        entry_cache.invalidate("15000")
+        self.addCleanup(entry_cache.invalidate, "15000")
+        self.entry = pynmrstar.Entry.from_string(self.star)
+        self.redis = _FakeRedis()
+        self.redis.set("macromolecules:entry:15000", zlib.compress(self.entry.get_json().encode()))
+
+    def get(self, query: str):
+        """ Returns the response for the entry, without accepting a compressed response. """
+
+        with mock.patch.object(entry_views, 'RedisConnection', self.redis), \
+                mock.patch.object(querymod, 'RedisConnection', self.redis):
+            return application.test_client().get("/entry/15000?" + query, headers={"Accept-Encoding": "identity"})
+
+    def test_stored_nmrstar(self):
+        """ Make sure both NMR-STAR formats use the NMR-STAR stored by the reloader, and fall back to rendering
+        the entry only when it wasn't stored."""
+
+        self.redis.set("macromolecules:nmrstar:15000", zlib.compress(b"stored rendering"))
+        with mock.patch.object(querymod, 'get_valid_entries_from_redis', side_effect=AssertionError):
+            self.assertEqual(self.get("format=nmrstar").get_json(), {"15000": "stored rendering"})
+            self.assertEqual(self.get("format=rawnmrstar").get_data(), b"stored rendering")
+
+        self.redis.delete("macromolecules:nmrstar:15000")
+        self.assertEqual(self.get("format=nmrstar").get_json(), {"15000": str(self.entry)})
+        self.assertEqual(self.get("format=rawnmrstar").get_data().decode(), str(self.entry))
+
+    def test_deflated_json(self):
+        """ Make sure a format=json entry stored by the reloader is sent as the stored deflate stream to clients that
+        accept it, and that the JSON is the same either way."""
+
+        entry_json = self.entry.get_json().encode()
+        expected = {"15000": json.loads(entry_json)}
+        self.redis.set("macromolecules:entry:15000", compress_spliceable(entry_json))
+        self.redis.hset("macromolecules:entry_info:15000", "json_length", len(entry_json))
+
+        with mock.patch.object(querymod, 'get_valid_entries_from_redis', side_effect=AssertionError), \
+                mock.patch.object(entry_views, 'RedisConnection', self.redis), \
+                mock.patch.object(querymod, 'RedisConnection', self.redis):
+            response = application.test_client().get("/entry/15000", headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(response.content_length, len(response.get_data()))
+        self.assertEqual(json.loads(zlib.decompress(response.get_data())), expected)
+        self.assertEqual(self.get("format=json").get_json(), expected)
+
+        # Not compressed by compress_spliceable(), or stored without the length, so it can't be sent as is
+        self.redis.set("macromolecules:entry:15000", zlib.compress(entry_json))
+        for stored_length in [True, False]:
+            if not stored_length:
+                self.redis.delete("macromolecules:entry_info:15000")
+            with mock.patch.object(entry_views, 'RedisConnection', self.redis), \
+                    mock.patch.object(querymod, 'RedisConnection', self.redis):
+                response = application.test_client().get("/entry/15000", headers={"Accept-Encoding": "deflate"})
+            self.assertEqual(json.loads(response.get_data()), expected)
+
+
+class TestETags(unittest.TestCase):
+
+    def setUp(self):
+        # Other tests cache their own entry 15000
+        entry_cache.invalidate("15000")
+        self.addCleanup(entry_cache.invalidate, "15000")
+        self.entry = pynmrstar.Entry.from_scratch("15000")
+        self.redis = _FakeRedis()
+        self.redis.hset("macromolecules:meta", "update_time", "1")
+        self.redis.rpush("macromolecules:entry_list", "15000")
+        self.redis.set("macromolecules:entry:15000", zlib.compress(self.entry.get_json().encode()))
+        self.redis.hset("macromolecules:entry_info:15000", "hash", "first")
+
+    def get(self, path: str, etag: str = None, encoding: str = "identity"):
+        """ Returns the response, sending the ETag in If-None-Match if one is given. """
+
+        headers = {"Accept-Encoding": encoding}
+        if etag:
+            headers["If-None-Match"] = etag
+        with mock.patch.object(entry_views, 'RedisConnection', self.redis), \
+                mock.patch.object(querymod, 'RedisConnection', self.redis):
+            return application.test_client().get(path, headers=headers)
+
+    def test_entry(self):
+        """ Make sure an entry gets a 304 only while neither the stored entry nor the request changed, without
+        the entry being read."""
+
+        response = self.get("/entry/15000")
+        etag = response.headers['ETag']
+        self.assertEqual(response.status_code, 200)
+
+        with mock.patch.object(querymod, 'get_valid_entries_from_redis', side_effect=AssertionError):
+            response = self.get("/entry/15000", etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b"")
+        self.assertEqual(response.headers['ETag'], etag)
+
+        # The response would be different
+        for path, encoding in [("/entry/15000?format=rawnmrstar", "identity"), ("/entry/15000", "deflate")]:
+            response = self.get(path, etag, encoding)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+        self.redis.hset("macromolecules:entry_info:15000", "hash", "second")
+        response = self.get("/entry/15000", etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        # Stored before there were hashes
+        self.redis.delete("macromolecules:entry_info:15000")
+        response = self.get("/entry/15000", etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_entry_list(self):
+        """ Make sure the entry list gets a 304 until the database is reloaded."""
+
+        response = self.get("/list_entries?database=macromolecules")
+        etag = response.headers['ETag']
+        self.assertEqual(response.get_json(), ["15000"])
+        self.assertEqual(self.get("/list_entries?database=macromolecules", etag).status_code, 304)
+
+        self.redis.hset("macromolecules:meta", "update_time", "2")
+        response = self.get("/list_entries?database=macromolecules", etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+
+class TestHsqc(unittest.TestCase):
+
+    star = """data_15000
+save_shifts
+   _Assigned_chem_shift_list.Sf_category assigned_chemical_shifts
+   _Assigned_chem_shift_list.Sf_framecode shifts
+   _Assigned_chem_shift_list.ID 1
+   _Assigned_chem_shift_list.Entry_ID 15000
+   loop_
+      _Atom_chem_shift.ID
+      _Atom_chem_shift.Entity_assembly_ID
+      _Atom_chem_shift.Entity_ID
+      _Atom_chem_shift.Comp_index_ID
+      _Atom_chem_shift.Seq_ID
+      _Atom_chem_shift.Comp_ID
+      _Atom_chem_shift.Atom_ID
+      _Atom_chem_shift.Atom_type
+      _Atom_chem_shift.Val
+      _Atom_chem_shift.Entry_ID
+      _Atom_chem_shift.Assigned_chem_shift_list_ID
+      1  1 1 1 1 ALA H    H 8.123    15000 1
+      2  1 1 1 1 ALA N    N 121.4567 15000 1
+      3  1 1 2 2 ASN H    H 8.4      15000 1
+      4  1 1 2 2 ASN N    N 118.2    15000 1
+      5  1 1 2 2 ASN HD21 H 7.5      15000 1
+      6  1 1 2 2 ASN HD22 H 6.9      15000 1
+      7  1 1 2 2 ASN ND2  N 112.7    15000 1
+      8  1 1 3 3 TRP H    H 7.9      15000 1
+      9  1 1 3 3 TRP N    N 120.0    15000 1
+      10 1 1 3 3 TRP HE1  H 10.1     15000 1
+      11 1 1 3 3 TRP NE1  N 129.3    15000 1
+   stop_
+save_
+"""
+
+    def setUp(self):
+        # Other tests cache their own entry 15000
+        entry_cache.invalidate("15000")
+        self.addCleanup(entry_cache.invalidate, "15000")
+        self.entry = pynmrstar.Entry.from_string(self.star)
+        self.redis = _FakeRedis()
+        self.redis.hset("macromolecules:meta", "update_time", "1")
+        self.redis.set("macromolecules:entry:15000", zlib.compress(self.entry.get_json().encode()))
+        self.redis.hset("macromolecules:entry_info:15000", "hash", "first")
+
+    def test_formats(self):
+        """ Make sure the peak lists rendered from the cached peaks are the same as PyBMRB's, with and without the
+        side chain peaks."""
+
+        from pybmrb import Spectra
+
+        peak_list = Spectra.create_n15hsqc_peaklist(entry_objects=self.entry, include_sidechain=True)
+        peaks = json.loads(json.dumps(hsqc.make_peak_list(self.entry)))
+        self.assertEqual(len(peaks), 6)
+
+        for include_sidechain in [True, False]:
+            self.assertEqual(hsqc.render_peak_list(peaks, 'json', include_sidechain),
+                             Spectra.export_peak_list(peak_list, include_side_chain=include_sidechain))
+            for format_ in ['csv', 'sparky']:
+                with tempfile.NamedTemporaryFile(mode="r") as output_file:
+                    Spectra.export_peak_list(peak_list, output_file_name=output_file.name, output_format=format_,
+                                             include_side_chain=include_sidechain)
+                    self.assertEqual(hsqc.render_peak_list(peaks, format_, include_sidechain), output_file.read())
+        self.assertEqual(len(hsqc.render_peak_list(peaks, 'json', False)['sequence']), 3)
+
+    def test_json(self):
+        """ Make sure format=json returns the columns of the peaks, and that the peaks are only simulated once per
+        version of the entry."""
+
+        with mock.patch.object(entry_views, 'RedisConnection', self.redis), \
+                mock.patch.object(querymod, 'RedisConnection', self.redis), \
+                mock.patch.object(hsqc, 'RedisConnection', self.redis), \
+                mock.patch.object(hsqc, 'make_peak_list', wraps=hsqc.make_peak_list) as make_peak_list:
+            client = application.test_client()
+            backbone = client.get("/entry/15000/simulate_hsqc?format=json&filter=backbone").get_json()
+            everything = client.get("/entry/15000/simulate_hsqc?format=json").get_json()
+            self.assertEqual(make_peak_list.call_count, 1)
+
+            self.redis.hset("macromolecules:entry_info:15000", "hash", "second")
+            self.assertEqual(client.get("/entry/15000/simulate_hsqc?format=json").get_json(), everything)
+            self.assertEqual(make_peak_list.call_count, 2)
+
+        self.assertEqual(backbone, {'sequence': ['1', '2', '3'], 'chem_comp_ID': ['ALA', 'ASN', 'TRP'],
+                                    'X_shift': [8.123, 8.4, 7.9], 'Y_shift': [121.4567, 118.2, 120.0],
+                                    'X_atom_name': ['H', 'H', 'H'], 'Y_atom_name': ['N', 'N', 'N']})
+        self.assertEqual(everything['X_atom_name'], ['H', 'H', 'HD21', 'HD22', 'H', 'HE1'])
+        self.assertEqual(self.redis.ttls["hsqc:peaks:15000:first"], 2592000)
+
+
+class TestEntryFetching(unittest.TestCase):
+
+    def setUp(self):
+        self.redis = _FakeRedis()
+        self.redis.hset("macromolecules:meta", "update_time", "1")
+        self.entries = {}
+        for entry_id in ["1", "2", "3", "4", "5"]:
+            self.entries[entry_id] = pynmrstar.Entry.from_scratch(entry_id)
+            self.redis.set("macromolecules:entry:%s" % entry_id,
+                           zlib.compress(self.entries[entry_id].get_json().encode()))
+
+    def fetch(self, entry_ids: list, format_: str, consumed: list) -> None:
+        """ Fetches the entries in chunks of two, adding each to consumed as it is yielded. """
+
+        with mock.patch.object(querymod, 'RedisConnection', self.redis), \
+                mock.patch.dict(configuration['redis'], {'fetch_chunk_size': 2}):
+            for entry_id, entry in querymod.get_valid_entries_from_redis(entry_ids, format_=format_):
+                consumed.append((entry_id, entry))
+
+    def test_order(self):
+        """ Make sure entries come back in the order requested, whether or not they were in the entry cache."""
+
+        entry_ids = ["5", "2", "4", "1", "3"]
+        entry_cache.invalidate("4")
+        entry_cache.put("2", "1", self.entries["2"], 10)
+
+        for format_ in ["object", "json", "nmrstar"]:
+            consumed = []
+            self.fetch(entry_ids, format_, consumed)
+            self.assertEqual([entry_id for entry_id, entry in consumed], entry_ids)
+            for entry_id, entry in consumed:
+                if format_ == "object":
+                    self.assertEqual(entry, self.entries[entry_id])
+                elif format_ == "json":
+                    self.assertEqual(pynmrstar.Entry.from_json(json.loads(entry)), self.entries[entry_id])
+                else:
+                    self.assertEqual(entry, str(self.entries[entry_id]))
+        entry_cache.invalidate("2")
+
+    def test_missing(self):
+        """ Make sure a missing ID raises a 404 when it is reached, after the entries before it were yielded."""
+
+        for entry_ids, before in [(["3", "1", "missing", "2"], ["3", "1"]), (["3", "missing", "2"], ["3"]),
+                                  (["missing"], [])]:
+            consumed = []
+            with self.assertRaises(querymod.RequestException) as context:
+                self.fetch(entry_ids, "object", consumed)
+            self.assertEqual(context.exception.status_code, 404)
+            self.assertIn("'missing'", str(context.exception.message))
+            self.assertEqual([entry_id for entry_id, entry in consumed], before)
+
+
+class TestPartialEntry(unittest.TestCase):
+
+    star = "data_15000\n" \
+           "save_entry_information\n_Entry.Sf_category entry_information\n_Entry.Sf_framecode entry_information\n" \
+           "_Entry.ID 15000\nloop_\n_Entry_author.Ordinal\n_Entry_author.Family_name\n1 Smith\nstop_\nsave_\n" \
+           "save_shifts\n_Assigned_chem_shift_list.Sf_category assigned_chemical_shifts\n" \
+           "_Assigned_chem_shift_list.Sf_framecode shifts\n_Assigned_chem_shift_list.ID 1\n" \
+           "loop_\n_Atom_chem_shift.ID\n_Atom_chem_shift.Val\n1 8.5\n2 4.2\nstop_\nsave_\n"
+
+    def setUp(self):
+        # Other tests cache their own entry 15000
+        entry_cache.invalidate("15000")
+        self.addCleanup(entry_cache.invalidate, "15000")
+        self.entry = pynmrstar.Entry.from_string(self.star)
+        self.redis = _FakeRedis()
+        self.redis.hset("macromolecules:meta", "update_time", "1")
+        self.redis.set("macromolecules:entry:15000", zlib.compress(self.entry.get_json().encode()))
+        self.redis.hset("macromolecules:entry_index:15000", mapping=querymod.make_entry_index(self.entry))
+
+    def get(self, full: bool, **kwargs) -> pynmrstar.Entry:
+        """ Returns the partial entry, making sure whether or not the full entry was fetched for it. """
+
+        with mock.patch.object(querymod, 'RedisConnection', self.redis), \
+                mock.patch.object(querymod, 'get_valid_entries_from_redis',
+                                  wraps=querymod.get_valid_entries_from_redis) as get_full_entry:
+            entry_id, entry = querymod.get_partial_entry_from_redis("15000", **kwargs)
+        self.assertEqual(entry_id, "15000")
+        self.assertEqual(get_full_entry.called, full)
+        return entry
+
+    def test_partial(self):
+        """ Make sure only the saveframes that can match are read, and give the same results as the full entry."""
+
+        for kwargs, names in [({'saveframe_names': ['shifts']}, ['shifts']),
+                              ({'saveframe_categories': ['entry_information']}, ['entry_information']),
+                              ({'loop_categories': ['_Atom_chem_shift']}, ['shifts']),
+                              ({'tags': ['_Entry.ID']}, ['entry_information']),
+                              ({'tags': ['_Entry_author.Family_name']}, ['entry_information']),
+                              ({'saveframe_names': ['missing']}, [])]:
+            entry = self.get(False, **kwargs)
+            self.assertEqual([frame.name for frame in entry.frame_list], names)
+            for name in names:
+                self.assertEqual(entry.get_saveframe_by_name(name), self.entry.get_saveframe_by_name(name))
+
+        entry = self.get(False, loop_categories=['_Atom_chem_shift'])
+        self.assertEqual(entry.get_loops_by_category('_Atom_chem_shift'),
+                         self.entry.get_loops_by_category('_Atom_chem_shift'))
+        self.assertEqual(entry.get_tag('_Atom_chem_shift.Val'), ['8.5', '4.2'])
+
+    def test_fallback(self):
+        """ Make sure the full entry is used when there is no index, or a saveframe changed while it was read."""
+
+        del self.redis.data["macromolecules:entry_index:15000"][b"frame:shifts"]
+        self.assertEqual(self.get(True, saveframe_names=['shifts']), self.entry)
+        # The saveframes that are still there are still read on their own
+        self.assertEqual(len(self.get(False, saveframe_names=['entry_information']).frame_list), 1)
+
+        self.redis.delete("macromolecules:entry_index:15000")
+        self.assertEqual(self.get(True, saveframe_names=['shifts']), self.entry)
+
+
 def run_test(conf_url=querymod.configuration.get('url', None)):
     """ Run the unit tests and make sure the server is online."""
 
@@ -132,7 +1995,7 @@ def run_test(conf_url=querymod.configuration.get('url', None)):
     results = StringIO()
 
     # Run the test
-    demo_test = unittest.TestLoader().loadTestsFromTestCase(TestAPI)
+    demo_test = unittest.TestLoader().loadTestsFromModule(sys.modules[__name__])
     unittest.TextTestRunner(stream=results).run(demo_test)
 
     # See if the end of the results says it passed
@@ -0,0 +1,257 @@
+""" The validation reports of entries: the AVS assignment validation and the PANAV chemical shift referencing
+check of each chemical shift loop.
+
+A report only depends on the stored entry and the versions of the tools, so reports are cached in Redis under the
+hash of the stored entry and the tool version. Released entries are cached for validation.cache_ttl seconds (the
+reloader can fill the cache ahead of time with --validation), uploaded entries for as long as the upload is kept. """
+
+import copy
+import os
+import subprocess
+import tempfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from typing import Optional
+
+import pynmrstar
+import simplejson as json
+
+from bmrbapi.exceptions import RequestException, ServerException
+from bmrbapi.utils import querymod
+from bmrbapi.utils.configuration import configuration
+from bmrbapi.utils.connections import RedisConnection
+from bmrbapi.utils.panav import PANAV_JAR, panav_workers, run_panav
+
+AVS_SCRIPT = os.path.join(querymod.SUBMODULE_DIR, "avs", "validate_assignments_31.pl")
+VALIDATION_KEY = "validation:%s:%s:%s"
+
+# Errors which come from the server being busy rather than from the entry
+AVS_TIMEOUT_ERROR = "AVS took too long on this entry."
+PANAV_TIMEOUT_ERROR = "PANAV took too long on this entry."
+PANAV_UNAVAILABLE_ERROR = "PANAV stopped unexpectedly on this entry. Please try again later."
+TEMPORARY_ERRORS = {AVS_TIMEOUT_ERROR, PANAV_TIMEOUT_ERROR, PANAV_UNAVAILABLE_ERROR}
+
+_tool_version: Optional[str] = None
+
+
+def get_tool_version() -> str:
+    """ Returns a version of AVS and PANAV together, which changes whenever either of them is updated. """
+
+    global _tool_version
+
+    if _tool_version is None:
+        tools_hash = md5()
+        for tool in [AVS_SCRIPT, PANAV_JAR]:
+            with open(tool, 'rb') as tool_file:
+                tools_hash.update(tool_file.read())
+        _tool_version = tools_hash.hexdigest()[:12]
+    return _tool_version
+
+
+def get_validation_key(entry_id: str, entry_hash: str) -> str:
+    """ Returns the Redis key of the cached validation report of the entry. """
+
+    return VALIDATION_KEY % (entry_id, entry_hash, get_tool_version())
+
+
+def panav_parser(panav_text: bytes) -> dict:
+    """ Parses the PANAV data into something jsonify-able."""
+
+    panav_text: str = panav_text.decode()
+
+    lines = panav_text.split("\n")
+
+    # Initialize the result dictionary
+    result = {'offsets': {}, 'deviants': [], 'suspicious': [], 'text': panav_text}
+
+    # Variables to keep track of output line numbers
+    deviant_line = 5
+    suspicious_line = 6
+
+    # There is an error
+    if len(lines) < 3:
+        raise ServerException("PANAV failed to produce expected output. Output: %s" % panav_text)
+
+    # Check for unusual output
+    if "No reference" in lines[0]:
+        # Handle the special case when no offsets
+        result['offsets'] = {'CO': float(0), 'CA': float(0), 'CB': float(0), 'N': float(0)}
+        deviant_line = 1
+        suspicious_line = 2
+    # Normal output
+    else:
+        result['offsets']['CO'] = float(lines[1].split(" ")[-1].replace("ppm", ""))
+        result['offsets']['CA'] = float(lines[2].split(" ")[-1].replace("ppm", ""))
+        result['offsets']['CB'] = float(lines[3].split(" ")[-1].replace("ppm", ""))
+        result['offsets']['N'] = float(lines[4].split(" ")[-1].replace("ppm", ""))
+
+    # Figure out how many deviant and suspicious shifts were detected
+    num_deviants = int(lines[deviant_line].rstrip().split(" ")[-1])
+    num_suspicious = int(lines[suspicious_line + num_deviants].rstrip().split(" ")[-1])
+    suspicious_line += num_deviants + 1
+    deviant_line += 1
+
+    # Get the deviants
+    for deviant in lines[deviant_line:deviant_line + num_deviants]:
+        res_num, res, atom, shift = deviant.strip().split(" ")
+        result['deviants'].append({"residue_number": res_num, "residue_name": res,
+                                   "atom": atom, "chemical_shift_value": shift})
+
+    # Get the suspicious shifts
+    for suspicious in lines[suspicious_line:suspicious_line + num_suspicious]:
+        res_num, res, atom, shift = suspicious.strip().split(" ")
+        result['suspicious'].append({"residue_number": res_num, "residue_name": res,
+                                     "atom": atom, "chemical_shift_value": shift})
+
+    # Return the result dictionary
+    return result
+
+
+def _run_panav(loop: bytes) -> dict:
+    """ Returns the parsed PANAV results for a chemical shift loop. """
+
+    try:
+        # There is a -j option that produces a somewhat usable JSON...
+        return panav_parser(run_panav(loop))
+    except subprocess.CalledProcessError:
+        return {"error": "PANAV failed on this entry."}
+    except (OSError, ValueError):
+        # The worker died, or its response couldn't be understood
+        return {"error": PANAV_UNAVAILABLE_ERROR}
+    except subprocess.TimeoutExpired:
+        return {"error": PANAV_TIMEOUT_ERROR}
+
+
+def _avs_result(output: bytes) -> dict:
+    """ Returns the AVS analysis loop from the AVS output. """
+
+    error_loop = pynmrstar.Entry.from_string(output.decode())
+    try:
+        error_loop = error_loop.get_loops_by_category("_AVS_analysis_r")[0]
+    except IndexError:
+        return {'error': "AVS failed to run on this entry."}
+    error_loop = error_loop.filter(["Assembly_ID", "Entity_assembly_ID",
+                                    "Entity_ID", "Comp_index_ID",
+                                    "Comp_ID",
+                                    "Comp_overall_assignment_score",
+                                    "Comp_typing_score",
+                                    "Comp_SRO_score",
+                                    "Comp_1H_shifts_analysis_status",
+                                    "Comp_13C_shifts_analysis_status",
+                                    "Comp_15N_shifts_analysis_status"])
+    error_loop.category = "AVS_analysis"
+    return error_loop.get_json(serialize=False)
+
+
+def _run_panav_loops(entry: pynmrstar.Entry, avs_columns: bool, parallelism: int) -> dict:
+    """ Returns the PANAV results of each chemical shift loop of the entry. With avs_columns, the loops get the
+    analysis status columns that are added when AVS succeeds. """
+
+    # Don't touch the cached copy of the entry
+    shift_loops = copy.deepcopy(entry.get_loops_by_category("atom_chem_shift"))
+    if avs_columns:
+        for loop in shift_loops:
+            loop.add_tag(["AVS_analysis_status", "PANAV_analysis_status"])
+            for row in loop.data:
+                row.extend(["Consistent", "Consistent"])
+
+    parallelism = max(1, min(len(shift_loops), panav_workers(), parallelism))
+    with ThreadPoolExecutor(max_workers=parallelism) as executor:
+        outputs = executor.map(_run_panav, [str(cs_loop).encode() for cs_loop in shift_loops])
+        return dict(enumerate(outputs))
+
+
+def validate_entry(entry_id: str, entry: pynmrstar.Entry) -> dict:
+    """ Runs AVS and PANAV on the entry and returns the validation report. AVS runs on the whole entry while PANAV
+    runs on the chemical shift loops, using at most validation.parallelism processes at a time between them.
+
+    The chemical shift loops only get the analysis status columns if AVS succeeds. Since that is almost always the
+    case, PANAV runs on the loops with the columns while AVS works, and again without them if AVS fails. """
+
+    settings = configuration.get('validation', {})
+    timeout = settings.get('timeout', 600)
+    has_shift_loops = bool(entry.get_loops_by_category("atom_chem_shift"))
+
+    result = {'avs': {}}
+    panav = {}
+    # Put the entry in a file
+    with tempfile.NamedTemporaryFile(dir="/dev/shm") as star_file:
+        star_file.write(str(entry).encode())
+        star_file.flush()
+
+        # Start AVS, and run PANAV while it works. A thread reads the output of AVS as it is written, since AVS
+        #  would stop once the pipe is full.
+        avs = subprocess.Popen([AVS_SCRIPT, entry_id, "-nitrogen", "-fmean",
+                                "-aromatic", "-std", "-anomalous", "-suspicious",
+                                "-star_output", star_file.name], stdout=subprocess.PIPE)
+        with ThreadPoolExecutor(max_workers=1) as avs_executor:
+            avs_output = avs_executor.submit(avs.communicate, timeout=timeout)
+            try:
+                if has_shift_loops:
+                    panav = _run_panav_loops(entry, True, settings.get('parallelism', 4) - 1)
+                res = avs_output.result()[0]
+            except subprocess.TimeoutExpired:
+                avs.kill()
+                avs.communicate()
+                result["avs"] = {'error': AVS_TIMEOUT_ERROR}
+            except BaseException:
+                avs.kill()
+                avs.wait()
+                raise
+            else:
+                if avs.returncode:
+                    raise subprocess.CalledProcessError(avs.returncode, avs.args, output=res)
+                result["avs"] = _avs_result(res)
+
+    if has_shift_loops:
+        # There is at least one chem shift saveframe for this entry
+        if 'error' in result["avs"]:
+            panav = _run_panav_loops(entry, False, settings.get('parallelism', 4))
+        result["panav"] = panav
+
+    return result
+
+
+def has_temporary_error(report: dict) -> bool:
+    """ Returns whether AVS or PANAV failed on the entry only because the server was busy. """
+
+    results = [report.get('avs', {})] + list(report.get('panav', {}).values())
+    return any(result.get('error') in TEMPORARY_ERRORS for result in results)
+
+
+def get_validation_report(entry_id: str, refresh: bool = False) -> dict:
+    """ Returns the validation report of the entry from the cache, or runs the validation and caches the report.
+    With refresh, the validation is run even if a report is cached. Reports with temporary errors are only cached
+    for validation.error_cache_ttl seconds, so they are soon run again. """
+
+    entry_hash = querymod.get_entry_hash(entry_id)
+    key = get_validation_key(entry_id, entry_hash) if entry_hash else None
+    uploaded = len(entry_id) == 32
+    ttl = configuration['redis']['upload_timeout'] if uploaded else \
+        configuration.get('validation', {}).get('cache_ttl', 2592000)
+
+    if key and ttl and not refresh:
+        with RedisConnection() as r:
+            cached = r.get(key)
+            if cached:
+                report = json.loads(zlib.decompress(cached))
+                if uploaded and not has_temporary_error(report):
+                    r.expire(key, ttl)
+                return report
+
+    try:
+        entry_id, entry = next(querymod.get_valid_entries_from_redis(entry_id))
+    except StopIteration:
+        raise RequestException("Entry '%s' does not exist in the public database." % entry_id)
+    report = validate_entry(entry_id, entry)
+
+    if key and ttl:
+        # The report uses the same (string) keys as when it is sent, so cached and fresh reports look the same
+        report = json.loads(json.dumps(report))
+        if has_temporary_error(report):
+            ttl = min(ttl, configuration.get('validation', {}).get('error_cache_ttl', 60))
+        if ttl:
+            with RedisConnection() as r:
+                r.set(key, zlib.compress(json.dumps(report, separators=(',', ':')).encode()), ex=ttl)
+    return report
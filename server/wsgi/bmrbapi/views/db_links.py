@@ -3,6 +3,7 @@ from flask import Blueprint, Response, request, jsonify
 import bmrbapi.views.sql.db_links as sql_statements
 from bmrbapi.exceptions import RequestException
 from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.decorators import cache_response
 
 # Set up the blueprint
 db_endpoints = Blueprint('db_links', __name__)
@@ -41,6 +42,7 @@ def mapping_helper(direction: str):
 
 
 @db_endpoints.route('/mappings/uniprot/uniprot')
+@cache_response(ttl=86400)
 def uniprot_mappings_internal():
     """ Returns a list of the UniProt->UniProt where there is a BMRB record
     for the protein."""
@@ -49,6 +51,7 @@ def uniprot_mappings_internal():
 
 
 @db_endpoints.route('/mappings/uniprot/bmrb')
+@cache_response(ttl=86400)
 def uniprot_bmrb_map():
     """ Returns a list of the UniProt->BMRB mappings."""
 
@@ -56,6 +59,7 @@ def uniprot_bmrb_map():
 
 
 @db_endpoints.route('/mappings/bmrb/uniprot')
+@cache_response(ttl=86400)
 def bmrb_uniprot_map():
     """ Returns a list of the BMRB->UniProt mappings."""
 
@@ -63,6 +67,7 @@ def bmrb_uniprot_map():
 
 
 @db_endpoints.route('/mappings/pdb/bmrb')
+@cache_response(ttl=86400)
 def pdb_bmrb_map():
     """ Returns a list of the PDB->BMRB mappings."""
 
@@ -70,6 +75,7 @@ def pdb_bmrb_map():
 
 
 @db_endpoints.route('/mappings/bmrb/pdb')
+@cache_response(ttl=86400)
 def bmrb_pdb_map():
     """ Returns a list of the BMRB-PDB mappings."""
 
@@ -78,6 +84,7 @@ def bmrb_pdb_map():
 
 @db_endpoints.route('/protein/uniprot')
 @db_endpoints.route('/protein/uniprot/<accession_id>')
+@cache_response(ttl=86400)
 def uniprot(accession_id=None):
     """ Returns either a list of objects, or just a single object,
         in the appropriate format.
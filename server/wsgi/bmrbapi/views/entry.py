@@ -1,26 +1,64 @@
-import os
-import subprocess
-import tempfile
 import zlib
 from hashlib import md5
 from time import time as unix_time
-from typing import List, Dict, Union
+from typing import List, Dict, Optional, Union
 
 import pynmrstar
 import werkzeug.utils
-from flask import Blueprint, Response, request, jsonify, send_file, make_response
+from flask import Blueprint, Response, request, jsonify, make_response, after_this_request, url_for
 from pybtex.database import Entry, Person
 
-from bmrbapi.exceptions import ServerException, RequestException
+from bmrbapi.exceptions import RequestException
+from bmrbapi.schemas.entry import ValidateEntry
 from bmrbapi.utils import querymod
 from bmrbapi.utils.configuration import configuration
 from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+from bmrbapi.utils.entry_cache import entry_cache
+from bmrbapi.utils.hsqc import get_hsqc_html, get_peak_list, render_peak_list
+from bmrbapi.utils.jobs import enqueue_job
 from bmrbapi.utils.querymod import get_valid_entries_from_redis
+from bmrbapi.utils.validation import get_validation_report
 
 entry_endpoints = Blueprint('entry', __name__)
 
 
 # Helper functions defined before the views
+def make_etag(*versions) -> str:
+    """ Returns a strong ETag for a response that is determined by the given versions and the query arguments. """
+
+    parts = [str(x) for x in versions] + sorted("%s=%s" % x for x in request.args.items(multi=True))
+    return md5("\n".join(parts).encode()).hexdigest()
+
+
+def use_etag(etag: str) -> Optional[Response]:
+    """ Sends the given ETag with the response to this request. If the client already has the response with that
+    ETag, returns the 304 response to send instead. """
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    @after_this_request
+    def add_etag(response: Response) -> Response:
+        if response.status_code == 200:
+            response.set_etag(etag)
+        return response
+
+
+def send_deflated(data: bytes, mimetype: str) -> Response:
+    """ Sends zlib compressed data as is if the client accepts the deflate encoding, and decompresses it
+    otherwise. """
+
+    if request.accept_encodings.quality('deflate') > 0:
+        response = Response(data, mimetype=mimetype)
+        response.headers['Content-Encoding'] = 'deflate'
+    else:
+        response = Response(zlib.decompress(data), mimetype=mimetype)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 def check_valid(entry_id) -> None:
     """ Checks if a given entry ID exists in redis. If not, throws a RequestException."""
 
@@ -39,7 +77,7 @@ def get_tags(entry_id: str, search_tags: List[str]) -> Dict[str, Dict[str, List[
                                    "example, use 'Entry.Title' rather than 'Title'.")
 
     # Go through the IDs
-    entry = next(get_valid_entries_from_redis(entry_id))
+    entry = querymod.get_partial_entry_from_redis(entry_id, tags=search_tags)
     try:
         return {entry[0]: entry[1].get_tags(search_tags)}
     # They requested a tag that doesn't exist
@@ -53,18 +91,18 @@ def get_loops_by_category(entry_id: str, loop_categories: List[str], format_: st
     result = {}
 
     # Go through the IDs
-    for entry in get_valid_entries_from_redis(entry_id):
-        result[entry[0]] = {}
-        for loop_category in loop_categories:
-            matches = entry[1].get_loops_by_category(loop_category)
+    entry = querymod.get_partial_entry_from_redis(entry_id, loop_categories=loop_categories)
+    result[entry[0]] = {}
+    for loop_category in loop_categories:
+        matches = entry[1].get_loops_by_category(loop_category)
 
-            if format_ == "rawnmrstar":
-                response = make_response("\n".join([str(x) for x in matches]), 200)
-                response.mimetype = "text/plain"
-                return response
-            else:
-                matching_loops = [x.get_json(serialize=False) for x in matches]
-            result[entry[0]][loop_category] = matching_loops
+        if format_ == "rawnmrstar":
+            response = make_response("\n".join([str(x) for x in matches]), 200)
+            response.mimetype = "text/plain"
+            return response
+        else:
+            matching_loops = [x.get_json(serialize=False) for x in matches]
+        result[entry[0]][loop_category] = matching_loops
 
     return jsonify(result)
 
@@ -75,7 +113,7 @@ def get_saveframes_by_category(entry_id: str, saveframe_categories: List[str], f
     result = {}
 
     # Go through the IDs
-    entry = next(get_valid_entries_from_redis(entry_id))
+    entry = querymod.get_partial_entry_from_redis(entry_id, saveframe_categories=saveframe_categories)
     result[entry[0]] = {}
     for saveframe_category in saveframe_categories:
         matches = entry[1].get_saveframes_by_category(saveframe_category)
@@ -95,7 +133,7 @@ def get_saveframes_by_name(entry_id: str, saveframe_names: List[str], format_: s
     result = {}
 
     # Go through the IDs
-    entry = next(get_valid_entries_from_redis(entry_id))
+    entry = querymod.get_partial_entry_from_redis(entry_id, saveframe_names=saveframe_names)
     result[entry[0]] = {}
     for saveframe_name in saveframe_names:
         try:
@@ -112,59 +150,6 @@ def get_saveframes_by_name(entry_id: str, saveframe_names: List[str], format_: s
     return jsonify(result)
 
 
-def panav_parser(panav_text: bytes) -> dict:
-    """ Parses the PANAV data into something jsonify-able."""
-
-    panav_text: str = panav_text.decode()
-
-    lines = panav_text.split("\n")
-
-    # Initialize the result dictionary
-    result = {'offsets': {}, 'deviants': [], 'suspicious': [], 'text': panav_text}
-
-    # Variables to keep track of output line numbers
-    deviant_line = 5
-    suspicious_line = 6
-
-    # There is an error
-    if len(lines) < 3:
-        raise ServerException("PANAV failed to produce expected output. Output: %s" % panav_text)
-
-    # Check for unusual output
-    if "No reference" in lines[0]:
-        # Handle the special case when no offsets
-        result['offsets'] = {'CO': float(0), 'CA': float(0), 'CB': float(0), 'N': float(0)}
-        deviant_line = 1
-        suspicious_line = 2
-    # Normal output
-    else:
-        result['offsets']['CO'] = float(lines[1].split(" ")[-1].replace("ppm", ""))
-        result['offsets']['CA'] = float(lines[2].split(" ")[-1].replace("ppm", ""))
-        result['offsets']['CB'] = float(lines[3].split(" ")[-1].replace("ppm", ""))
-        result['offsets']['N'] = float(lines[4].split(" ")[-1].replace("ppm", ""))
-
-    # Figure out how many deviant and suspicious shifts were detected
-    num_deviants = int(lines[deviant_line].rstrip().split(" ")[-1])
-    num_suspicious = int(lines[suspicious_line + num_deviants].rstrip().split(" ")[-1])
-    suspicious_line += num_deviants + 1
-    deviant_line += 1
-
-    # Get the deviants
-    for deviant in lines[deviant_line:deviant_line + num_deviants]:
-        res_num, res, atom, shift = deviant.strip().split(" ")
-        result['deviants'].append({"residue_number": res_num, "residue_name": res,
-                                   "atom": atom, "chemical_shift_value": shift})
-
-    # Get the suspicious shifts
-    for suspicious in lines[suspicious_line:suspicious_line + num_suspicious]:
-        res_num, res, atom, shift = suspicious.strip().split(" ")
-        result['suspicious'].append({"residue_number": res_num, "residue_name": res,
-                                     "atom": atom, "chemical_shift_value": shift})
-
-    # Return the result dictionary
-    return result
-
-
 @entry_endpoints.route('/entry', methods=['POST'])
 @entry_endpoints.route('/entry/<entry_id>', methods=['GET'])
 def get_entry(entry_id=None):
@@ -196,6 +181,8 @@ def get_entry(entry_id=None):
         with RedisConnection() as r:
             r.setex("uploaded:entry:%s" % key, configuration['redis']['upload_timeout'],
                     zlib.compress(parsed_star.get_json(serialize=True).encode()))
+        # Uploaded entries all have the same version, so don't keep serving an object parsed before the re-post
+        entry_cache.invalidate(key)
 
         return jsonify({"entry_id": key, "expiration": unix_time() + configuration['redis']['upload_timeout']})
 
@@ -204,6 +191,13 @@ def get_entry(entry_id=None):
         # Make sure it is a valid entry
         check_valid(entry_id)
 
+        # Don't send the entry again if the client has this version of it
+        entry_hash = querymod.get_entry_hash(entry_id)
+        if entry_hash:
+            not_modified = use_etag(make_etag(entry_hash, request.accept_encodings.quality('deflate') > 0))
+            if not_modified:
+                return not_modified
+
         # See if they specified more than one of [saveframe, loop, tag]
         args = sum([1 if request.args.get('saveframe_category', None) else 0,
                     1 if request.args.get('saveframe_name', None) else 0,
@@ -231,17 +225,41 @@ def get_entry(entry_id=None):
 
         # They want an entry
         else:
+            # Send the stored entry without decompressing it if the client will do that
+            if format_ == "json" and request.accept_encodings.quality('deflate') > 0:
+                wrapped = querymod.get_wrapped_json_from_redis(entry_id)
+                if wrapped is not None:
+                    response = Response(wrapped, mimetype="application/json")
+                    response.headers['Content-Encoding'] = 'deflate'
+                    response.content_length = sum(len(x) for x in wrapped)
+                    response.vary.add('Accept-Encoding')
+                    return response
+
+            # Use the NMR-STAR rendered at reload time if there is one
+            if format_ in ("rawnmrstar", "nmrstar"):
+                rendered = querymod.get_nmrstar_from_redis(entry_id)
+                if rendered is not None:
+                    if format_ == "rawnmrstar":
+                        return send_deflated(rendered, "text/plain")
+                    return jsonify({entry_id: zlib.decompress(rendered).decode()})
+
             # Get the entry
             entry_id, entry = next(querymod.get_valid_entries_from_redis(entry_id, format_=format_))
 
             # Bypass JSON encode/decode cycle
             if format_ == "json":
-                return Response("""{"%s": %s}""" % (entry_id, entry.decode()), mimetype="application/json")
+                response = Response("""{"%s": %s}""" % (entry_id, entry.decode()), mimetype="application/json")
+                response.vary.add('Accept-Encoding')
+                return response
 
             # Special case to return raw nmrstar
             elif format_ == "rawnmrstar":
                 return Response(entry, mimetype="text/plain")
 
+            # NMR-STAR wrapped in JSON
+            elif format_ == "nmrstar":
+                return jsonify({entry_id: entry})
+
             # Special case for raw zlib
             elif format_ == "zlib":
                 return Response(entry, mimetype="application/zlib")
@@ -534,109 +552,41 @@ def simulate_hsqc(entry_id):
 
     # The PyBMRB exception only fires if the entry ID is valid
     check_valid(entry_id)
-    entry_object: pynmrstar.Entry = next(get_valid_entries_from_redis(entry_id))[1]
-
-    from pybmrb import Spectra
-    # 18857
 
     if format_ == 'html':
-        with tempfile.NamedTemporaryFile(suffix='.html') as output_file:
-            try:
-                peak_list = Spectra.n15hsqc(entry_objects=entry_object, legend='residue', show_visualization=False,
-                                            output_format='html', output_file=output_file.name)
-            except ValueError:
-                return 'No amide proton nitrogen chemical shifts found'
-            if len(peak_list[0]) == 0:
-                return 'No amide proton nitrogen chemical shifts found'
-            output_file.seek(0)
-            if len(output_file.read()) == 0:
-                raise ServerException('PyBMRB failed to generate valid output.')
-            return send_file(output_file.name)
-    elif format_ in ['csv', 'sparky']:
-
-        with tempfile.NamedTemporaryFile(suffix='.html') as output_file:
-            peak_list = Spectra.n15hsqc(entry_objects=entry_object, show_visualization=False)
-            Spectra.export_peak_list(peak_list=peak_list, output_format=format_, output_file_name=output_file.name,
-                                     include_side_chain=include_sidechain)
-            output_file.seek(0)
-
-            if format_ == "sparky":
-                response = Response(output_file.read(), mimetype='text/plain')
-                response.headers.set("Content-Disposition", 'attachment',
-                                     filename=f'{entry_id}_simulated_hsqc_{filter_}.list')
-            elif format_ == 'csv':
-                response = Response(output_file.read(), mimetype='text/csv')
-                response.headers.set("Content-Disposition", 'attachment',
-                                     filename=f'{entry_id}_simulated_hsqc_{filter_}.csv')
-            return response
+        html = get_hsqc_html(entry_id)
+        if html is None:
+            return 'No amide proton nitrogen chemical shifts found'
+        return send_deflated(html, 'text/html')
+
+    peak_list = render_peak_list(get_peak_list(entry_id), format_, include_sidechain)
+    if format_ == 'json':
+        return jsonify(peak_list)
+    elif format_ == "sparky":
+        response = Response(peak_list, mimetype='text/plain')
+        response.headers.set("Content-Disposition", 'attachment',
+                             filename=f'{entry_id}_simulated_hsqc_{filter_}.list')
+    else:
+        response = Response(peak_list, mimetype='text/csv')
+        response.headers.set("Content-Disposition", 'attachment',
+                             filename=f'{entry_id}_simulated_hsqc_{filter_}.csv')
+    return response
 
 
 @entry_endpoints.route('/entry/<entry_id>/validate')
 def validate_entry(entry_id):
-    """ Returns the validation report for the given entry. """
+    """ Returns the validation report for the given entry. With async, queues the validation and returns the ID of
+    the job, which can be polled at /jobs/<job_id>. """
 
-    try:
-        entry_id, entry = next(querymod.get_valid_entries_from_redis(entry_id))
-    except StopIteration:
-        raise RequestException("Entry '%s' does not exist in the public database." % entry_id)
-
-    result = {entry_id: {'avs': {}}}
-    # Put the chemical shift loop in a file
-    with tempfile.NamedTemporaryFile(dir="/dev/shm") as star_file:
-        star_file.write(str(entry).encode())
-        star_file.flush()
-
-        avs_location = os.path.join(querymod.SUBMODULE_DIR, "avs/validate_assignments_31.pl")
-        res = subprocess.check_output([avs_location, entry_id, "-nitrogen", "-fmean",
-                                       "-aromatic", "-std", "-anomalous", "-suspicious",
-                                       "-star_output", star_file.name])
-
-        error_loop = pynmrstar.Entry.from_string(res.decode())
-        try:
-            error_loop = error_loop.get_loops_by_category("_AVS_analysis_r")[0]
-            error_loop = error_loop.filter(["Assembly_ID", "Entity_assembly_ID",
-                                            "Entity_ID", "Comp_index_ID",
-                                            "Comp_ID",
-                                            "Comp_overall_assignment_score",
-                                            "Comp_typing_score",
-                                            "Comp_SRO_score",
-                                            "Comp_1H_shifts_analysis_status",
-                                            "Comp_13C_shifts_analysis_status",
-                                            "Comp_15N_shifts_analysis_status"])
-            error_loop.category = "AVS_analysis"
-
-            # Modify the chemical shift loops with the new data
-            shift_lists = entry.get_loops_by_category("atom_chem_shift")
-            for loop in shift_lists:
-                loop.add_tag(["AVS_analysis_status", "PANAV_analysis_status"])
-                for row in loop.data:
-                    row.extend(["Consistent", "Consistent"])
-
-            result[entry_id]["avs"] = error_loop.get_json(serialize=False)
-        except IndexError:
-            result[entry_id]["avs"] = {'error': "AVS failed to run on this entry."}
-
-    # PANAV
-    # For each chemical shift loop
-    for pos, cs_loop in enumerate(entry.get_loops_by_category("atom_chem_shift")):
-
-        # There is at least one chem shift saveframe for this entry
-        result[entry_id]["panav"] = {}
-        # Put the chemical shift loop in a file
-        with tempfile.NamedTemporaryFile(dir="/dev/shm") as chem_shifts:
-            chem_shifts.write(str(cs_loop).encode())
-            chem_shifts.flush()
-
-            panav_location = os.path.join(querymod.SUBMODULE_DIR, "panav/panav.jar")
-            try:
-                res = subprocess.check_output(["java", "-cp", panav_location, "CLI", "-f", "star", "-i",
-                                               chem_shifts.name], stderr=subprocess.STDOUT)
-                # There is a -j option that produces a somewhat usable JSON...
-                result[entry_id]["panav"][pos] = panav_parser(res)
-            except subprocess.CalledProcessError:
-                result[entry_id]["panav"][pos] = {"error": "PANAV failed on this entry."}
+    if ValidateEntry().load(request.args).get('async_', False):
+        check_valid(entry_id)
+        job_id = enqueue_job('validate', entry_id, request.remote_addr)
+        response = jsonify({"job_id": job_id, "status": "queued",
+                            "url": url_for('jobs.get_job_status', job_id=job_id, _external=True)})
+        response.status_code = 202
+        return response
 
-    return jsonify(result)
+    return jsonify({entry_id: get_validation_report(entry_id)})
 
 
 @entry_endpoints.route('/list_entries')
@@ -646,4 +596,11 @@ def list_entries():
 
     db = querymod.get_db("combined")
     with RedisConnection() as r:
+        # The list only changes when the database is reloaded
+        update_time = r.hget("%s:meta" % db, "update_time")
+        if update_time:
+            not_modified = use_etag(make_etag(db, update_time.decode()))
+            if not_modified:
+                return not_modified
+
         return jsonify(r.lrange("%s:entry_list" % db, 0, -1))
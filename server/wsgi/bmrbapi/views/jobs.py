@@ -0,0 +1,18 @@
+from flask import Blueprint, jsonify, Response
+
+from bmrbapi.exceptions import RequestException
+from bmrbapi.utils.jobs import get_job
+
+# Set up the blueprint
+job_endpoints = Blueprint('jobs', __name__)
+
+
+@job_endpoints.route('/jobs/<job_id>')
+def get_job_status(job_id: str) -> Response:
+    """ Returns the status of a job, and its result once it has finished. """
+
+    job = get_job(job_id)
+    if job is None:
+        raise RequestException("Job '%s' does not exist. (Results are only kept for a limited time.)" % job_id,
+                               status_code=404)
+    return jsonify(job)
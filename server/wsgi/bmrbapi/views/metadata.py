@@ -5,6 +5,7 @@ from flask import Blueprint, jsonify, Response
 from psycopg2.extras import DictCursor
 
 from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.decorators import cache_response
 from bmrbapi.views.sql.metadata import *
 
 # Set up the blueprint
@@ -12,6 +13,7 @@ meta_endpoints = Blueprint('metadata', __name__)
 
 
 @meta_endpoints.route('/meta/release_statistics')
+@cache_response(ttl=3600)
 def get_release_statistics() -> Response:
     """ Returns statistics about released entries. """
 
@@ -1,29 +1,70 @@
+import base64
+import functools
 import os
 import shlex
-import subprocess
-import textwrap
 import warnings
 from decimal import Decimal
+from hashlib import md5
 from tempfile import NamedTemporaryFile
-from typing import List, Dict, Iterable, Set
+from typing import List, Dict, Iterable, Iterator, Optional, Set
 from urllib.parse import quote
 
 import psycopg2
-from flask import jsonify, request, Blueprint, url_for
+import simplejson
+from flask import jsonify, request, Blueprint, url_for, Response
 from psycopg2 import ProgrammingError
 
 import bmrbapi.views.sql.search as sql_statements
 from bmrbapi.exceptions import RequestException, ServerException
+from bmrbapi.utils.columnar import COLUMNAR_FORMATS, export_query
 from bmrbapi.utils.configuration import configuration
-from bmrbapi.utils.connections import PostgresConnection
-from bmrbapi.utils.decorators import require_content_type_json
+from bmrbapi.utils.connections import PostgresConnection, RedisConnection
+from bmrbapi.utils.decorators import cache_response, require_content_type_json
+from bmrbapi.utils.fasta import fasta_search_slot, fasta_sequences, get_fasta_library, run_fasta, wrap_sequence
+from bmrbapi.utils.instant_index import get_instant_index, is_prefix_term
+from bmrbapi.utils.shift_index import ShiftIndex, get_shift_index
+from bmrbapi.utils.shift_scoring import score_shift_lists
 from bmrbapi.utils.querymod import SUBMODULE_DIR, get_db, get_entry_id_tag, select as qselect, \
     get_database_from_entry_id, get_valid_entries_from_redis, \
-    get_category_and_tag, wrap_it_up, select as querymod_select
+    get_category_and_tag, get_data_versions, wrap_it_up, select as querymod_select
 
 # Set up the blueprint
 search_endpoints = Blueprint('search', __name__)
 
+INSTANT_CACHE_KEY = "instant:%s:%s"
+
+# The order chemical shift searches are paged through in. Each column is ordered by whether it is NULL (so NULLs
+#  come last) and then by its value, with NULL replaced by a constant of the column type so that rows can be
+#  compared. There is a matching index on web.chem_shifts.
+CHEMICAL_SHIFTS_KEYSET = [("Atom_chem_shift.Atom_type", "''::text"),
+                          ("Atom_chem_shift.Atom_ID", "''::text"),
+                          ("Atom_chem_shift.Comp_ID", "''::text"),
+                          ("Atom_chem_shift.Val", "'NaN'::numeric"),
+                          ("Sample_conditions.pH", "'NaN'::numeric"),
+                          ("Sample_conditions.Temperature_K", "'NaN'::numeric"),
+                          ("Atom_chem_shift.Entry_ID", "''::text"),
+                          ("Atom_chem_shift.Assigned_chem_shift_list_ID", "-1"),
+                          ("Atom_chem_shift.Entity_assembly_ID", "-1"),
+                          ("Atom_chem_shift.Entity_ID", "-1"),
+                          ("Atom_chem_shift.Comp_index_ID", "-1"),
+                          ("Atom_chem_shift.Val_err", "'NaN'::numeric"),
+                          ("Atom_chem_shift.Ambiguity_code", "-1")]
+
+# The types of the chemical shift search columns in the columnar formats
+CHEMICAL_SHIFTS_COLUMN_TYPES = {"Atom_chem_shift.Entry_ID": "string",
+                                "Atom_chem_shift.Entity_ID": "int64",
+                                "Atom_chem_shift.Entity_assembly_ID": "int64",
+                                "Atom_chem_shift.Comp_index_ID": "int64",
+                                "Atom_chem_shift.Comp_ID": "string",
+                                "Atom_chem_shift.Atom_ID": "string",
+                                "Atom_chem_shift.Atom_type": "string",
+                                "Atom_chem_shift.Val": "float64",
+                                "Atom_chem_shift.Val_err": "float64",
+                                "Atom_chem_shift.Ambiguity_code": "int64",
+                                "Atom_chem_shift.Assigned_chem_shift_list_ID": "int64",
+                                "Sample_conditions.pH": "float64",
+                                "Sample_conditions.Temperature_K": "float64"}
+
 
 def get_extra_data_available(bmrb_id):
     """ Returns any additional data associated with the entry. For example:
@@ -118,24 +159,56 @@ def get_bmrb_data_from_pdb_id(pdb_id):
     return jsonify(result)
 
 
-@search_endpoints.route('/search/multiple_shift_search')
-def multiple_shift_search():
-    """ Finds entries that match at least some of the chemical shifts. """
+def _multiple_shift_search_index(index: ShiftIndex, shift_floats: List[float], thresholds: Dict[str, float],
+                                 solvent: str, database: str) -> dict:
+    """ Finds the shift lists with shifts close to the given shifts in the shift index, for
+    multiple_shift_search. Only the details of the matching lists are fetched from Postgres. """
 
-    shift_strings: List[str] = request.args.getlist('shift')
-    if not shift_strings:
-        shift_strings = request.args.getlist('s')
-    else:
-        shift_strings.extend(list(request.args.getlist('s')))
+    result = {"data": []}
+    shift_lists = index.find_shift_lists(shift_floats, thresholds)
+    sql = '''
+SELECT *
+FROM (SELECT l.entry_id,
+             l.list_id,
+             ent.title,
+             ent.link,
+             (SELECT array_agg(DISTINCT (s."Mol_common_name"))
+              FROM "Chem_shift_experiment" cse
+                       LEFT JOIN "Sample_component" s ON s."Sample_ID" = cse."Sample_ID"
+                  AND s."Entry_ID" = cse."Entry_ID"
+                  AND cse."Assigned_chem_shift_list_ID"::text = l.list_id
+                  AND cse."Entry_ID" = l.entry_id
+              WHERE (s."Type" ilike 'solvent' OR (s."Type" IS NULL
+                  AND s."Concentration_val_units" = '%%'
+                  AND web.convert_to_numeric(s."Concentration_val") >= 20
+                  AND s."Entity_ID" IS NULL))) AS solvent
+      FROM unnest(%s::text[], %s::text[]) WITH ORDINALITY AS l(entry_id, list_id, position)
+               LEFT JOIN web.instant_cache AS ent
+                         ON ent.id = l.entry_id
+      ORDER BY l.position) sq'''
+    terms = [[x[0] for x in shift_lists], [x[1] for x in shift_lists]]
+    if solvent != 'any':
+        sql += " WHERE %s ilike ANY(solvent)"
+        terms.append(solvent)
 
-    thresholds = {'N': float(request.args.get('nthresh', .2)),
-                  'C': float(request.args.get('cthresh', .2)),
-                  'H': float(request.args.get('hthresh', .01))}
+    shifts_by_list = {(x[0], x[1]): x[2] for x in shift_lists}
+    with PostgresConnection(schema=database) as cur:
+        cur.execute(sql, terms)
+        if configuration['debug']:
+            result['debug'] = cur.query
 
-    solvent = request.args.get('solvent', 'any').lower()
+        for entry in cur:
+            title = entry[2].replace("\n", "") if entry[2] else None
+            shifts = [{'Shift': Decimal(x[0]), 'Atom_type': x[1]} for x in shifts_by_list[(entry[0], entry[1])]]
+            result['data'].append({'Entry_ID': entry[0], 'Assigned_chem_shift_list_ID': entry[1],
+                                   'Title': title, 'Link': entry[3], 'Val': shifts, 'Solvent': entry[4]})
 
-    if not shift_strings:
-        raise RequestException("You must specify at least one shift to search for.")
+    return result
+
+
+def _multiple_shift_search_sql(shift_floats: List[float], thresholds: Dict[str, float], solvent: str,
+                               database: str) -> dict:
+    """ Finds the shift lists with shifts close to the given shifts in Postgres, for multiple_shift_search. """
 
     terms = []
     sql = '''
@@ -160,19 +233,6 @@ FROM (SELECT atom_shift."Entry_ID",
                          ON ent.id = atom_shift."Entry_ID"
       WHERE  '''
 
-    shift_floats: List[float] = []
-    shift_decimals: List[Decimal] = []
-    shift = None
-    try:
-        for shift in shift_strings:
-            shift_floats.append(float(shift))
-            shift_decimals.append(Decimal(shift))
-    except ValueError:
-        raise RequestException("Invalid shift specified. All shifts must be numbers. Invalid shift: '%s'" % shift)
-
-    shift_floats = sorted(shift_floats)
-    shift_decimals = sorted(shift_decimals)
-
     for shift in shift_floats:
         sql += '''
 ((atom_shift."Val"::float <= %s  AND atom_shift."Val"::float >= %s AND atom_shift."Atom_type" = 'C')
@@ -199,7 +259,7 @@ ORDER BY count(DISTINCT atom_shift."Val") DESC) sq
         terms.append(solvent)
 
     # Do the query
-    with PostgresConnection(schema=get_db("metabolomics")) as cur:
+    with PostgresConnection(schema=database) as cur:
         cur.execute(sql, terms)
         result = {"data": []}
 
@@ -215,42 +275,50 @@ ORDER BY count(DISTINCT atom_shift."Val") DESC) sq
             result['data'].append({'Entry_ID': entry[0], 'Assigned_chem_shift_list_ID': entry[1], 'Title': title,
                                    'Link': entry[4], 'Val': shifts, 'Solvent': entry[5]})
 
-    def get_closest(collection, number):
-        """ Returns the closest number from a list of numbers. """
-        return min(collection, key=lambda _: abs(_ - number))
+    return result
+
+
+@search_endpoints.route('/search/multiple_shift_search')
+def multiple_shift_search():
+    """ Finds entries that match at least some of the chemical shifts. """
 
-    def get_closest_by_atom(collection: dict,
-                            shift_value: Decimal) -> dict:
-        """ Returns the closest [shift,atom_name] pair from the options. """
+    shift_strings: List[str] = request.args.getlist('shift')
+    if not shift_strings:
+        shift_strings = request.args.getlist('s')
+    else:
+        shift_strings.extend(list(request.args.getlist('s')))
 
-        # Start with impossibly bad peak of the correct atom type, in case no matches for this peak exist
-        best_match: dict = {'Shift': Decimal('inf'), 'Atom_type': None}
-        for item in collection:
-            if abs(item['Shift'] - shift_value) < best_match['Shift']:
-                best_match = {'Shift': item['Shift'], 'Atom_type': item['Atom_type']}
-        return best_match
+    thresholds = {'N': float(request.args.get('nthresh', .2)),
+                  'C': float(request.args.get('cthresh', .2)),
+                  'H': float(request.args.get('hthresh', .01))}
 
-    def get_sort_key(res) -> [int, Decimal, str]:
-        """ Returns the sort key. """
+    solvent = request.args.get('solvent', 'any').lower()
 
-        key: Decimal = Decimal(0)
+    if not shift_strings:
+        raise RequestException("You must specify at least one shift to search for.")
 
-        # Add the difference of all the shifts
-        for item in res['Val']:
-            key += abs(get_closest(shift_decimals, item['Shift']) - item['Shift'])
-        res['Combined_offset'] = round(key, 3)
+    shift_floats: List[float] = []
+    shift_decimals: List[Decimal] = []
+    shift = None
+    try:
+        for shift in shift_strings:
+            shift_floats.append(float(shift))
+            shift_decimals.append(Decimal(shift))
+    except ValueError:
+        raise RequestException("Invalid shift specified. All shifts must be numbers. Invalid shift: '%s'" % shift)
 
-        # Determine how many of the queried shifts were matched
-        num_match = 0
-        for check_peak in shift_decimals:
-            closest = get_closest_by_atom(res['Val'], check_peak)
-            if abs(check_peak - closest['Shift']) <= thresholds[closest['Atom_type']]:
-                num_match += 1
-        res['Shifts_matched'] = num_match
+    shift_floats = sorted(shift_floats)
+    shift_decimals = sorted(shift_decimals)
 
-        return -num_match, key, res['Entry_ID']
+    # Use the in-memory shift index if the reloader built one
+    database = get_db("metabolomics")
+    index = get_shift_index(database)
+    if index is not None:
+        result = _multiple_shift_search_index(index, shift_floats, thresholds, solvent, database)
+    else:
+        result = _multiple_shift_search_sql(shift_floats, thresholds, solvent, database)
 
-    result['data'] = sorted(result['data'], key=get_sort_key)
+    result['data'] = score_shift_lists(result['data'], shift_decimals, thresholds)
 
     return jsonify(result)
 
@@ -361,22 +429,137 @@ WHERE
     sql += '''database=%s'''
     args.append(database)
 
+    format_: str = request.args.get('format', 'json')
+    limit: Optional[int] = request.args.get('limit', None, type=int)
+    after: Optional[str] = request.args.get('after', None)
+    max_limit: int = configuration.get('chemical_shifts_max_limit', 100000)
+    if limit and limit > max_limit:
+        raise RequestException('You may request at most %d chemical shifts per page.' % max_limit)
+
+    if format_ in COLUMNAR_FORMATS:
+        if limit or after:
+            raise RequestException('Paging is only supported for the json and ndjson formats.')
+        with PostgresConnection() as cur:
+            return export_query(cur, sql, args, format_, CHEMICAL_SHIFTS_COLUMN_TYPES, 'chemical_shifts')
+    if after and not limit:
+        raise RequestException('The "after" parameter can only be used together with "limit".')
+
+    if not limit:
+        mimetype = 'application/x-ndjson' if format_ == 'ndjson' else 'application/json'
+        return Response(_stream_chemical_shifts(sql, args, dictionary_result, format_), mimetype=mimetype)
+
+    # Page through the results in the keyset order, which is backed by an index
+    if after:
+        sql += ' AND (%s) > (%s)' % (_chemical_shifts_keyset(), _chemical_shifts_keyset(parameters=True))
+        for value in _decode_after_token(after):
+            args.extend([value, value])
+    sql += ' ORDER BY %s LIMIT %%s' % _chemical_shifts_keyset()
+    args.append(limit)
+
     # Do the query
     with PostgresConnection(real_dict_cursor=dictionary_result) as cur:
         cur.execute(sql, args)
+        columns = [desc[0] for desc in cur.description]
+        rows = cur.fetchall()
+        query = cur.query
+
+    next_after = None
+    if len(rows) == limit:
+        last_row = rows[-1] if dictionary_result else dict(zip(columns, rows[-1]))
+        next_after = _encode_after_token(last_row)
+
+    if format_ == 'ndjson':
+        response = Response(_ndjson_lines(columns, rows), mimetype='application/x-ndjson')
+    elif not dictionary_result:
+        result = {'columns': columns, 'data': rows, 'next': next_after}
+        # Send query string if in debug mode
+        if configuration['debug']:
+            result['debug'] = query
+        response = jsonify(result)
+    else:
+        response = jsonify(rows)
+    if next_after:
+        response.headers['X-Next-After'] = next_after
+    return response
+
+
+def _chemical_shifts_keyset(parameters: bool = False) -> str:
+    """ Returns the keyset of the chemical shift search as columns, or with parameters, as the placeholders for the
+    values of an 'after' token. Each value is used twice. """
+
+    keyset = []
+    for column, sentinel in CHEMICAL_SHIFTS_KEYSET:
+        value = '%s' if parameters else '"%s"' % column
+        keyset.append('%s IS NULL, COALESCE(%s, %s)' % (value, value, sentinel))
+    return ", ".join(keyset)
+
+
+def _encode_after_token(row: dict) -> str:
+    """ Returns the token which continues a chemical shift search after the given row. """
+
+    values = [row[column] for column, sentinel in CHEMICAL_SHIFTS_KEYSET]
+    return base64.urlsafe_b64encode(simplejson.dumps(values).encode()).decode()
+
+
+def _decode_after_token(token: str) -> list:
+    """ Returns the keyset values in an 'after' token, or raises a RequestException if it isn't one. """
+
+    try:
+        values = simplejson.loads(base64.urlsafe_b64decode(token.encode()), use_decimal=True)
+    except (ValueError, TypeError):
+        raise RequestException('Invalid "after" value. Please use the value returned with the previous page.')
+    if not isinstance(values, list) or len(values) != len(CHEMICAL_SHIFTS_KEYSET):
+        raise RequestException('Invalid "after" value. Please use the value returned with the previous page.')
+    for value, (column, sentinel) in zip(values, CHEMICAL_SHIFTS_KEYSET):
+        value_type = {"string": str, "int64": int}.get(CHEMICAL_SHIFTS_COLUMN_TYPES[column], (int, Decimal))
+        if value is not None and (not isinstance(value, value_type) or isinstance(value, bool)):
+            raise RequestException('Invalid "after" value. Please use the value returned with the previous page.')
+    return values
+
+
+def _ndjson_lines(columns: List[str], rows: Iterable) -> str:
+    """ Returns the rows as newline delimited JSON objects. """
+
+    return "".join(simplejson.dumps(row if isinstance(row, dict) else dict(zip(columns, row))) + "\n"
+                   for row in rows)
+
+
+def _stream_chemical_shifts(sql: str, args: list, dictionary_result: bool, format_: str) -> Iterator[str]:
+    """ Runs the query using a server side cursor and yields the results in batches, so that the
+    whole result never needs to be held in memory. """
 
-        if not dictionary_result:
-            result = {'columns': [desc[0] for desc in cur.description],
-                      'data': cur.fetchall()}
+    with PostgresConnection(real_dict_cursor=dictionary_result, server_side=True) as cur:
+        cur.execute(sql, args)
+        rows = cur.fetchmany(cur.itersize)
+        columns = [desc[0] for desc in cur.description]
+
+        if format_ == 'ndjson':
+            while rows:
+                yield _ndjson_lines(columns, rows)
+                rows = cur.fetchmany(cur.itersize)
+            return
+
+        if dictionary_result:
+            yield '['
+        else:
+            yield '{"columns": %s, "data": [' % simplejson.dumps(columns)
+        separator = ''
+        while rows:
+            yield separator + ", ".join(simplejson.dumps(row) for row in rows)
+            separator = ', '
+            rows = cur.fetchmany(cur.itersize)
+        if dictionary_result:
+            yield ']'
+        else:
             # Send query string if in debug mode
             if configuration['debug']:
-                result['debug'] = cur.query
-            return jsonify(result)
-        else:
-            return jsonify(cur.fetchall())
+                yield '], "debug": %s}' % simplejson.dumps(cur.query.decode())
+            else:
+                yield ']}'
 
 
 @search_endpoints.route('/search/get_all_values_for_tag/<tag_name>')
+@cache_response(ttl=86400)
 def get_all_values_for_tag(tag_name):
     """ Returns all entry numbers and corresponding tag values."""
 
@@ -388,18 +571,23 @@ def get_all_values_for_tag(tag_name):
         # Use Entry_ID normally, but occasionally use ID depending on the context
         id_field = get_entry_id_tag(tag_name, database=database)
 
+        format_ = request.args.get('format', 'json')
+        if format_ in COLUMNAR_FORMATS:
+            # One row per value rather than an array of values per entry
+            query = '''SELECT "%s", "%s"::text FROM "%s" WHERE "%s"::text NOT IN ('', 'na') ORDER BY "%s"'''
+            query = query % (id_field, params[1], params[0], params[1], id_field)
+            column_types = {id_field: 'string', params[1]: 'string'}
+            try:
+                return export_query(cur, query, [], format_, column_types, tag_name)
+            except ProgrammingError as e:
+                _raise_tag_not_found(e)
+
         query = '''SELECT "%s", array_agg(%%s) from "%s" GROUP BY "%s";'''
         query = query % (id_field, params[0], id_field)
         try:
             cur.execute(query, [wrap_it_up(params[1])])
         except ProgrammingError as e:
-            sp = str(e).split('\n')
-            if len(sp) > 3:
-                if sp[3].strip().startswith("HINT:  Perhaps you meant to reference the column"):
-                    raise RequestException("Tag not found. Did you mean the tag: '%s'?" %
-                                           sp[3].split('"')[1])
-
-            raise RequestException("Tag not found.")
+            _raise_tag_not_found(e)
 
         # Turn the results into a dict
         res = {}
@@ -417,6 +605,19 @@ def get_all_values_for_tag(tag_name):
     return res
 
 
+def _raise_tag_not_found(error: ProgrammingError):
+    """ Raises a RequestException for a query on a tag which doesn't exist, suggesting the right tag
+    if Postgres has one. """
+
+    sp = str(error).split('\n')
+    if len(sp) > 3:
+        if sp[3].strip().startswith("HINT:  Perhaps you meant to reference the column"):
+            raise RequestException("Tag not found. Did you mean the tag: '%s'?" %
+                                   sp[3].split('"')[1])
+
+    raise RequestException("Tag not found.")
+
+
 @search_endpoints.route('/search/get_id_by_tag_value/<tag_name>/<path:tag_value>')
 def get_id_from_search(tag_name, tag_value):
     """ Returns all BMRB IDs that were found when querying for entries
@@ -482,59 +683,72 @@ def fasta_search(sequence):
     a_type = request.args.get('type', 'polymer')
     e_val = request.args.get('e_val')
 
-    # Map the type to the exact name
-    a_type = {'polymer': 'polypeptide(L)', 'rna': 'polyribonucleotide', 'dna': 'polydeoxyribonucleotide'}[a_type]
-
     if not os.path.isfile(fasta_binary):
         raise ServerException("Unable to perform FASTA search. Server improperly installed.")
 
-    with PostgresConnection(schema="macromolecules") as cur:
-        cur.execute('''
-SELECT ROW_NUMBER() OVER (ORDER BY 1) AS id, entity."Entry_ID",entity."ID",
-  regexp_replace(entity."Polymer_seq_one_letter_code", E'[\\n\\r]+', '', 'g' ),
-  replace(regexp_replace(entry."Title", E'[\\n\\r]+', ' ', 'g' ), '  ', ' ')
-FROM "Entity" as entity
-  LEFT JOIN "Entry" as entry
-  ON entity."Entry_ID" = entry."ID"
-  WHERE entity."Polymer_seq_one_letter_code" IS NOT NULL AND "Polymer_type" = %s''', [a_type])
+    library = get_fasta_library()
+    sequence = "".join(sequence.split()).upper()
 
-        sequences = cur.fetchall()
+    # The same sequences are searched over and over, so the results are cached until the libraries are rebuilt
+    cache_ttl = configuration.get('fasta', {}).get('cache_ttl', 86400)
+    cache_key = library.result_key(sequence, a_type, e_val) if library and cache_ttl else None
+    if cache_key:
+        with RedisConnection() as r:
+            cached = r.get(cache_key)
+        if cached:
+            return jsonify(simplejson.loads(cached, use_decimal=True))
 
-    wrapper = textwrap.TextWrapper(width=80, expand_tabs=False,
-                                   replace_whitespace=False,
-                                   drop_whitespace=False, break_on_hyphens=False)
-    seq_strings = [">%s\n%s\n" % (x[0], "\n".join(wrapper.wrap(x[3]))) for x in sequences]
-
-    # Use temporary files to store the FASTA search string and FASTA DB
+    # Use temporary files to store the FASTA search string, and the FASTA DB if it hasn't been built
     with NamedTemporaryFile(dir="/tmp") as fasta_file, \
             NamedTemporaryFile(dir="/tmp") as sequence_file:
-        fasta_file.write((">query\n%s" % sequence.upper()).encode())
+        fasta_file.write((">query\n%s" % sequence).encode())
         fasta_file.flush()
 
-        sequence_file.write(("".join(seq_strings)).encode())
-        sequence_file.flush()
+        if library:
+            candidates = library.write_candidates(a_type, sequence, sequence_file)
+            if candidates is None:
+                library_files = library.library_files(a_type)
+            else:
+                library_files = [sequence_file.name] if candidates else []
+            database_size = library.size(a_type)
+            lookup = functools.partial(library.lookup, a_type)
+        else:
+            sequences = fasta_sequences(a_type)
+            sequence_file.write(("".join(">%s\n%s\n" % (position, wrap_sequence(x[2]))
+                                         for position, x in enumerate(sequences, 1))).encode())
+            sequence_file.flush()
+            library_files = [sequence_file.name]
+            database_size = None
+
+            def lookup(sequence_id: int) -> List[str]:
+                matching_row = sequences[sequence_id - 1]
+                return [matching_row[0], matching_row[1], matching_row[3]]
 
         # Set up the FASTA arguments
         fasta_arguments = [fasta_binary, "-m", "8"]
         if e_val:
             fasta_arguments.extend(["-E", e_val])
-        fasta_arguments.extend([fasta_file.name, sequence_file.name])
 
-        # Run FASTA
-        res = subprocess.check_output(fasta_arguments, stderr=subprocess.STDOUT).decode()
+        # Run FASTA, unless no sequence could match
+        hits = []
+        if library_files:
+            with fasta_search_slot():
+                hits = run_fasta(fasta_arguments, fasta_file.name, library_files, database_size)
 
     # Combine the results
     results = []
-    for line in res.split("\n"):
-        cols = line.split()
-        if len(cols) == 12:
-            matching_row = sequences[int(cols[1]) - 1]
-            results.append({'entry_id': matching_row[1], 'entity_id': matching_row[2],
-                            'entry_title': matching_row[4], 'percent_id': Decimal(cols[2]),
-                            'alignment_length': int(cols[3]), 'mismatches': int(cols[4]),
-                            'gap_openings': int(cols[5]), 'q.start': int(cols[6]),
-                            'q.end': int(cols[7]), 's.start': int(cols[8]), 's.end': int(cols[9]),
-                            'e-value': Decimal(cols[10]), 'bit_score': Decimal(cols[11])})
+    for cols in hits:
+        entry_id, entity_id, entry_title = lookup(int(cols[1]))
+        results.append({'entry_id': entry_id, 'entity_id': entity_id,
+                        'entry_title': entry_title, 'percent_id': Decimal(cols[2]),
+                        'alignment_length': int(cols[3]), 'mismatches': int(cols[4]),
+                        'gap_openings': int(cols[5]), 'q.start': int(cols[6]),
+                        'q.end': int(cols[7]), 's.start': int(cols[8]), 's.end': int(cols[9]),
+                        'e-value': Decimal(cols[10]), 'bit_score': Decimal(cols[11])})
+
+    if cache_key:
+        with RedisConnection() as r:
+            r.set(cache_key, simplejson.dumps(results, separators=(',', ':')), ex=cache_ttl)
 
     return jsonify(results)
 
@@ -579,10 +793,53 @@ def instant():
             continue
         x += 1
     term = " ".join(split_term)
+    limit: Optional[int] = request.args.get('limit', None, type=int)
+
+    # The negated terms are compiled into the queries, so that only the rows which are returned are fetched. A
+    #  result is excluded if a negated term is part of its title, one of its citations or the extra term that matched.
+    parameters = {'term': term, 'limit': limit}
+    negations = ""
+    extra_term_negations = ""
+    for position, negated_term in enumerate(sorted(negated_terms)):
+        parameters['negated_%d' % position] = "%%%s%%" % negated_term.replace("\\", "\\\\") \
+            .replace("%", "\\%").replace("_", "\\_")
+        negations += " AND COALESCE(instant_cache.title, '') NOT ILIKE %%(negated_%d)s" \
+                     " AND NOT EXISTS (SELECT 1 FROM unnest(instant_cache.citations) AS citation" \
+                     " WHERE citation ILIKE %%(negated_%d)s)" % (position, position)
+        extra_term_negations += " AND COALESCE(tt.term, '') NOT ILIKE %%(negated_%d)s" % position
+    instant_query_one = instant_query_one.format(negations=negations)
+    instant_query_two = instant_query_two.format(negations=negations + extra_term_negations)
+
+    settings = configuration.get('instant', {})
+    cache_ttl = settings.get('cache_ttl', 3600) if not configuration['debug'] else 0
+    with RedisConnection() as r:
+        versions = get_data_versions(r)
+        cache_key = INSTANT_CACHE_KEY % (database, md5(simplejson.dumps([term, sorted(negated_terms), limit,
+                                                                          versions]).encode()).hexdigest())
+        cached = r.get(cache_key) if cache_ttl else None
+
+    if cached:
+        return Response(cached, mimetype='application/json')
+
+    # Someone still typing an ID or the start of a word can be answered from the prefix index
+    if not negated_terms and is_prefix_term(term) and not configuration['debug']:
+        instant_index = get_instant_index(versions)
+        if instant_index:
+            completions = instant_index.complete(term, database, min(limit or settings.get('prefix_limit', 25),
+                                                                     settings.get('prefix_limit', 25)),
+                                                 settings.get('prefix_max_keys', 500))
+            if completions:
+                result = []
+                for row, extra, sml in completions:
+                    res = _instant_result(row, database, extra)
+                    if extra:
+                        res['sml'] = "%s" % sml
+                    result.append(res)
+                return _instant_response(result, cache_key, cache_ttl)
 
     with PostgresConnection() as cur:
         try:
-            cur.execute(instant_query_one, [term, term, term])
+            cur.execute(instant_query_one, parameters)
         except psycopg2.ProgrammingError:
             if configuration['debug']:
                 raise
@@ -593,23 +850,7 @@ def instant():
         result = []
         ids = {}
         for item in cur.fetchall():
-            res = {"citations": item['citations'],
-                   "authors": item['authors'],
-                   "link": item['link'],
-                   "value": item['id'],
-                   "sub_date": str(item['sub_date']),
-                   "data_types": item['data_types'],
-                   "label": "%s" % (item['title'])}
-
-            if database == "metabolomics":
-                res['formula'] = item['formula']
-                res['smiles'] = item['smiles']
-                res['inchi'] = item['inchi']
-                res['monoisotopic_mass'] = item['monoisotopic_mass']
-                res['average_mass'] = item['average_mass']
-                res['molecular_weight'] = item['molecular_weight']
-
-            result.append(res)
+            result.append(_instant_result(item, database))
             ids[item['id']] = 1
 
         debug = {}
@@ -618,7 +859,7 @@ def instant():
 
         # Second query
         try:
-            cur.execute(instant_query_two, [term, term, term, term])
+            cur.execute(instant_query_two, parameters)
         except psycopg2.ProgrammingError:
             if configuration['debug']:
                 raise
@@ -627,54 +868,51 @@ def instant():
 
         for item in cur.fetchall():
             if item['id'] not in ids:
-                res = {"citations": item['citations'],
-                       "authors": item['authors'],
-                       "link": item['link'],
-                       "value": item['id'],
-                       "sub_date": str(item['sub_date']),
-                       "data_types": item['data_types'],
-                       "label": "%s" % (item['title']),
-                       "extra": {"term": item['term'],
-                                 "termname": item['termname']},
-                       "sml": "%s" % item['sml']}
-                if database == "metabolomics":
-                    res['formula'] = item['formula']
-                    res['smiles'] = item['smiles']
-                    res['inchi'] = item['inchi']
-                    res['monoisotopic_mass'] = item['monoisotopic_mass']
-                    res['average_mass'] = item['average_mass']
-                    res['molecular_weight'] = item['molecular_weight']
-
+                res = _instant_result(item, database, {"term": item['term'], "termname": item['termname']})
+                res['sml'] = "%s" % item['sml']
                 result.append(res)
+        # The limit applies to each query, so the two together can return more
+        if limit is not None:
+            del result[limit:]
         if configuration['debug']:
             debug['query2'] = cur.query
             result.append({"debug": debug})
 
-    def needs_remove(negated_term_list, check_result):
-        for negated_term in negated_term_list:
-            if negated_term in check_result['label'].lower():
-                return True
-            if 'extra' in check_result and negated_term in check_result['extra']['term'].lower():
-                return True
-            citations = check_result['citations']
-            if citations[0] is None:
-                citations.pop(0)
-            if any([negated_term in _.lower() for _ in [_ for _ in citations]]):
-                return True
-        return False
-
-    # Remove the negation results
-    x = 0
-    while x < len(result):
-        if 'debug' in result[x]:
-            x += 1
-            continue
-        if needs_remove(negated_terms, result[x]):
-            result.pop(x)
-            continue
-        x += 1
+    return _instant_response(result, cache_key, cache_ttl)
 
-    return jsonify(result)
+
+def _instant_response(result: list, cache_key: str, cache_ttl: int) -> Response:
+    """ Returns the instant search results, and caches them for cache_ttl seconds. """
+
+    response = jsonify(result)
+    if cache_ttl:
+        with RedisConnection() as r:
+            r.set(cache_key, response.get_data(), ex=cache_ttl)
+    return response
+
+
+def _instant_result(item, database: str, extra: dict = None) -> dict:
+    """ Formats a row of the instant search, and the extra search term that matched (if any), as a result. """
+
+    res = {"citations": item['citations'],
+           "authors": item['authors'],
+           "link": item['link'],
+           "value": item['id'],
+           "sub_date": str(item['sub_date']),
+           "data_types": item['data_types'],
+           "label": "%s" % (item['title'])}
+    if extra:
+        res['extra'] = extra
+
+    if database == "metabolomics":
+        res['formula'] = item['formula']
+        res['smiles'] = item['smiles']
+        res['inchi'] = item['inchi']
+        res['monoisotopic_mass'] = item['monoisotopic_mass']
+        res['average_mass'] = item['average_mass']
+        res['molecular_weight'] = item['molecular_weight']
+
+    return res
 
 
 @search_endpoints.route('/select', methods=['POST'])
@@ -1,12 +1,14 @@
 from flask import jsonify, Blueprint
 
 from bmrbapi.utils.connections import PostgresConnection
+from bmrbapi.utils.decorators import cache_response
 from bmrbapi.utils.querymod import get_db
 
 software_blueprint = Blueprint('software', __name__)
 
 
 @software_blueprint.route('/software')
+@cache_response(ttl=86400)
 def get_software_summary():
     """ Returns a summary of all software used in all entries. """
 
@@ -25,6 +27,7 @@ FROM "Software"
 
 
 @software_blueprint.route('/software/package/<package_name>')
+@cache_response(ttl=86400)
 def get_software_by_package(package_name):
     """ Returns the entries that used a particular software package. Search
     is done case-insensitive and is an x in y search rather than x == y
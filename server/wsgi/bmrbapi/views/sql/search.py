@@ -15,10 +15,11 @@ SELECT instant_cache.id,
 FROM web.instant_cache
          LEFT JOIN web.metabolomics_summary AS ms
                    ON instant_cache.id = ms.id
-WHERE tsv @@ plainto_tsquery(%s)
+WHERE tsv @@ plainto_tsquery(%(term)s){negations}
   AND is_metab = 'True'
   AND ms.id IS NOT NULL
-ORDER BY instant_cache.id = %s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%s)) DESC;'''
+ORDER BY instant_cache.id = %(term)s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%(term)s)) DESC
+LIMIT %(limit)s;'''
 
 metabolomics_instant_query_two = """
 SELECT set_limit(.5);
@@ -42,14 +43,14 @@ SELECT DISTINCT ON (tt.id) term,
 FROM web.instant_cache
          LEFT JOIN web.instant_extra_search_terms AS tt
                    ON instant_cache.id = tt.id
-WHERE tt.identical_term @@ plainto_tsquery(%s)
+WHERE tt.identical_term @@ plainto_tsquery(%(term)s){negations}
   AND is_metab = 'True'
 UNION
 SELECT *
 FROM (
          SELECT DISTINCT ON (tt.id) term,
                                  termname,
-                                 similarity(tt.term, %s) AS sml,
+                                 similarity(tt.term, %(term)s) AS sml,
                                  tt.id,
                                  title,
                                  citations,
@@ -69,18 +70,21 @@ FROM (
                             ON instant_cache.id = tt.id
                   LEFT JOIN web.metabolomics_summary AS ms
                             ON instant_cache.id = ms.id
-         WHERE tt.term %% %s
+         WHERE tt.term %% %(term)s{negations}
            AND tt.identical_term IS NULL
            AND ms.id IS NOT NULL
-         ORDER BY id, similarity(tt.term, %s) DESC) AS y
-WHERE is_metab = 'True'"""
+         ORDER BY id, similarity(tt.term, %(term)s) DESC) AS y
+WHERE is_metab = 'True'
+ORDER BY sml DESC
+LIMIT %(limit)s"""
 
 macromolecules_instant_query_one = '''
 SELECT id, title, citations, authors, link, sub_date, data_types
 FROM web.instant_cache
-WHERE tsv @@ plainto_tsquery(%s)
+WHERE tsv @@ plainto_tsquery(%(term)s){negations}
   AND is_metab = 'False'
-ORDER BY id = %s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%s)) DESC;
+ORDER BY id = %(term)s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%(term)s)) DESC
+LIMIT %(limit)s;
 '''
 
 macromolecules_instant_query_two = '''
@@ -99,13 +103,13 @@ SELECT DISTINCT ON (tt.id) term,
 FROM web.instant_cache
          LEFT JOIN web.instant_extra_search_terms AS tt
                    ON instant_cache.id = tt.id
-WHERE tt.identical_term @@ plainto_tsquery(%s)
+WHERE tt.identical_term @@ plainto_tsquery(%(term)s){negations}
 UNION
 SELECT *
 FROM (
          SELECT DISTINCT ON (tt.id) term,
                                                termname,
-                                               similarity(tt.term, %s) AS sml,
+                                               similarity(tt.term, %(term)s) AS sml,
                                                tt.id,
                                                title,
                                                citations,
@@ -117,20 +121,21 @@ FROM (
          FROM web.instant_cache
                   LEFT JOIN web.instant_extra_search_terms AS tt
                             ON instant_cache.id = tt.id
-         WHERE tt.term %% %s
+         WHERE tt.term %% %(term)s{negations}
            AND tt.identical_term IS NULL
-         ORDER BY id, similarity(tt.term, %s) DESC) AS y
+         ORDER BY id, similarity(tt.term, %(term)s) DESC) AS y
 WHERE is_metab = 'False'
 ORDER BY sml DESC
-LIMIT 75;
+LIMIT LEAST(%(limit)s, 75);
 '''
 
 
 combined_instant_query_one = '''
 SELECT id, title, citations, authors, link, sub_date, data_types
 FROM web.instant_cache
-WHERE tsv @@ plainto_tsquery(%s)
-ORDER BY id = %s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%s)) DESC;
+WHERE tsv @@ plainto_tsquery(%(term)s){negations}
+ORDER BY id = %(term)s DESC, is_metab, sub_date DESC, ts_rank_cd(tsv, plainto_tsquery(%(term)s)) DESC
+LIMIT %(limit)s;
 '''
 
 combined_instant_query_two = '''
@@ -149,13 +154,13 @@ SELECT DISTINCT ON (tt.id) term,
 FROM web.instant_cache
          LEFT JOIN web.instant_extra_search_terms AS tt
                    ON instant_cache.id = tt.id
-WHERE tt.identical_term @@ plainto_tsquery(%s)
+WHERE tt.identical_term @@ plainto_tsquery(%(term)s){negations}
 UNION
 SELECT *
 FROM (
          SELECT DISTINCT ON (tt.id) term,
                                                termname,
-                                               similarity(tt.term, %s) AS sml,
+                                               similarity(tt.term, %(term)s) AS sml,
                                                tt.id,
                                                title,
                                                citations,
@@ -167,9 +172,9 @@ FROM (
          FROM web.instant_cache
                   LEFT JOIN web.instant_extra_search_terms AS tt
                             ON instant_cache.id = tt.id
-         WHERE tt.term %% %s
+         WHERE tt.term %% %(term)s{negations}
            AND tt.identical_term IS NULL
-         ORDER BY id, similarity(tt.term, %s) DESC) AS y
+         ORDER BY id, similarity(tt.term, %(term)s) DESC) AS y
 ORDER BY sml DESC
-LIMIT 75;
+LIMIT LEAST(%(limit)s, 75);
 '''
\ No newline at end of file